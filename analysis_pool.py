@@ -0,0 +1,230 @@
+"""Pool de workers partagé pour exécuter les analyses hors du thread du script.
+
+Le script Streamlit soumet l'analyse, range l'identifiant du job dans la
+session et rend la main : la page interroge ensuite le job à intervalle
+régulier, affiche le résultat partiel (streaming) puis le résultat final.
+La capacité est bornée (workers + file d'attente) : au-delà, submit() lève
+PoolFullError et la page demande de réessayer au lieu d'empiler les sessions.
+Les jobs spéculatifs (lancés dès l'envoi de la photo, avant le clic) n'ont
+droit qu'à la moitié de la file et sont abandonnés s'ils n'ont pas démarré
+quand la photo est remplacée ou la session fermée.
+"""
+import copy
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from memory_report import get_memory_ledger
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+POOL_WORKERS = int(os.getenv("BEAUTY_POOL_WORKERS", "8"))
+POOL_MAX_QUEUE = int(os.getenv("BEAUTY_POOL_MAX_QUEUE", "32"))
+# Un job terminé mais jamais relu (onglet fermé) est oublié après ce délai
+JOB_TTL_SECONDS = int(os.getenv("BEAUTY_POOL_JOB_TTL", "600"))
+
+
+class PoolFullError(RuntimeError):
+    """Workers et file d'attente pleins : la demande est refusée."""
+
+
+class Job:
+    def __init__(self, job_id: str, speculative: bool = False,
+                 precondition: Optional[Callable[[], bool]] = None,
+                 session: Optional[str] = None):
+        self.id = job_id
+        self.speculative = speculative
+        # Session à laquelle imputer la mémoire du job (memory_report)
+        self.session = session
+        self.claimed = False
+        self.cancelled = False
+        # Vérifiée au démarrage : False (session fermée...) et le job est abandonné
+        self.precondition = precondition
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.future: Optional[Future] = None
+        self._lock = threading.Lock()
+        self._partial: Dict = {}
+        self._completed: Set[str] = set()
+        # Issue de l'analyse et message éventuel (niveau, texte), affichés par la page
+        self.outcome: Optional[str] = None
+        self.notice: Optional[Tuple[str, str]] = None
+
+    def update(self, partial: Dict, completed: Set[str]) -> None:
+        # Appelé depuis le worker ; copie, car le parseur continue de modifier son objet
+        snapshot = copy.deepcopy(partial)
+        with self._lock:
+            self._partial = snapshot
+            self._completed = set(completed)
+
+    def report(self, outcome: str, notice: Optional[Tuple[str, str]] = None) -> None:
+        # Appelé depuis le worker : st.* n'y affiche rien, la page relit ces champs
+        self.outcome = outcome
+        self.notice = notice
+
+    def progress(self):
+        with self._lock:
+            return self._partial, self._completed
+
+    @property
+    def state(self) -> str:
+        if self.finished_at is not None:
+            return "done"
+        return "running" if self.started_at is not None else "queued"
+
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def result(self) -> Any:
+        # Relance l'exception du worker le cas échéant
+        return self.future.result()
+
+
+class AnalysisPool:
+    def __init__(self, workers: int = POOL_WORKERS, max_queue: int = POOL_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+        self._queued = 0
+        self._running = 0
+        self.stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "cancelled": 0}
+
+    def submit(self, fn: Callable[..., Any], *args, speculative: bool = False,
+               precondition: Optional[Callable[[], bool]] = None,
+               session: Optional[str] = None, **kwargs) -> Job:
+        # fn(job, *args) : le job sert à publier la progression
+        with self._lock:
+            self._sweep()
+            # Les jobs spéculatifs laissent la moitié de la file aux clics
+            capacity = self.workers + (self.max_queue // 2 if speculative else self.max_queue)
+            if self._queued + self._running >= capacity:
+                self.stats["rejected"] += 1
+                raise PoolFullError("Trop d'analyses en cours, réessayez dans quelques secondes")
+            job = Job(uuid.uuid4().hex, speculative, precondition, session)
+            self._jobs[job.id] = job
+            self._queued += 1
+            self.stats["submitted"] += 1
+        job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job: Job, fn: Callable[..., Any], args, kwargs) -> Any:
+        if job.cancelled or (job.precondition is not None and not self._check(job.precondition)):
+            with self._lock:
+                self._queued -= 1
+                self.stats["cancelled"] += 1
+            job.finished_at = time.time()
+            return None
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        job.started_at = time.time()
+        try:
+            with get_memory_ledger().measure(job.session, "analysis"):
+                result = fn(job, *args, **kwargs)
+        except BaseException:
+            logger.exception("Analyse %s en échec", job.id)
+            with self._lock:
+                self.stats["failed"] += 1
+            raise
+        else:
+            with self._lock:
+                self.stats["completed"] += 1
+            return result
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._running -= 1
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        if job_id is None:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def forget(self, job_id: str) -> None:
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def cancel(self, job_id: Optional[str]) -> None:
+        # Un job pas encore démarré est abandonné ; un appel déjà parti va à son terme
+        # (son résultat alimente le cache partagé) mais n'est plus relu
+        with self._lock:
+            job = self._jobs.pop(job_id, None) if job_id else None
+        if job is None:
+            return
+        job.cancelled = True
+        if job.speculative and not job.claimed:
+            get_metrics().count_speculation("cancelled")
+
+    def claim(self, job_id: Optional[str]) -> Optional[Job]:
+        # Clic sur le bouton alors qu'un job spéculatif existe : il devient le job de la page
+        job = self.get(job_id)
+        if job is None or job.cancelled:
+            return None
+        job.claimed = True
+        metrics = get_metrics()
+        metrics.count_speculation("claimed_ready" if job.done() else "claimed_pending")
+        if job.started_at is not None:
+            # Avance prise sur le clic : le temps de modèle déjà écoulé
+            metrics.observe_head_start((job.finished_at or time.time()) - job.started_at)
+        return job
+
+    @staticmethod
+    def _check(precondition: Callable[[], bool]) -> bool:
+        try:
+            return bool(precondition())
+        except Exception:
+            return True
+
+    def queue_position(self, job: Job) -> int:
+        # Nombre de jobs soumis avant celui-ci et pas encore démarrés
+        with self._lock:
+            return sum(1 for other in self._jobs.values()
+                       if other.started_at is None and other.finished_at is None
+                       and other.submitted_at < job.submitted_at)
+
+    def _sweep(self) -> None:
+        # Appelé avec self._lock déjà acquis
+        limit = time.time() - JOB_TTL_SECONDS
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and j.finished_at < limit]:
+            job = self._jobs.pop(job_id)
+            if job.speculative and not job.claimed:
+                # Photo envoyée mais bouton jamais cliqué : spéculation perdue
+                get_metrics().count_speculation("unused")
+
+    def queue_depth(self) -> int:
+        with self._lock:
+            return self._queued
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {**self.stats, "queued": self._queued, "running": self._running,
+                    "workers": self.workers, "max_queue": self.max_queue, "jobs": len(self._jobs)}
+
+
+_shared: Optional[AnalysisPool] = None
+_shared_lock = threading.Lock()
+
+
+def get_analysis_pool() -> AnalysisPool:
+    # Un seul pool par processus Streamlit, partagé par toutes les sessions
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = AnalysisPool()
+            metrics = get_metrics()
+            metrics.register_callback("beauty_pool_queue_depth", "Analyses en attente d'un worker",
+                                      _shared.queue_depth)
+            metrics.register_callback("beauty_pool_running", "Analyses en cours d'exécution",
+                                      lambda: _shared.snapshot()["running"])
+            metrics.register_callback("beauty_pool_rejected_total", "Analyses refusées (pool plein)",
+                                      lambda: _shared.stats["rejected"], kind="counter")
+        return _shared
@@ -1,7 +1,11 @@
 import base64
+import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import replace
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional, Set, Tuple, TypedDict
 import json
 import re
 
@@ -9,6 +13,31 @@ import streamlit as st
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from analysis_pool import Job, PoolFullError, get_analysis_pool
+from cascade import (BRIEF_INSTRUCTION, CONFIDENCE_PROPERTY, Tier, cascade_enabled_by_env,
+                     escalation_reason)
+from image_prep import PREVIEW_OPTIONS, ImageOptions, PreparedImage, prepare_image
+from json_stream import StreamTiming, stream_completion, streaming_enabled
+from metrics import AnalysisTrace, start_exporter, start_trace, timed
+from multi_photo import (MAX_SESSION_PHOTOS, check_session, photo_key, session_cache_key,
+                         session_content, session_max_tokens, session_result, session_schema,
+                         split_session)
+from openai_client import get_openai_client, start_warm_up
+from rate_limiter import RateLimitExceeded, estimate_request_tokens
+from resilience import CircuitOpenError, ResilientCaller, get_resilient_caller, latency_class
+from near_duplicate import NearDuplicateIndex, get_near_duplicate_index
+from result_cache import ResultCache, cache_namespace, get_result_cache, make_cache_key
+from session_memo import (RETRY_OUTCOMES, SessionMemo, claim_speculation, poll_job,
+                          start_speculation)
+from single_flight import SingleFlight, get_single_flight
+from structured_output import (SchemaValidationError, coerce_bool, enum_property,
+                               json_schema_format, repair_enum, strict_object)
+from upload_buffer import MAX_UPLOAD_BYTES, UploadTooLargeError, upload_bytes
+
+logger = logging.getLogger(__name__)
+
+DEGRADED_NOTICE = "Service d'analyse momentanément indisponible : résultat simplifié."
+
 # Configuration des types de barbe avec leurs descriptions
 BEARD_STYLES = {
     'Barbe Complète': 'Une barbe épaisse et complète qui couvre tout le visage',
@@ -48,55 +77,39 @@ LOREAL_PRODUCTS = {
     }
 }
 
-class BeardAnalyzer:
-    def __init__(self):
-        # load_dotenv()
-        # self.api_key = os.getenv("OPENAI_API_KEY")
-        # self.client = OpenAI()
-        self.api_key = st.secrets["OPENAI_API_KEY"]
-        self.client = OpenAI()
+class BeardRecommendations(TypedDict):
+    trim: str
+    products: List[str]
+    routine: str
 
-    def _encode_image(self, image_bytes: bytes) -> str:
-        return base64.b64encode(image_bytes).decode("utf-8")
+class BeardResult(TypedDict):
+    recommended_style: str
+    recommended_color: str
+    trim_length_mm: str
+    has_gray: bool
+    face_shape: str
+    problem_areas: List[str]
+    recommendations: BeardRecommendations
+    analysis: str
 
-    def _clean_response(self, response: str) -> Dict:
-        # Supprimer les balises code et json
-        cleaned = re.sub(r'```json\s*|\s*```', '', response)
-        try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError:
-            return {
-                "recommended_style": "Barbe Courte",
-                "recommended_color": "Naturel",
-                "trim_length_mm": "5-10",
-                "has_gray": False,
-                "recommendations": {
-                    "trim": "Une légère taille est recommandée pour maintenir une apparence professionnelle",
-                    "products": ["L'Oréal Men Expert Barber Club Huile", "L'Oréal Men Expert Barber Club Gel"],
-                    "routine": "Lavage quotidien et hydratation recommandés"
-                },
-                "face_shape": "Ovale",
-                "problem_areas": [],
-                "analysis": "Désolé, une erreur s'est produite pendant l'analyse."
-            }
+# Schéma imposé au modèle : style et couleur ne peuvent être que des clés connues
+BEARD_SCHEMA = strict_object({
+    "recommended_style": enum_property(BEARD_STYLES),
+    "recommended_color": enum_property(BEARD_COLORS),
+    "trim_length_mm": {"type": "string"},
+    "has_gray": {"type": "boolean"},
+    "face_shape": {"type": "string"},
+    "problem_areas": {"type": "array", "items": {"type": "string"}},
+    "recommendations": strict_object({
+        "trim": {"type": "string"},
+        "products": {"type": "array", "items": {"type": "string"}},
+        "routine": {"type": "string"}
+    }),
+    "analysis": {"type": "string"},
+    "confidence": CONFIDENCE_PROPERTY
+})
 
-    def analyze_image(self, image_bytes: bytes) -> Optional[Dict]:
-        try:
-            base64_image = self._encode_image(image_bytes)
-            
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Tu es un expert en analyse faciale et stylisme capillaire pour hommes de la marque L'Oréal Paris. Tu dois fournir une analyse professionnelle corporative de barbes et recommander des solutions précises et techniques. Ta réponse doit TOUJOURS être en JSON valide avec le format demandé."
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": """Analyse cette photo avec précision technique et professionnelle:
+ANALYSIS_PROMPT = """Analyse cette photo avec précision technique et professionnelle:
 
                                 1. Analyse faciale et pilosité:
                                 - Forme du visage (ovale, carré, rond, rectangulaire, triangulaire)
@@ -141,42 +154,856 @@ class BeardAnalyzer:
                                     "products": ["PRODUIT L'ORÉAL 1", "PRODUIT L'ORÉAL 2", "PRODUIT L'ORÉAL 3"],
                                     "routine": "ROUTINE D'ENTRETIEN PROFESSIONNELLE DÉTAILLÉE"
                                   },
-                                  "analysis": "TON ANALYSE PROFESSIONNELLE ET CORPORATIVE DÉTAILLÉE EN FRANÇAIS"
+                                  "analysis": "TON ANALYSE PROFESSIONNELLE ET CORPORATIVE DÉTAILLÉE EN FRANÇAIS",
+                                  "confidence": NOMBRE ENTRE 0 ET 1
                                 }"""
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=800
-            )
-            
-            response_content = response.choices[0].message.content
-            return self._clean_response(response_content)
-            
-        except Exception as e:
-            st.error(f"Erreur d'analyse: {str(e)}")
-            return {
-                "recommended_style": "Barbe Courte",
-                "recommended_color": "Naturel",
-                "trim_length_mm": "5-10",
-                "has_gray": False,
-                "recommendations": {
-                    "trim": "Une légère taille est recommandée pour maintenir une apparence professionnelle",
-                    "products": ["L'Oréal Men Expert Barber Club Huile", "L'Oréal Men Expert Barber Club Gel"],
-                    "routine": "Lavage quotidien et hydratation recommandés"
-                },
-                "face_shape": "Ovale",
-                "problem_areas": [],
-                "analysis": "Désolé, une erreur s'est produite pendant l'analyse. Veuillez réessayer."
+
+SYSTEM_PROMPT = "Tu es un expert en analyse faciale et stylisme capillaire pour hommes de la marque L'Oréal Paris. Tu dois fournir une analyse professionnelle corporative de barbes et recommander des solutions précises et techniques. Ta réponse doit TOUJOURS être en JSON valide avec le format demandé."
+
+# Rapport en deux temps : verdict structuré d'abord (affiché aussitôt), puis
+# produits, routine et analyse rédigée en requêtes parallèles, sans image
+VERDICT_SCHEMA = strict_object({
+    "recommended_style": enum_property(BEARD_STYLES),
+    "recommended_color": enum_property(BEARD_COLORS),
+    "trim_length_mm": {"type": "string"},
+    "has_gray": {"type": "boolean"},
+    "face_shape": {"type": "string"},
+    "problem_areas": {"type": "array", "items": {"type": "string"}},
+    "trim": {"type": "string"},
+    "confidence": CONFIDENCE_PROPERTY
+})
+
+FOLLOW_UP_SECTIONS = {
+    "products": {
+        "schema": {"type": "array", "items": {"type": "string"}},
+        "max_tokens": 150,
+        "prompt": "Recommande 2 ou 3 produits L'Oréal Paris précis adaptés à ce profil, de préférence parmi : "
+                  + ", ".join(name for products in LOREAL_PRODUCTS.values() for name in products) + ".",
+    },
+    "routine": {
+        "schema": {"type": "string"},
+        "max_tokens": 250,
+        "prompt": "Décris la routine d'entretien quotidienne professionnelle et détaillée adaptée à ce profil.",
+    },
+    "analysis": {
+        "schema": {"type": "string"},
+        "max_tokens": 400,
+        "prompt": "Rédige ton analyse professionnelle et corporative détaillée en français : "
+                  "forme du visage, densité, points d'attention et justification du style recommandé.",
+    },
+}
+
+_follow_up_executor: Optional[ThreadPoolExecutor] = None
+_follow_up_lock = threading.Lock()
+
+def get_follow_up_executor() -> ThreadPoolExecutor:
+    # Partagé par le processus : trois sections par analyse en cours
+    global _follow_up_executor
+    with _follow_up_lock:
+        if _follow_up_executor is None:
+            _follow_up_executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("BEARD_FOLLOW_UP_WORKERS", "24")),
+                thread_name_prefix="beard-follow-up")
+        return _follow_up_executor
+
+class BeardAnalyzer:
+    MODEL = "gpt-4o-mini"
+    MAX_TOKENS = 800
+    # À incrémenter à chaque modification du prompt pour invalider le cache
+    PROMPT_VERSION = "beard-v3"
+    # Recadrage des pommettes au cou : la barbe et la mâchoire
+    IMAGE_OPTIONS = ImageOptions(max_edge=1024, detail="high", region="lower_face")
+    # Passe rapide de la cascade : détail "low" et réponse courte
+    FAST_IMAGE_OPTIONS = ImageOptions(max_edge=512, detail="low", region="lower_face")
+    FAST_MAX_TOKENS = 400
+    # Rapport en deux temps (BEARD_TWO_PHASE=off : une seule requête complète)
+    TWO_PHASE = os.getenv("BEARD_TWO_PHASE", "on").strip().lower() not in ("off", "0", "false", "no")
+    VERDICT_MAX_TOKENS = 300
+
+    def __init__(self, cache: Optional[ResultCache] = None,
+                 image_options: Optional[ImageOptions] = None,
+                 client: Optional[OpenAI] = None,
+                 single_flight: Optional[SingleFlight] = None,
+                 resilience: Optional[ResilientCaller] = None,
+                 near_index: Optional[NearDuplicateIndex] = None,
+                 cascade: Optional[bool] = None,
+                 two_phase: Optional[bool] = None):
+        try:
+            self.api_key = st.secrets["OPENAI_API_KEY"]
+        except Exception:
+            # Hors Streamlit (batch, service) : variables d'environnement / .env
+            load_dotenv()
+            self.api_key = os.getenv("OPENAI_API_KEY")
+        # Client partagé par tout le processus : pas de nouvelle connexion par clic
+        self.client = client or get_openai_client(self.api_key)
+        self.cache = cache if cache is not None else get_result_cache()
+        self.single_flight = single_flight if single_flight is not None else get_single_flight()
+        self.resilience = resilience if resilience is not None else get_resilient_caller()
+        self.near_index = near_index if near_index is not None else get_near_duplicate_index()
+        self.image_options = image_options or self.IMAGE_OPTIONS
+        self.cascade = cascade_enabled_by_env() if cascade is None else cascade
+        self.two_phase = self.TWO_PHASE if two_phase is None else two_phase
+        self.last_prepared: Optional[PreparedImage] = None
+        self.last_stream_timing: Optional[StreamTiming] = None
+        self.last_trace: Optional[AnalysisTrace] = None
+        # (niveau, message) pour la page : l'analyse tourne dans un worker, où st.* ne s'affiche pas
+        self.last_notice: Optional[Tuple[str, str]] = None
+
+    def tiers(self) -> List[Tier]:
+        tiers = [Tier("full", self.image_options, self.MAX_TOKENS)]
+        if self.cascade:
+            tiers.insert(0, Tier("fast", self.FAST_IMAGE_OPTIONS, self.FAST_MAX_TOKENS))
+        if self.two_phase:
+            # Premier temps : le verdict seul, court quelle que soit la passe
+            tiers = [replace(t, max_tokens=min(t.max_tokens, self.VERDICT_MAX_TOKENS)) for t in tiers]
+        return tiers
+
+    def _prepare_image(self, image_bytes: bytes, options: Optional[ImageOptions] = None) -> PreparedImage:
+        # Réduit la photo avant l'upload : le modèle la redimensionne de toute façon
+        prepared = prepare_image(image_bytes, options or self.image_options)
+        self.last_prepared = prepared
+        return prepared
+
+    def _encode_image(self, image_bytes: bytes) -> str:
+        return base64.b64encode(image_bytes).decode("utf-8")
+
+    def _fallback_result(self, analysis: str) -> BeardResult:
+        return {
+            "recommended_style": "Barbe Courte",
+            "recommended_color": "Naturel",
+            "trim_length_mm": "5-10",
+            "has_gray": False,
+            "recommendations": {
+                "trim": "Une légère taille est recommandée pour maintenir une apparence professionnelle",
+                "products": ["L'Oréal Men Expert Barber Club Huile", "L'Oréal Men Expert Barber Club Gel"],
+                "routine": "Lavage quotidien et hydratation recommandés"
+            },
+            "face_shape": "Ovale",
+            "problem_areas": [],
+            "analysis": analysis
+        }
+
+    def _degraded_result(self, image_bytes: bytes) -> BeardResult:
+        # Disjoncteur ouvert : recommandation générique sans attendre l'API
+        return self._fallback_result("Notre service d'analyse est momentanément surchargé. "
+                                     "Voici une recommandation générique, réessayez dans quelques instants.")
+
+    def _validate(self, data) -> BeardResult:
+        if not isinstance(data, dict):
+            raise SchemaValidationError("La réponse n'est pas un objet JSON")
+        repairs = []
+        repair_enum(data, "recommended_style", BEARD_STYLES, repairs)
+        repair_enum(data, "recommended_color", BEARD_COLORS, repairs)
+
+        # Champs libres invalides : valeur par défaut champ par champ
+        defaults = self._fallback_result("")
+        result = {}
+        for key in ("trim_length_mm", "face_shape", "analysis"):
+            value = data.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = str(value)
+            if not isinstance(value, str):
+                repairs.append(f"{key}: {value!r} -> défaut")
+                value = defaults[key]
+            result[key] = value
+        has_gray = coerce_bool(data.get("has_gray"))
+        if has_gray is None:
+            repairs.append(f"has_gray: {data.get('has_gray')!r} -> défaut")
+            has_gray = defaults["has_gray"]
+        problem_areas = data.get("problem_areas")
+        if not isinstance(problem_areas, list):
+            repairs.append("problem_areas -> défaut")
+            problem_areas = defaults["problem_areas"]
+
+        recommendations = data.get("recommendations")
+        if not isinstance(recommendations, dict):
+            repairs.append("recommendations -> défaut")
+            recommendations = defaults["recommendations"]
+        products = recommendations.get("products")
+        if not isinstance(products, list):
+            products = defaults["recommendations"]["products"]
+
+        if repairs:
+            logger.warning("Réponse réparée localement: %s", "; ".join(repairs))
+        return {
+            "recommended_style": data["recommended_style"],
+            "recommended_color": data["recommended_color"],
+            "trim_length_mm": result["trim_length_mm"],
+            "has_gray": has_gray,
+            "face_shape": result["face_shape"],
+            "problem_areas": [str(p) for p in problem_areas],
+            "recommendations": {
+                "trim": str(recommendations.get("trim") or defaults["recommendations"]["trim"]),
+                "products": [str(p) for p in products],
+                "routine": str(recommendations.get("routine") or defaults["recommendations"]["routine"])
+            },
+            "analysis": result["analysis"]
+        }
+
+    def _validate_verdict(self, data) -> Dict:
+        # Mêmes contrôles que le rapport complet ; les sections différées restent absentes
+        if not isinstance(data, dict):
+            raise SchemaValidationError("La réponse n'est pas un objet JSON")
+        report = self._validate({**data, "recommendations": {"trim": data.get("trim")}, "analysis": ""})
+        report["recommendations"] = {"trim": report["recommendations"]["trim"]}
+        del report["analysis"]
+        return report
+
+    def _load_response(self, response: str):
+        # Supprimer les balises code et json (réponses antérieures au schéma strict)
+        return json.loads(re.sub(r'```json\s*|\s*```', '', response))
+
+    def _parse_response(self, response: str) -> BeardResult:
+        return self._validate(self._load_response(response))
+
+    def _parse_tier(self, response: str, finish_reason: Optional[str],
+                    validate: Callable[[Dict], Dict]) -> Tuple[Optional[Dict], Optional[str]]:
+        # (résultat validé ou None, raison d'escalader ou None)
+        try:
+            data = self._load_response(response)
+            confidence = data.get("confidence") if isinstance(data, dict) else None
+            result = validate(data)
+        except ValueError:
+            return None, escalation_reason(None, finish_reason)
+        return result, escalation_reason({"confidence": confidence}, finish_reason)
+
+    def _clean_response(self, response: str) -> BeardResult:
+        try:
+            return self._parse_response(response)
+        except ValueError:
+            return self._fallback_result("Désolé, une erreur s'est produite pendant l'analyse.")
+
+    def _prompt_version(self) -> str:
+        # Toutes les passes de la cascade entrent dans la clé : un résultat rapide
+        # n'est pas servi à une configuration sans cascade
+        parts = [self.PROMPT_VERSION] + (["two-phase"] if self.two_phase else [])
+        return "|".join(parts + [t.signature() for t in self.tiers()])
+
+    def cache_key(self, image_bytes: bytes) -> str:
+        return make_cache_key(image_bytes, "beard", self.MODEL,
+                              self._prompt_version(), self.MAX_TOKENS)
+
+    def _single_pass_version(self) -> str:
+        # Une seule requête aux options d'image de l'analyseur, sans cascade ni pipeline
+        # en deux temps (sessions multi-photos, batch_analyze, bulk_analyze) : ces
+        # réglages n'entrent pas dans la clé
+        return f"{self.PROMPT_VERSION}|{self.image_options.signature()}"
+
+    def batch_cache_key(self, image_bytes: bytes) -> str:
+        return make_cache_key(image_bytes, "beard-batch", self.MODEL,
+                              self._single_pass_version(), self.MAX_TOKENS)
+
+    def batch_namespace(self) -> str:
+        return cache_namespace("beard-batch", self.MODEL, self._single_pass_version(), self.MAX_TOKENS)
+
+    def result_namespace(self) -> str:
+        # Partition de l'index des quasi-doublons : mêmes paramètres que la clé de cache
+        return cache_namespace("beard", self.MODEL, self._prompt_version(), self.MAX_TOKENS)
+
+    def build_request(self, prepared: PreparedImage, max_tokens: Optional[int] = None,
+                      brief: bool = False) -> Dict:
+        # Paramètres chat.completions, réutilisés par le mode batch
+        return {
+            "model": self.MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": ANALYSIS_PROMPT + (BRIEF_INSTRUCTION if brief else "")
+                        },
+                        self._image_part(prepared)
+                    ]
+                }
+            ],
+            "max_tokens": max_tokens or self.MAX_TOKENS,
+            "response_format": json_schema_format("beard_analysis", BEARD_SCHEMA)
+        }
+
+    def _image_part(self, prepared: PreparedImage) -> Dict:
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{prepared.mime_type};base64,{self._encode_image(prepared.data)}",
+                "detail": prepared.detail
             }
+        }
+
+    def build_session_request(self, prepared: List[PreparedImage], mode: str) -> Dict:
+        # Face et profil dans un seul message : prompt système et consignes payés une fois
+        return {
+            "model": self.MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": session_content(
+                    ANALYSIS_PROMPT, [self._image_part(p) for p in prepared], mode)}
+            ],
+            "max_tokens": session_max_tokens(self.MAX_TOKENS, len(prepared), mode),
+            "response_format": json_schema_format(
+                f"beard_session_{mode}", session_schema(BEARD_SCHEMA, len(prepared), mode))
+        }
+
+    def build_verdict_request(self, prepared: PreparedImage, max_tokens: Optional[int] = None,
+                              brief: bool = False) -> Dict:
+        # Premier temps : uniquement ce qu'affichent STYLE RECOMMANDÉ et CARACTÉRISTIQUES
+        return {
+            "model": self.MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": f"""Analyse cette photo avec précision technique et donne ton verdict:
+                                - Forme du visage (ovale, carré, rond, rectangulaire, triangulaire)
+                                - Présence de poils blancs/gris
+                                - Problèmes spécifiques (zones clairsemées, croissance inégale, irritations)
+                                - Style de barbe le plus adapté parmi: {", ".join(BEARD_STYLES)}
+                                - Couleur idéale parmi: {", ".join(BEARD_COLORS)}
+                                - Longueur optimale en mm et conseil technique de taille en une phrase
+
+                                Tu DOIS répondre EXACTEMENT dans ce format JSON:
+                                {{
+                                  "recommended_style": "UN STYLE PRÉCIS",
+                                  "recommended_color": "UNE COULEUR PRÉCISE",
+                                  "trim_length_mm": "LONGUEUR EN MM",
+                                  "has_gray": boolean,
+                                  "face_shape": "FORME DU VISAGE",
+                                  "problem_areas": ["PROBLÈME 1", "PROBLÈME 2"],
+                                  "trim": "CONSEIL TECHNIQUE DE TAILLE PRÉCIS",
+                                  "confidence": NOMBRE ENTRE 0 ET 1
+                                }}""" + (BRIEF_INSTRUCTION if brief else "")
+                        },
+                        self._image_part(prepared)
+                    ]
+                }
+            ],
+            "max_tokens": max_tokens or self.VERDICT_MAX_TOKENS,
+            "response_format": json_schema_format("beard_verdict", VERDICT_SCHEMA)
+        }
+
+    def build_follow_up_request(self, section: str, verdict: Dict) -> Dict:
+        # Second temps, sans image : le verdict suffit comme contexte
+        spec = FOLLOW_UP_SECTIONS[section]
+        profile = {key: verdict[key] for key in ("recommended_style", "recommended_color", "trim_length_mm",
+                                                 "has_gray", "face_shape", "problem_areas")}
+        profile["trim"] = verdict["recommendations"]["trim"]
+        return {
+            "model": self.MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": f"Profil établi pour ce client: {json.dumps(profile, ensure_ascii=False)}\n\n"
+                               f"{spec['prompt']}\n\nRéponds en JSON: {{\"{section}\": ...}}"
+                }
+            ],
+            "max_tokens": spec["max_tokens"],
+            "response_format": json_schema_format(f"beard_section_{section}", strict_object({section: spec["schema"]}))
+        }
+
+    def _request_section(self, section: str, verdict: Dict):
+        # Exécuté dans le pool des sections : (valeur, usage)
+        request = self.build_follow_up_request(section, verdict)
+        response = self.resilience.call(
+            lambda timeout: self.client.with_options(timeout=timeout).chat.completions.create(**request),
+            hedge=True, tokens=estimate_request_tokens(request),
+            request_class=latency_class(f"beard:{section}", request))
+        data = self._load_response(response.choices[0].message.content)
+        return (data.get(section) if isinstance(data, dict) else None), response.usage
+
+    def _follow_ups(self, report: Dict, on_update: Optional[Callable[[Dict, Set[str]], None]],
+                    trace: AnalysisTrace) -> bool:
+        # Sections différées en parallèle, intégrées au rapport dans l'ordre d'arrivée ;
+        # retourne False si l'une d'elles a dû prendre sa valeur par défaut
+        defaults = self._fallback_result("")
+        executor = get_follow_up_executor()
+        futures = {executor.submit(self._request_section, section, report): section
+                   for section in FOLLOW_UP_SECTIONS}
+        complete = True
+        for future in as_completed(futures):
+            section = futures[future]
+            try:
+                value, usage = future.result()
+            except Exception as e:
+                logger.warning("Section %s non générée: %s", section, e)
+                value, usage = None, None
+            trace.add_usage(usage)
+            if section == "products":
+                valid = isinstance(value, list)
+                report["recommendations"]["products"] = [str(p) for p in value] if valid \
+                    else defaults["recommendations"]["products"]
+            elif section == "routine":
+                valid = isinstance(value, str) and bool(value.strip())
+                report["recommendations"]["routine"] = value if valid else defaults["recommendations"]["routine"]
+            else:
+                valid = isinstance(value, str) and bool(value.strip())
+                report["analysis"] = value if valid else ""
+            complete = complete and valid
+            if on_update is not None:
+                on_update(report, set(report))
+        return complete
+
+    def _request_model(self, image_bytes: bytes, cache_key: str, use_cache: bool,
+                       on_update: Optional[Callable[[Dict, Set[str]], None]],
+                       trace: AnalysisTrace, fingerprint: Optional[int] = None) -> BeardResult:
+        # Exécuté une seule fois par clé en cours : les exceptions remontent à tous les appelants
+        if use_cache:
+            # L'appel précédent pour cette clé a pu se terminer entre-temps
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                trace.outcome = "cache_hit"
+                return cached
+
+        # Cascade : passe rapide, puis passe complète si la réponse est invalide,
+        # tronquée ou peu sûre ; la dernière passe est acceptée telle quelle.
+        # En deux temps, la cascade ne porte que sur le verdict
+        build = self.build_verdict_request if self.two_phase else self.build_request
+        validate = self._validate_verdict if self.two_phase else self._validate
+        tiers = self.tiers()
+        for i, tier in enumerate(tiers):
+            last = i == len(tiers) - 1
+            with trace.tier(tier.name) as record:
+                with trace.stage("prepare"):
+                    prepared = self._prepare_image(image_bytes, tier.image_options)
+                with trace.stage("encode"):
+                    request = build(prepared, tier.max_tokens, brief=not last)
+                trace.payload_bytes += len(json.dumps(request))
+                with trace.stage("model"):
+                    response_content, finish_reason = self._call_model(request, on_update, trace)
+                trace.outcome = "model"
+                with trace.stage("parse"):
+                    result, reason = self._parse_tier(response_content, finish_reason, validate)
+                if last or reason is None:
+                    break
+                record.update(decision="escalated", reason=reason)
+                logger.info("Passe %s insuffisante (%s) : escalade", tier.name, reason)
+
+        if result is None:
+            # Réponse inexploitable : ni cache ni résultat définitif, un nouveau clic relance
+            trace.outcome = "error"
+            return self._clean_response(response_content)
+
+        complete = True
+        if self.two_phase:
+            if on_update is not None:
+                # Verdict validé : STYLE RECOMMANDÉ et CARACTÉRISTIQUES s'affichent déjà
+                on_update(result, set(result))
+            with trace.stage("follow_up"):
+                complete = self._follow_ups(result, on_update, trace)
+
+        # Rapport incomplet : pas de cache, un nouveau clic retentera les sections manquantes
+        if not complete:
+            trace.outcome = "incomplete"
+        elif use_cache:
+            self.cache.set(cache_key, result)
+            if fingerprint is not None:
+                self.near_index.add(self.result_namespace(), fingerprint, cache_key)
+        return result
+
+    def _call_model(self, request: Dict, on_update: Optional[Callable[[Dict, Set[str]], None]],
+                    trace: AnalysisTrace) -> Tuple[str, Optional[str]]:
+        # Échéance par tentative, relances sur 429/5xx, disjoncteur partagé
+        if on_update is None:
+            response = self.resilience.call(
+                lambda timeout: self.client.with_options(timeout=timeout).chat.completions.create(**request),
+                hedge=True, tokens=estimate_request_tokens(request),
+                request_class=latency_class("beard", request))
+            trace.add_usage(response.usage)
+            return response.choices[0].message.content, response.choices[0].finish_reason
+        # Pas de hedging en streaming : deux flux se disputeraient l'affichage
+        response_content, _, timing = self.resilience.call(
+            lambda timeout: stream_completion(self.client.with_options(timeout=timeout), request, on_update),
+            tokens=estimate_request_tokens(request))
+        self.last_stream_timing = timing
+        trace.add_usage(timing.usage)
+        if timing.first_token_s is not None:
+            # Premier token de la première passe : celui que voit l'utilisateur
+            trace.stages.setdefault("first_token", timing.first_token_s)
+        if timing.first_content_s is not None:
+            # Premier champ lisible à l'écran : la latence perçue, exportée avec les étapes
+            trace.stages.setdefault("first_content", timing.first_content_s)
+        return response_content, timing.finish_reason
+
+    def _analyze(self, image_bytes: bytes, use_cache: bool,
+                 on_update: Optional[Callable[[Dict, Set[str]], None]] = None) -> BeardResult:
+        with start_trace("beard", self.MODEL) as trace:
+            self.last_trace = trace
+            self.last_notice = None
+            cache_key = self.cache_key(image_bytes)
+            if use_cache:
+                with trace.stage("cache"):
+                    cached = self.cache.get(cache_key)
+                if cached is not None:
+                    trace.outcome = "cache_hit"
+                    return cached
+
+            fingerprint = None
+            if use_cache:
+                # Même photo recadrée ou recompressée : résultat d'une image quasi identique
+                with trace.stage("phash"):
+                    near, fingerprint = self.near_index.find(self.cache, self.result_namespace(), image_bytes)
+                if near is not None:
+                    trace.outcome = "near_hit"
+                    return near
+
+            try:
+                # Même photo déjà en cours d'analyse dans une autre session : on partage l'appel ;
+                # les sessions en attente reçoivent le résultat complet d'un coup
+                result, shared = self.single_flight.do(
+                    cache_key, lambda: self._request_model(image_bytes, cache_key, use_cache, on_update,
+                                                  trace, fingerprint))
+                if shared:
+                    trace.outcome = "coalesced"
+                return result
+
+            except (CircuitOpenError, RateLimitExceeded):
+                # API indisponible ou débit saturé : réponse locale immédiate plutôt qu'une erreur
+                trace.outcome = "degraded"
+                self.last_notice = ("warning", DEGRADED_NOTICE)
+                return self._degraded_result(image_bytes)
+            except Exception as e:
+                trace.outcome = "error"
+                logger.warning("Analyse en échec: %s", e)
+                self.last_notice = ("error", f"Erreur d'analyse: {str(e)}")
+                return self._fallback_result("Désolé, une erreur s'est produite pendant l'analyse. Veuillez réessayer.")
+
+    def analyze_image(self, image_bytes: bytes, use_cache: bool = True) -> Optional[BeardResult]:
+        return self._analyze(image_bytes, use_cache)
+
+    def analyze_image_stream(self, image_bytes: bytes,
+                             on_update: Callable[[Dict, Set[str]], None],
+                             use_cache: bool = True) -> Optional[BeardResult]:
+        # Variante streaming : on_update(résultat partiel, clés terminées) à chaque
+        # fragment ; l'appelant affiche ensuite le résultat complet retourné
+        return self._analyze(image_bytes, use_cache, on_update)
+
+    def _request_session(self, images: List[bytes], mode: str, cache_key: str,
+                         use_cache: bool, trace: AnalysisTrace) -> Dict:
+        if use_cache:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                trace.outcome = "cache_hit"
+                return cached
+        # Rapport complet en une requête : ni cascade ni deux temps pour une session
+        options = self.image_options
+        with trace.tier("session") as record:
+            record["photos"] = len(images)
+            with trace.stage("prepare"):
+                prepared = [self._prepare_image(image, options) for image in images]
+            with trace.stage("encode"):
+                request = self.build_session_request(prepared, mode)
+            trace.payload_bytes += len(json.dumps(request))
+            with trace.stage("model"):
+                response_content, finish_reason = self._call_model(request, None, trace)
+            trace.outcome = "model"
+            with trace.stage("parse"):
+                try:
+                    results, invalid = split_session(self._load_response(response_content),
+                                                     len(images), mode, self._validate)
+                except ValueError:
+                    results, invalid = {}, ["session"]
+        result = session_result(results, len(images), mode, lambda i: self._fallback_result(
+            "Désolé, une erreur s'est produite pendant l'analyse de cette photo."))
+        # Session incomplète ou tronquée : rien en cache, un nouvel essai repart du modèle
+        if invalid or finish_reason == "length":
+            trace.outcome = "incomplete"
+        elif use_cache:
+            self.cache.set(cache_key, result)
+        return result
+
+    def analyze_session(self, images: List[bytes], mode: str = "per_photo",
+                        use_cache: bool = True) -> Dict:
+        # Plusieurs photos en une requête : {"photo_1": rapport, ...} en mode
+        # per_photo, un seul rapport en mode consensus
+        check_session(images, mode)
+        if len(images) == 1:
+            # Une seule photo : l'analyse classique, avec sa cascade et son cache
+            result = self.analyze_image(images[0], use_cache)
+            return result if mode == "consensus" else {photo_key(0): result}
+        with start_trace("beard", self.MODEL) as trace:
+            self.last_trace = trace
+            self.last_notice = None
+            cache_key = session_cache_key(images, "beard", self.MODEL, self._single_pass_version(),
+                                          self.MAX_TOKENS, mode)
+            if use_cache:
+                with trace.stage("cache"):
+                    cached = self.cache.get(cache_key)
+                if cached is not None:
+                    trace.outcome = "cache_hit"
+                    return cached
+            try:
+                result, shared = self.single_flight.do(
+                    cache_key, lambda: self._request_session(images, mode, cache_key, use_cache, trace))
+                if shared:
+                    trace.outcome = "coalesced"
+                return result
+            except (CircuitOpenError, RateLimitExceeded):
+                trace.outcome = "degraded"
+                self.last_notice = ("warning", DEGRADED_NOTICE)
+                return session_result({}, len(images), mode,
+                                      lambda i: self._degraded_result(images[i or 0]))
+            except Exception as e:
+                trace.outcome = "error"
+                logger.warning("Analyse en échec: %s", e)
+                self.last_notice = ("error", f"Erreur d'analyse: {str(e)}")
+                return session_result({}, len(images), mode, lambda i: self._fallback_result(
+                    "Désolé, une erreur s'est produite pendant l'analyse. Veuillez réessayer."))
+
+# Affiché à la place d'un champ pas encore reçu pendant le streaming
+PENDING = "…"
+
+def render_style_grid(recommended_style: Optional[str]) -> None:
+    # Grille des styles améliorée
+    col1, col2 = st.columns(2)
+    cols = [col1, col2]
+    for idx, (name, desc) in enumerate(BEARD_STYLES.items()):
+        with cols[idx % 2]:
+            st.markdown(f"""
+                <div class="style-box {'selected-style-box' if name == recommended_style else ''}">
+                    <div class="style-name">{name}</div>
+                    <div class="style-desc">{desc}</div>
+                    {f'<div class="selected-badge">RECOMMANDÉ</div>' if name == recommended_style else ''}
+                </div>
+            """, unsafe_allow_html=True)
+
+def characteristics_html(recommended_style: str, face_shape: str, has_gray, trim_length: str) -> str:
+    if has_gray == PENDING:
+        gray_label = PENDING
+    else:
+        gray_label = "Oui" if has_gray else "Non"
+    return f"""
+        <div class="final-choice">
+            <div class="recommendation-item">
+                <div class="recommendation-label">Style optimal:</div>
+                <div class="recommendation-value">{recommended_style}</div>
+            </div>
+            <div class="recommendation-item">
+                <div class="recommendation-label">Forme du visage:</div>
+                <div class="recommendation-value">{face_shape}</div>
+            </div>
+            <div class="recommendation-item">
+                <div class="recommendation-label">Présence de gris:</div>
+                <div class="recommendation-value">{gray_label}</div>
+            </div>
+            <div class="recommendation-item">
+                <div class="recommendation-label">Longueur optimale:</div>
+                <div class="recommendation-value">{trim_length} mm</div>
+            </div>
+        </div>
+    """
+
+def problems_html(problem_areas: List[str]) -> str:
+    # Problèmes spécifiques s'il y en a
+    if not problem_areas:
+        return ""
+    problem_html = ""
+    for problem in problem_areas:
+        problem_html += f'<div class="product-item">{problem}</div>'
+    return f"""
+        <h2 class="analysis-title">POINTS D'ATTENTION</h2>
+        <div class="final-choice">
+            {problem_html}
+        </div>
+    """
+
+def technique_html(trim_advice: str, recommended_color: str) -> str:
+    # Affichage des techniques de coupe
+    return f"""
+        <div class="final-choice">
+            <div class="recommendation-item">
+                <div class="recommendation-value">{trim_advice}</div>
+            </div>
+            <div class="recommendation-item">
+                <div class="recommendation-label">Couleur idéale:</div>
+                <div class="recommendation-value">{recommended_color}</div>
+            </div>
+        </div>
+    """
+
+def products_html(products: List[str]) -> str:
+    # Affichage des produits L'Oréal recommandés
+    if not products:
+        return """
+            <div class="final-choice">
+                <div class="recommendation-item">
+                    <div class="recommendation-value">Aucun produit spécifique recommandé.</div>
+                </div>
+            </div>
+        """
+    products_html = ""
+    for product in products:
+        products_html += f'<div class="product-item">{product}</div>'
+    return f"""
+        <div class="final-choice">
+            {products_html}
+        </div>
+    """
+
+def routine_html(routine: str) -> str:
+    # Routine d'entretien
+    return f"""
+        <div class="final-choice">
+            <div class="routine-text">{routine}</div>
+        </div>
+    """
+
+def analysis_html(analysis: str) -> str:
+    # Analyse rédigée, arrivée après le verdict en mode deux temps
+    if not analysis:
+        return ""
+    return f'<div class="analysis-text">{analysis}</div>'
+
+def preview_html(image_bytes: bytes) -> str:
+    # Vignette ré-encodée : quelques dizaines de Ko en base64 au lieu de la photo entière
+    preview = prepare_image(image_bytes, PREVIEW_OPTIONS)
+    return f'<img src="data:{preview.mime_type};base64,{base64.b64encode(preview.data).decode()}" class="uploaded-image" style="width:100%">'
+
+def render_result(result: Dict, completed: Set[str], style_slot, slots: Dict,
+                  final: bool = False) -> Dict[str, str]:
+    # Dessine un résultat partiel ou final ; retourne le HTML écrit par emplacement
+    fragments = {}
+
+    def update(name: str, html: str) -> None:
+        slots[name].markdown(html, unsafe_allow_html=True)
+        fragments[name] = html
+
+    def field(key, default):
+        # Pendant le streaming, un champ pas encore reçu reste en attente
+        if key in result and (final or key in completed):
+            return result[key]
+        return default if final else PENDING
+
+    recommended_style = field("recommended_style", None)
+    with style_slot.container():
+        render_style_grid(recommended_style if recommended_style != PENDING else None)
+
+    # Extraire toutes les données du résultat
+    face_shape = field("face_shape", "Non détecté")
+    has_gray = field("has_gray", False)
+    trim_length = field("trim_length_mm", "5-10")
+    problem_areas = field("problem_areas", [])
+    recommended_color = field("recommended_color", "Non disponible")
+    
+    # Les recommandations imbriquées s'affichent dès qu'elles arrivent
+    recommendations = result.get("recommendations", {})
+    trim_advice = recommendations.get("trim", "Non disponible" if final else PENDING)
+    products = recommendations.get("products", [])
+    routine = recommendations.get("routine", "Non disponible" if final else PENDING)
+    analysis = field("analysis", "")
+
+    update("characteristics",
+           characteristics_html(recommended_style or "Non détecté", face_shape, has_gray, trim_length))
+    if problem_areas != PENDING:
+        update("problems", problems_html(problem_areas))
+    update("technique", technique_html(trim_advice, recommended_color))
+    if products or final:
+        update("products", products_html(products))
+    update("routine", routine_html(routine))
+    update("analysis", analysis_html(analysis))
+    return fragments
+
+def analysis_job(job: Job, image_bytes: bytes) -> Optional[BeardResult]:
+    # Exécuté dans un worker du pool : pas d'affichage ici, la page relit job.progress()
+    analyzer = BeardAnalyzer()
+    if streaming_enabled():
+        result = analyzer.analyze_image_stream(image_bytes, job.update)
+    else:
+        result = analyzer.analyze_image(image_bytes)
+    job.report(analyzer.last_trace.outcome if analyzer.last_trace else "model", analyzer.last_notice)
+    return result
+
+def session_job(job: Job, images: List[bytes]) -> Optional[BeardResult]:
+    # Face et profil : une seule requête, un rapport qui croise les angles
+    analyzer = BeardAnalyzer()
+    result = analyzer.analyze_session(images, mode="consensus")
+    job.report(analyzer.last_trace.outcome if analyzer.last_trace else "model", analyzer.last_notice)
+    return result
+
+def results_panel(memo: SessionMemo) -> None:
+    st.markdown('<h1 class="main-title">VOTRE PROFIL</h1>', 
+              unsafe_allow_html=True)
+    
+    # Affichage des styles de barbe
+    st.markdown('<h2 class="analysis-title">STYLE RECOMMANDÉ</h2>', 
+              unsafe_allow_html=True)
+    style_slot = st.empty()
+    
+    st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
+    
+    # Détails de l'analyse
+    st.markdown('<h2 class="analysis-title">ANALYSE PERSONNALISÉE</h2>', 
+              unsafe_allow_html=True)
+    status_slot = st.empty()
+    
+    # Emplacements remplis au fur et à mesure de la réponse
+    slots = {}
+    slots["analysis"] = st.empty()
+    st.markdown('<h2 class="analysis-title">1. CARACTÉRISTIQUES</h2>', unsafe_allow_html=True)
+    slots["characteristics"] = st.empty()
+    slots["problems"] = st.empty()
+    st.markdown('<h2 class="analysis-title">2. TECHNIQUE DE COUPE</h2>', unsafe_allow_html=True)
+    slots["technique"] = st.empty()
+    st.markdown('<h2 class="analysis-title">3. PRODUITS RECOMMANDÉS</h2>', unsafe_allow_html=True)
+    slots["products"] = st.empty()
+    st.markdown('<h2 class="analysis-title">4. ROUTINE D\'ENTRETIEN</h2>', unsafe_allow_html=True)
+    slots["routine"] = st.empty()
+
+    if memo.has("result"):
+        # Rerun : simple relecture de la session, aucun appel au modèle
+        with style_slot.container():
+            render_style_grid(memo.get("result")["recommended_style"])
+        for name, html in memo.get("fragments").items():
+            slots[name].markdown(html, unsafe_allow_html=True)
+        notice = memo.get("notice")
+        if notice is not None:
+            # Message du worker, affiché ici dans le thread du script
+            level, message = notice
+            getattr(status_slot, level)(message)
+        elif memo.get("outcome") in RETRY_OUTCOMES:
+            status_slot.warning("Analyse incomplète : cliquez à nouveau pour réessayer.")
+        return
+
+    pool = get_analysis_pool()
+    job = pool.get(memo.get("job_id"))
+    if job is None:
+        # Processus redémarré ou job expiré
+        memo.discard("job_id")
+        status_slot.warning("L'analyse a été interrompue, cliquez à nouveau pour la relancer.")
+        return
+
+    if not job.done():
+        # Résultat partiel publié par le worker pendant le streaming
+        render_result(*job.progress(), style_slot, slots)
+        if job.state == "queued":
+            status_slot.info(f"En file d'attente (position {pool.queue_position(job) + 1})…")
+        else:
+            status_slot.info("Analyse en cours…")
+        return
+
+    pool.forget(job.id)
+    memo.discard("job_id")
+    try:
+        result = job.result()
+    except Exception as e:
+        status_slot.error(f"Erreur d'analyse: {str(e)}")
+        return
+    with timed("beard", "render"):
+        fragments = render_result(result, set(result), style_slot, slots, final=True)
+    memo.set("result", result)
+    memo.set("fragments", fragments)
+    memo.set("outcome", job.outcome)
+    memo.set("notice", job.notice)
+    # Rerun complet : arrête l'interrogation périodique du job
+    st.rerun()
 
 def main():
+    start_warm_up()
+    start_exporter()
+
     st.set_page_config(
         page_title="BarbExpert - L'Oréal Brandstorm",
         page_icon="✂️",
@@ -464,145 +1291,55 @@ def main():
 
     with left_col:
         
-        uploaded_file = st.file_uploader(
+        uploaded_files = st.file_uploader(
             "TÉLÉCHARGEZ VOTRE PHOTO",
             type=['png', 'jpg', 'jpeg'],
-            help="Limite 200MB par fichier • PNG, JPG, JPEG"
+            accept_multiple_files=True,
+            help=f"Limite {MAX_UPLOAD_BYTES / 2**20:.0f} Mo par fichier • PNG, JPG, JPEG • face et profil : jusqu'à {MAX_SESSION_PHOTOS} photos analysées ensemble"
         )
 
-        if uploaded_file:
-            st.markdown(f'<img src="data:image/jpeg;base64,{base64.b64encode(uploaded_file.getvalue()).decode()}" class="uploaded-image" style="width:100%">', unsafe_allow_html=True)
+        if not uploaded_files:
+            SessionMemo.clear("beard")
+        else:
+            if len(uploaded_files) > MAX_SESSION_PHOTOS:
+                st.warning(f"Seules les {MAX_SESSION_PHOTOS} premières photos sont analysées.")
+                uploaded_files = uploaded_files[:MAX_SESSION_PHOTOS]
+            try:
+                # Taille vérifiée avant lecture, pixels dès l'en-tête ; octets partagés avec l'envoi
+                images = [upload_bytes(f) for f in uploaded_files]
+            except UploadTooLargeError as e:
+                st.error(str(e))
+                st.stop()
+            # Résultat, aperçu et HTML rendus conservés pour ces photos : un rerun ne relance rien
+            memo = SessionMemo("beard", uploaded_files)
+            with memo.measure("preview"):
+                preview = memo.cached("preview_html", lambda: "".join(preview_html(i) for i in images))
+            st.markdown(preview, unsafe_allow_html=True)
+            # Plusieurs photos : une requête commune plutôt qu'une analyse par photo
+            job_fn, job_input = (analysis_job, images[0]) if len(images) == 1 else (session_job, images)
+            # Mode spéculatif : l'analyse démarre avant même le clic
+            start_speculation(memo, job_fn, job_input)
             
-            if st.button("ANALYSER MA BARBE"):
+            clicked = st.button("ANALYSER MA BARBE")
+            if clicked:
+                claim_speculation(memo)
+            if clicked and not memo.has("job_id") and (
+                    not memo.has("result") or memo.get("outcome") in RETRY_OUTCOMES):
+                # L'analyse part dans le pool partagé : le thread du script est libéré
+                try:
+                    job = get_analysis_pool().submit(job_fn, job_input, session=memo.session)
+                    memo.discard("result", "fragments", "outcome", "notice")
+                    memo.set("job_id", job.id)
+                except PoolFullError:
+                    st.warning("Beaucoup de demandes en ce moment : réessayez dans quelques secondes.")
+
+            # Un job spéculatif non réclamé tourne sans être affiché
+            if memo.has("result") or (memo.has("job_id") and not memo.get("speculative")):
                 with right_col:
-                    st.markdown('<h1 class="main-title">VOTRE PROFIL</h1>', 
-                              unsafe_allow_html=True)
-                    
-                    analyzer = BeardAnalyzer()
-                    result = analyzer.analyze_image(uploaded_file.getvalue())
-                    
-                    if result:
-                        recommended_style = result["recommended_style"]
-                        recommended_color = result["recommended_color"]
-                        
-                        # Affichage des styles de barbe
-                        st.markdown('<h2 class="analysis-title">STYLE RECOMMANDÉ</h2>', 
-                                  unsafe_allow_html=True)
-                        
-                        # Grille des styles améliorée
-                        col1, col2 = st.columns(2)
-                        cols = [col1, col2]
-                        for idx, (name, desc) in enumerate(BEARD_STYLES.items()):
-                            with cols[idx % 2]:
-                                st.markdown(f"""
-                                    <div class="style-box {'selected-style-box' if name == recommended_style else ''}">
-                                        <div class="style-name">{name}</div>
-                                        <div class="style-desc">{desc}</div>
-                                        {f'<div class="selected-badge">RECOMMANDÉ</div>' if name == recommended_style else ''}
-                                    </div>
-                                """, unsafe_allow_html=True)
-                        
-                        st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
-                        
-                        # Détails de l'analyse
-                        st.markdown('<h2 class="analysis-title">ANALYSE PERSONNALISÉE</h2>', 
-                                  unsafe_allow_html=True)
-                        
-                        # Extraire toutes les données du résultat
-                        face_shape = result.get("face_shape", "Non détecté")
-                        has_gray = result.get("has_gray", False)
-                        trim_length = result.get("trim_length_mm", "5-10")
-                        problem_areas = result.get("problem_areas", [])
-                        
-                        # Extraire les recommandations
-                        recommendations = result.get("recommendations", {})
-                        trim_advice = recommendations.get("trim", "Non disponible")
-                        products = recommendations.get("products", [])
-                        routine = recommendations.get("routine", "Non disponible")
-                        
-                        # Affichage du profil et des recommandations
-                        st.markdown('<h2 class="analysis-title">1. CARACTÉRISTIQUES</h2>', unsafe_allow_html=True)
-                        
-                        st.markdown(f"""
-                            <div class="final-choice">
-                                <div class="recommendation-item">
-                                    <div class="recommendation-label">Style optimal:</div>
-                                    <div class="recommendation-value">{recommended_style}</div>
-                                </div>
-                                <div class="recommendation-item">
-                                    <div class="recommendation-label">Forme du visage:</div>
-                                    <div class="recommendation-value">{face_shape}</div>
-                                </div>
-                                <div class="recommendation-item">
-                                    <div class="recommendation-label">Présence de gris:</div>
-                                    <div class="recommendation-value">{"Oui" if has_gray else "Non"}</div>
-                                </div>
-                                <div class="recommendation-item">
-                                    <div class="recommendation-label">Longueur optimale:</div>
-                                    <div class="recommendation-value">{trim_length} mm</div>
-                                </div>
-                            </div>
-                        """, unsafe_allow_html=True)
-                        
-                        # Problèmes spécifiques s'il y en a
-                        if problem_areas:
-                            st.markdown('<h2 class="analysis-title">POINTS D\'ATTENTION</h2>', unsafe_allow_html=True)
-                            
-                            problem_html = ""
-                            for problem in problem_areas:
-                                problem_html += f'<div class="product-item">{problem}</div>'
-                            
-                            st.markdown(f"""
-                                <div class="final-choice">
-                                    {problem_html}
-                                </div>
-                            """, unsafe_allow_html=True)
-                        
-                        # Affichage des techniques de coupe
-                        st.markdown('<h2 class="analysis-title">2. TECHNIQUE DE COUPE</h2>', unsafe_allow_html=True)
-                        
-                        st.markdown(f"""
-                            <div class="final-choice">
-                                <div class="recommendation-item">
-                                    <div class="recommendation-value">{trim_advice}</div>
-                                </div>
-                                <div class="recommendation-item">
-                                    <div class="recommendation-label">Couleur idéale:</div>
-                                    <div class="recommendation-value">{recommended_color}</div>
-                                </div>
-                            </div>
-                        """, unsafe_allow_html=True)
-                        
-                        # Affichage des produits L'Oréal recommandés
-                        st.markdown('<h2 class="analysis-title">3. PRODUITS RECOMMANDÉS</h2>', unsafe_allow_html=True)
-                        
-                        if products:
-                            products_html = ""
-                            for product in products:
-                                products_html += f'<div class="product-item">{product}</div>'
-                            
-                            st.markdown(f"""
-                                <div class="final-choice">
-                                    {products_html}
-                                </div>
-                            """, unsafe_allow_html=True)
-                        else:
-                            st.markdown("""
-                                <div class="final-choice">
-                                    <div class="recommendation-item">
-                                        <div class="recommendation-value">Aucun produit spécifique recommandé.</div>
-                                    </div>
-                                </div>
-                            """, unsafe_allow_html=True)
-                        
-                        # Routine d'entretien
-                        st.markdown('<h2 class="analysis-title">4. ROUTINE D\'ENTRETIEN</h2>', unsafe_allow_html=True)
-                        
-                        st.markdown(f"""
-                            <div class="final-choice">
-                                <div class="routine-text">{routine}</div>
-                            </div>
-                        """, unsafe_allow_html=True)
+                    if memo.has("job_id"):
+                        poll_job(results_panel, memo)
+                    else:
+                        results_panel(memo)
 
 if __name__ == "__main__":
     main()
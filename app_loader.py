@@ -0,0 +1,34 @@
+"""Chargement des applications Streamlit comme modules importables.
+
+Les scripts ont des noms avec tirets (lipstick-analyser.py, app-beard.py) :
+on les charge par chemin pour réutiliser leurs analyseurs hors Streamlit.
+`main()` est protégé par `if __name__ == "__main__"`, rien ne s'affiche.
+"""
+import importlib.util
+import sys
+from pathlib import Path
+from types import ModuleType
+
+APP_DIR = Path(__file__).resolve().parent
+
+APPS = {
+    "lipstick": ("lipstick_analyser", "lipstick-analyser.py", "LipstickAnalyzer"),
+    "beard": ("app_beard", "app-beard.py", "BeardAnalyzer"),
+}
+
+
+def load_app(kind: str) -> ModuleType:
+    if kind not in APPS:
+        raise ValueError(f"Analyseur inconnu: {kind} (attendu: {', '.join(APPS)})")
+    module_name, filename, _ = APPS[kind]
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, APP_DIR / filename)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_analyzer_class(kind: str) -> type:
+    return getattr(load_app(kind), APPS[kind][2])
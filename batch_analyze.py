@@ -0,0 +1,226 @@
+"""Analyse par lots, hors Streamlit, d'un dossier ou d'un manifeste de photos.
+
+    python batch_analyze.py lipstick --input photos/ --output lipstick.jsonl \\
+        --concurrency 8 --rpm 300
+
+Chaque résultat est ajouté au fichier JSONL dès qu'il est prêt. Relancer la
+même commande reprend là où elle s'était arrêtée : les photos déjà présentes
+avec le statut "ok" dans le fichier de sortie sont ignorées.
+
+Les appels passent par le client partagé (pool de connexions, cassette) et
+par ResilientCaller : disjoncteur commun, relances des seules erreurs
+transitoires, budget de tokens du limiteur partagé. Un lot accepte d'attendre
+ce budget plus longtemps qu'un clic (BEAUTY_BATCH_RATE_MAX_WAIT) ; --rpm
+ajoute un plafond fixe, en dessous des limites du compte.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from app_loader import APPS, load_analyzer_class
+from image_prep import prepare_image
+from rate_limiter import RateLimiter, estimate_request_tokens, get_rate_limiter
+from resilience import ResilientCaller, get_resilient_caller
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp"}
+# Attente maximale du budget de débit pour une photo du lot, en secondes
+BATCH_RATE_MAX_WAIT = float(os.getenv("BEAUTY_BATCH_RATE_MAX_WAIT", "120"))
+
+
+def iter_inputs(input_dir: Optional[Path], manifest: Optional[Path]) -> List[Path]:
+    paths: List[Path] = []
+    if input_dir is not None:
+        paths.extend(sorted(p for p in input_dir.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS))
+    if manifest is not None:
+        # Une photo par ligne : chemin brut ou objet JSON {"path": ...}
+        for line in manifest.read_text(encoding="utf-8").splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            raw = json.loads(line)["path"] if line.startswith("{") else line
+            path = Path(raw)
+            paths.append(path if path.is_absolute() else manifest.parent / path)
+    return paths
+
+
+def load_checkpoint(output: Path) -> Set[str]:
+    done: Set[str] = set()
+    if not output.exists():
+        return done
+    with output.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Dernière ligne tronquée par un crash : elle sera refaite
+                continue
+            if record.get("status") == "ok":
+                done.add(record["path"])
+    return done
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # Rang le plus proche
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class RequestSpacer:
+    # Espace les appels pour ne pas dépasser `rpm` requêtes par minute (--rpm)
+    def __init__(self, rpm: int):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def batch_caller() -> ResilientCaller:
+    # Même disjoncteur et même budget de tokens que le reste du processus ; seule
+    # l'attente tolérée change. Pas de hedging : le lot n'a personne à faire attendre
+    limiter = RateLimiter(get_rate_limiter().backend, max_wait=BATCH_RATE_MAX_WAIT)
+    return ResilientCaller(breaker=get_resilient_caller().breaker, hedging=False, limiter=limiter)
+
+
+async def analyze_one(path: Path, analyzer, spacer: RequestSpacer,
+                      semaphore: asyncio.Semaphore, use_cache: bool) -> Dict:
+    async with semaphore:
+        start = time.perf_counter()
+        record = {"path": str(path), "cached": False}
+        try:
+            image_bytes = await asyncio.to_thread(path.read_bytes)
+            # Requête unique : clé distincte de celle de la cascade interactive
+            cache_key = analyzer.batch_cache_key(image_bytes)
+            result = analyzer.cache.get(cache_key) if use_cache else None
+
+            if result is not None:
+                record["cached"] = True
+            else:
+                prepared = await asyncio.to_thread(prepare_image, image_bytes, analyzer.image_options)
+                request = analyzer.build_request(prepared)
+                await spacer.acquire()
+                # Client synchrone partagé, appelé dans un thread du lot
+                response = await asyncio.to_thread(
+                    analyzer.resilience.call,
+                    lambda timeout: analyzer.client.with_options(timeout=timeout).chat.completions.create(**request),
+                    tokens=estimate_request_tokens(request))
+                result = analyzer._parse_response(response.choices[0].message.content)
+                if use_cache:
+                    analyzer.cache.set(cache_key, result)
+
+            record.update(status="ok", result=result)
+        except ValueError as e:
+            # JSON illisible ou non conforme au schéma, même après réparation
+            record.update(status="error", error=f"Réponse invalide: {e}")
+        except Exception as e:
+            record.update(status="error", error=f"{type(e).__name__}: {e}")
+        record["latency_s"] = round(time.perf_counter() - start, 4)
+        return record
+
+
+async def run_batch(kind: str, paths: List[Path], output: Path, concurrency: int,
+                    rpm: int, use_cache: bool) -> Dict:
+    analyzer = load_analyzer_class(kind)(resilience=batch_caller())
+    spacer = RequestSpacer(rpm)
+    semaphore = asyncio.Semaphore(concurrency)
+    # Un thread par appel simultané : to_thread utilise l'exécuteur par défaut de la boucle
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+    asyncio.get_running_loop().set_default_executor(executor)
+
+    done = load_checkpoint(output)
+    todo = [p for p in paths if str(p) not in done]
+    logger.info("%d photos, %d déjà traitées, %d à analyser", len(paths), len(paths) - len(todo), len(todo))
+
+    latencies: List[float] = []
+    api_latencies: List[float] = []
+    counts = {"ok": 0, "error": 0, "cached": 0}
+    start = time.perf_counter()
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    # Si le crash a laissé une ligne incomplète, on repart sur une ligne neuve
+    needs_newline = False
+    if output.exists() and output.stat().st_size > 0:
+        with output.open("rb") as f:
+            f.seek(-1, 2)
+            needs_newline = f.read(1) != b"\n"
+
+    try:
+        with output.open("a", encoding="utf-8") as out:
+            if needs_newline:
+                out.write("\n")
+            tasks = [asyncio.create_task(analyze_one(p, analyzer, spacer, semaphore, use_cache))
+                     for p in todo]
+            for finished in asyncio.as_completed(tasks):
+                record = await finished
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+
+                counts[record["status"]] += 1
+                latencies.append(record["latency_s"])
+                if record["cached"]:
+                    counts["cached"] += 1
+                elif record["status"] == "ok":
+                    api_latencies.append(record["latency_s"])
+    finally:
+        executor.shutdown(wait=False)
+
+    elapsed = time.perf_counter() - start
+    processed = counts["ok"] + counts["error"]
+    return {
+        "processed": processed,
+        "skipped": len(paths) - len(todo),
+        **counts,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_per_s": round(processed / elapsed, 2) if elapsed else 0.0,
+        "p50_s": round(percentile(latencies, 50), 3),
+        "p95_s": round(percentile(latencies, 95), 3),
+        "api_p50_s": round(percentile(api_latencies, 50), 3),
+        "api_p95_s": round(percentile(api_latencies, 95), 3),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Analyse par lots des photos (rouge à lèvres ou barbe)")
+    parser.add_argument("analyzer", choices=sorted(APPS))
+    parser.add_argument("--input", type=Path, help="Dossier de photos (parcours récursif)")
+    parser.add_argument("--manifest", type=Path, help="Fichier listant les photos, une par ligne")
+    parser.add_argument("--output", type=Path, required=True, help="Fichier JSONL de résultats (sert de checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Appels simultanés maximum")
+    parser.add_argument("--rpm", type=int, default=0, help="Requêtes par minute maximum (0 = illimité)")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore le cache de résultats")
+    args = parser.parse_args(argv)
+
+    if args.input is None and args.manifest is None:
+        parser.error("--input ou --manifest est requis")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    paths = iter_inputs(args.input, args.manifest)
+    summary = asyncio.run(run_batch(args.analyzer, paths, args.output, args.concurrency,
+                                    args.rpm, not args.no_cache))
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+    return 0 if summary["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
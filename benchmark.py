@@ -0,0 +1,234 @@
+"""Banc de mesure hors ligne des analyseurs, contre le serveur local stub_server.
+
+    python benchmark.py lipstick --save bench/main.json
+    python benchmark.py lipstick --compare bench/main.json --threshold 0.15
+
+Deux parties : des micro-mesures des étapes locales (préparation de l'image,
+base64, construction du prompt, _clean_response, rendu HTML), puis un test de
+bout en bout de analyze_image à plusieurs niveaux de concurrence (débit,
+p50/p95/p99, erreurs). Avec --compare, les valeurs sont comparées à un run
+précédent et le code de sortie vaut 1 si une mesure régresse au-delà du seuil.
+"""
+import argparse
+import io
+import json
+import logging
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from app_loader import APPS, load_app
+from image_prep import prepare_image
+from rate_limiter import RateLimiter
+from resilience import CircuitBreaker, ResilientCaller
+from result_cache import ResultCache
+from single_flight import SingleFlight
+from stub_server import BEARD_BODY, LIPSTICK_BODY, StubConfig, start_stub_server
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = (1, 4, 16)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def synthetic_photo(width: int = 2400, height: int = 1800, seed: int = 0) -> bytes:
+    # Dégradé teinté peau + bruit : se compresse comme une vraie photo, pas comme un aplat
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    base = np.stack([200 - yy * 60 / height, 150 - xx * 40 / width, 120 + 0 * xx], axis=-1)
+    noisy = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(noisy).save(buffer, format="JPEG", quality=92)
+    return buffer.getvalue()
+
+
+def unique_photos(base: bytes, count: int) -> List[bytes]:
+    # Octets différents (donc clés de cache différentes) pour une même image décodée
+    return [base + f"\n{i}".encode() for i in range(count)]
+
+
+def measure(fn: Callable[[], object], repeat: int) -> Dict:
+    fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {"median_us": round(statistics.median(samples) * 1e6, 1),
+            "p95_us": round(percentile(samples, 95) * 1e6, 1)}
+
+
+def make_analyzer(kind: str, base_url: str, resilience: ResilientCaller):
+    from openai import OpenAI
+
+    analyzer_cls = getattr(load_app(kind), APPS[kind][2])
+    client = OpenAI(base_url=base_url, api_key="stub", max_retries=0)
+    # Pas de cache ni de coalescence partagés : chaque appel doit atteindre le serveur
+    return analyzer_cls(cache=ResultCache(directory=None, enabled=False), client=client,
+                        single_flight=SingleFlight(), resilience=resilience)
+
+
+def run_micro(kind: str, analyzer, photo: bytes, repeat: int) -> Dict:
+    app = load_app(kind)
+    prepared = prepare_image(photo, analyzer.image_options)
+    body = json.dumps(LIPSTICK_BODY if kind == "lipstick" else BEARD_BODY, ensure_ascii=False)
+    fenced = f"```json\n{body}\n```"
+
+    results = {
+        "prepare_image": measure(lambda: prepare_image(photo, analyzer.image_options), max(5, repeat // 20)),
+        "encode_base64": measure(lambda: analyzer._encode_image(prepared.data), repeat),
+        "build_request": measure(lambda: analyzer.build_request(prepared), repeat),
+        "clean_response": measure(lambda: analyzer._clean_response(body), repeat),
+        "clean_response_fenced": measure(lambda: analyzer._clean_response(fenced), repeat),
+    }
+    if kind == "lipstick":
+        def render():
+            app.analysis_html(LIPSTICK_BODY["analysis"])
+            app.final_choice_html(LIPSTICK_BODY["chosen_color"])
+    else:
+        def render():
+            recommendations = BEARD_BODY["recommendations"]
+            app.characteristics_html(BEARD_BODY["recommended_style"], BEARD_BODY["face_shape"],
+                                     BEARD_BODY["has_gray"], BEARD_BODY["trim_length_mm"])
+            app.problems_html(BEARD_BODY["problem_areas"])
+            app.technique_html(recommendations["trim"], BEARD_BODY["recommended_color"])
+            app.products_html(recommendations["products"])
+            app.routine_html(recommendations["routine"])
+    results["render_html"] = measure(render, repeat)
+    return results
+
+
+def run_end_to_end(kind: str, base_url: str, photos: List[bytes], concurrency: int,
+                   stream: bool) -> Dict:
+    # Le serveur local n'envoie pas d'en-têtes x-ratelimit : pas de limiteur, on mesure le pipeline
+    resilience = ResilientCaller(breaker=CircuitBreaker(), hedging=False, limiter=RateLimiter(enabled=False))
+    local = threading.local()
+
+    def one(photo: bytes) -> Dict:
+        # Un analyseur par thread : last_trace n'est pas partagé entre appels concurrents
+        if not hasattr(local, "analyzer"):
+            local.analyzer = make_analyzer(kind, base_url, resilience)
+        analyzer = local.analyzer
+        start = time.perf_counter()
+        if stream:
+            analyzer.analyze_image_stream(photo, lambda partial, completed: None, use_cache=False)
+        else:
+            analyzer.analyze_image(photo, use_cache=False)
+        return {"latency_s": time.perf_counter() - start, "outcome": analyzer.last_trace.outcome}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        records = list(pool.map(one, photos))
+    elapsed = time.perf_counter() - start
+
+    latencies = [r["latency_s"] for r in records]
+    errors = sum(1 for r in records if r["outcome"] in ("error", "degraded"))
+    return {
+        "requests": len(records),
+        "errors": errors,
+        "throughput_per_s": round(len(records) / elapsed, 2) if elapsed else 0.0,
+        "p50_s": round(percentile(latencies, 50), 4),
+        "p95_s": round(percentile(latencies, 95), 4),
+        "p99_s": round(percentile(latencies, 99), 4),
+        "retries": resilience.stats["retries"],
+    }
+
+
+# Sens d'une régression : une latence qui monte, un débit qui baisse
+HIGHER_IS_WORSE = ("median_us", "p95_us", "p50_s", "p95_s", "p99_s", "errors")
+LOWER_IS_WORSE = ("throughput_per_s",)
+
+
+def compare(current: Dict, baseline: Dict, threshold: float, prefix: str = "") -> List[str]:
+    regressions = []
+    for key, value in current.items():
+        previous = baseline.get(key)
+        name = f"{prefix}{key}"
+        if isinstance(value, dict) and isinstance(previous, dict):
+            regressions += compare(value, previous, threshold, f"{name}.")
+            continue
+        if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)):
+            continue
+        if previous == 0:
+            worse = key in HIGHER_IS_WORSE and value > 0
+            change = float("inf") if worse else 0.0
+        else:
+            change = (value - previous) / previous
+            worse = (key in HIGHER_IS_WORSE and change > threshold) or \
+                    (key in LOWER_IS_WORSE and -change > threshold)
+        if key in HIGHER_IS_WORSE + LOWER_IS_WORSE:
+            marker = "  RÉGRESSION" if worse else ""
+            print(f"{name:55s} {previous:>12} -> {value:>12} ({change:+.1%}){marker}", file=sys.stderr)
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Banc de mesure hors ligne (serveur OpenAI local)")
+    parser.add_argument("analyzer", choices=sorted(APPS))
+    parser.add_argument("--requests", type=int, default=64, help="Analyses par niveau de concurrence")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(DEFAULT_CONCURRENCY))
+    parser.add_argument("--repeat", type=int, default=200, help="Répétitions des micro-mesures")
+    parser.add_argument("--latency", type=float, default=0.3, help="Latence simulée du modèle (s)")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--stream", action="store_true", help="Passe par analyze_image_stream")
+    parser.add_argument("--skip-e2e", action="store_true", help="Micro-mesures uniquement")
+    parser.add_argument("--save", type=Path, help="Écrit les résultats en JSON")
+    parser.add_argument("--compare", type=Path, help="Résultats JSON d'un run de référence")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Régression tolérée (0.10 = 10 %%)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    config = StubConfig(latency_s=args.latency, jitter_s=args.jitter, error_rate=args.error_rate)
+    server, base_url = start_stub_server(config)
+    photo = synthetic_photo()
+
+    try:
+        analyzer = make_analyzer(args.analyzer, base_url, ResilientCaller(hedging=False, limiter=RateLimiter(enabled=False)))
+        report = {
+            "analyzer": args.analyzer,
+            "config": {"latency_s": args.latency, "error_rate": args.error_rate, "stream": args.stream},
+            "micro": run_micro(args.analyzer, analyzer, photo, args.repeat),
+            "end_to_end": {},
+        }
+        if not args.skip_e2e:
+            for level in args.concurrency:
+                photos = unique_photos(photo, args.requests)
+                report["end_to_end"][f"c{level}"] = run_end_to_end(
+                    args.analyzer, base_url, photos, level, args.stream)
+        report["stub"] = server.RequestHandlerClass.stats.snapshot()
+    finally:
+        server.shutdown()
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        args.save.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text(encoding="utf-8"))
+        regressions = compare({k: report[k] for k in ("micro", "end_to_end")},
+                              {k: baseline.get(k, {}) for k in ("micro", "end_to_end")}, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} régression(s) au-delà de {args.threshold:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
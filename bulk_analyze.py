@@ -0,0 +1,335 @@
+"""Analyse en masse via l'API Batch d'OpenAI (moitié prix, résultats sous 24 h).
+
+    python bulk_analyze.py lipstick --input archive/ --output lipstick.jsonl \\
+        --work-dir bulk-lipstick/ --poll-interval 60
+
+Pour re-scorer une archive de photos avec un nouveau prompt, la latence ne
+compte pas : les requêtes sont celles de build_request(), écrites dans des
+fichiers JSONL au format Batch (une ligne par photo, custom_id = clé
+batch_cache_key, à part de la cascade interactive), envoyées avec
+files.create puis batches.create, et les fichiers de sortie sont relus au
+fil de l'eau. Chaque ligne est traitée à part : une
+réponse invalide ou en erreur donne un enregistrement "error" sans bloquer
+le reste du lot.
+
+Le fichier de sortie a le format de batch_analyze.py et sert de checkpoint.
+L'état des lots (fichiers envoyés, identifiants de lot, lots déjà relus) est
+gardé dans work_dir/state.json : relancer la commande reprend l'attente des
+lots en cours sans rien renvoyer ; une fois tous les lots relus, une
+nouvelle exécution ne renvoie que les photos sans résultat "ok".
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app_loader import APPS, load_analyzer_class
+from batch_analyze import iter_inputs, load_checkpoint
+from image_prep import prepare_image
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+# Limites de l'API Batch par fichier d'entrée (marge sur les 200 Mo)
+MAX_REQUESTS_PER_FILE = 50_000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# Envoi et téléchargement de fichiers de plusieurs centaines de Mo
+FILE_TIMEOUT_SECONDS = 600
+STATE_FILENAME = "state.json"
+# Lignes préparées d'avance par worker : borne la mémoire (une ligne = une image en base64)
+PREPARE_AHEAD_PER_WORKER = 4
+
+
+class BulkState:
+    # work_dir/state.json, réécrit atomiquement après chaque étape
+    def __init__(self, work_dir: Path):
+        self.path = work_dir / STATE_FILENAME
+        self.data: Dict = {}
+        if self.path.exists():
+            self.data = json.loads(self.path.read_text(encoding="utf-8"))
+
+    @property
+    def shards(self) -> List[Dict]:
+        return self.data.get("shards", [])
+
+    def pending(self) -> bool:
+        return any(not shard.get("ingested") for shard in self.shards)
+
+    def save(self) -> None:
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.data, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def clear(self) -> None:
+        self.data = {}
+        self.path.unlink(missing_ok=True)
+
+
+def _prepare_line(analyzer, path: Path, use_cache: bool) -> Tuple[Path, str, Optional[Dict], Optional[str]]:
+    # (photo, clé de cache, enregistrement déjà prêt ou None, ligne JSONL ou None) ;
+    # l'enregistrement prêt est un résultat en cache ou une erreur de préparation
+    try:
+        image_bytes = path.read_bytes()
+        # Une requête Batch unique : clé distincte de celle de la cascade interactive
+        cache_key = analyzer.batch_cache_key(image_bytes)
+        cached = analyzer.cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            return path, cache_key, {"path": str(path), "cached": True, "status": "ok", "result": cached}, None
+        request = analyzer.build_request(prepare_image(image_bytes, analyzer.image_options))
+    except Exception as e:
+        # Photo illisible ou trop grande (UploadTooLargeError) : le reste du lot part quand même
+        logger.warning("%s : %s", path, e)
+        return path, "", {"path": str(path), "cached": False, "status": "error",
+                          "error": f"{type(e).__name__}: {e}"}, None
+    line = json.dumps({"custom_id": cache_key, "method": "POST", "url": ENDPOINT, "body": request},
+                      ensure_ascii=False)
+    return path, cache_key, None, line
+
+
+def _ordered_map(executor: ThreadPoolExecutor, fn: Callable, items: Iterable,
+                 ahead: int) -> Iterator:
+    # Comme executor.map, dans l'ordre, mais au plus `ahead` tâches soumises et non relues
+    pending: Deque[Future] = deque()
+    for item in items:
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def write_shards(analyzer, paths: List[Path], work_dir: Path, use_cache: bool,
+                 max_requests: int = MAX_REQUESTS_PER_FILE,
+                 max_bytes: int = MAX_BYTES_PER_FILE) -> Tuple[List[Dict], Dict[str, List[str]], List[Dict]]:
+    # Retourne (lots à envoyer, custom_id -> photos, enregistrements déjà prêts :
+    # servis par le cache ou en erreur de préparation)
+    shards: List[Dict] = []
+    owners: Dict[str, List[str]] = {}
+    ready: List[Dict] = []
+    out = None
+    size = count = 0
+    # Préparation des images en parallèle, par fenêtre glissante ; écriture séquentielle,
+    # dans l'ordre, chaque ligne partant dans le lot dès qu'elle est prête
+    workers = os.cpu_count() or 4
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, cache_key, record, line in _ordered_map(
+                executor, lambda p: _prepare_line(analyzer, p, use_cache), paths,
+                ahead=workers * PREPARE_AHEAD_PER_WORKER):
+            if record is not None:
+                ready.append(record)
+                continue
+            if cache_key in owners:
+                # Même photo sous deux chemins : une seule requête, résultat recopié
+                owners[cache_key].append(str(path))
+                continue
+            owners[cache_key] = [str(path)]
+            encoded = line.encode("utf-8") + b"\n"
+            if out is None or count >= max_requests or size + len(encoded) > max_bytes:
+                if out is not None:
+                    out.close()
+                shard_path = work_dir / f"input-{len(shards):04d}.jsonl"
+                shards.append({"input": str(shard_path), "requests": 0, "custom_ids": []})
+                out = shard_path.open("wb")
+                size = count = 0
+            out.write(encoded)
+            size += len(encoded)
+            count += 1
+            shards[-1]["requests"] = count
+            shards[-1]["custom_ids"].append(cache_key)
+    if out is not None:
+        out.close()
+    return shards, owners, ready
+
+
+def submit_shard(client, shard: Dict, kind: str) -> None:
+    if not shard.get("file_id"):
+        with open(shard["input"], "rb") as f:
+            shard["file_id"] = client.files.create(file=f, purpose="batch").id
+    if not shard.get("batch_id"):
+        batch = client.batches.create(input_file_id=shard["file_id"], endpoint=ENDPOINT,
+                                      completion_window=COMPLETION_WINDOW,
+                                      metadata={"analyzer": kind, "input": Path(shard["input"]).name})
+        shard["batch_id"] = batch.id
+        shard["status"] = batch.status
+
+
+def _file_lines(client, file_id: Optional[str]) -> Iterator[str]:
+    if not file_id:
+        return
+    for line in client.files.content(file_id).text.splitlines():
+        if line.strip():
+            yield line
+
+
+def parse_output_line(analyzer, line: str) -> Tuple[Optional[str], Dict]:
+    # (custom_id, champs de l'enregistrement : status et result ou error)
+    try:
+        item = json.loads(line)
+    except json.JSONDecodeError as e:
+        return None, {"status": "error", "error": f"Ligne de sortie illisible: {e}"}
+    custom_id = item.get("custom_id")
+    response = item.get("response") or {}
+    if item.get("error") or response.get("status_code") != 200:
+        error = item.get("error") or (response.get("body") or {}).get("error") or {}
+        return custom_id, {"status": "error",
+                           "error": f"{response.get('status_code', error.get('code', '?'))}: "
+                                    f"{error.get('message', 'erreur inconnue')}"}
+    try:
+        choice = response["body"]["choices"][0]
+        result = analyzer._parse_response(choice["message"]["content"])
+    except (KeyError, IndexError, TypeError) as e:
+        return custom_id, {"status": "error", "error": f"Réponse incomplète: {e!r}"}
+    except ValueError as e:
+        # JSON illisible ou non conforme au schéma, même après réparation
+        return custom_id, {"status": "error", "error": f"Réponse invalide: {e}"}
+    if choice.get("finish_reason") == "length":
+        return custom_id, {"status": "error", "error": "Réponse tronquée (max_tokens)"}
+    return custom_id, {"status": "ok", "result": result}
+
+
+def ingest_shard(client, analyzer, shard: Dict, owners: Dict[str, List[str]], out,
+                 done: set, use_cache: bool, counts: Dict) -> None:
+    seen = set()
+    for file_id in (shard.get("output_file_id"), shard.get("error_file_id")):
+        for line in _file_lines(client, file_id):
+            custom_id, fields = parse_output_line(analyzer, line)
+            if custom_id not in owners:
+                logger.warning("Ligne de sortie sans photo connue (%s) : ignorée", custom_id)
+                continue
+            seen.add(custom_id)
+            if fields["status"] == "ok" and use_cache:
+                analyzer.cache.set(custom_id, fields["result"])
+            _write(out, owners[custom_id], fields, shard, done, counts)
+    if shard["status"] != "completed":
+        # Lot expiré, échoué ou annulé : les requêtes sans réponse sont à refaire
+        missing = {"status": "error", "error": f"Lot {shard['status']} sans réponse pour cette photo"}
+        for custom_id in shard.get("custom_ids", []):
+            if custom_id not in seen:
+                _write(out, owners[custom_id], missing, shard, done, counts)
+
+
+def _write(out, paths: List[str], fields: Dict, shard: Dict, done: set, counts: Dict) -> None:
+    for path in paths:
+        if path in done:
+            # Lot relu une seconde fois après un arrêt : déjà dans la sortie
+            continue
+        record = {"path": path, "cached": False, **fields, "batch_id": shard["batch_id"]}
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        counts[fields["status"]] += 1
+        if fields["status"] == "ok":
+            done.add(path)
+    out.flush()
+
+
+def check_state(state: BulkState, kind: str, namespace: str, work_dir: Path) -> None:
+    # Les réponses des lots en cours sont rangées sous leur custom_id : les relire
+    # avec un autre analyseur ou un autre prompt remplirait le mauvais cache
+    if state.data.get("analyzer") not in (None, kind):
+        raise SystemExit(f"{work_dir} contient des lots {state.data['analyzer']}, pas {kind}")
+    if state.pending() and state.data.get("namespace") != namespace:
+        raise SystemExit(f"{work_dir} contient des lots envoyés avec un autre prompt ou modèle "
+                         f"({state.data.get('namespace')}) : attendre leur fin avec la configuration "
+                         f"d'origine, ou utiliser un autre --work-dir")
+
+
+def run_bulk(kind: str, paths: List[Path], output: Path, work_dir: Path,
+             poll_interval: float = 60.0, use_cache: bool = True, wait: bool = True,
+             max_requests: int = MAX_REQUESTS_PER_FILE, client=None) -> Dict:
+    analyzer = load_analyzer_class(kind)()
+    # Client partagé, mais sans l'échéance courte des appels interactifs
+    client = (client or analyzer.client).with_options(timeout=FILE_TIMEOUT_SECONDS, max_retries=3)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    state = BulkState(work_dir)
+    done = load_checkpoint(output)
+    counts = {"ok": 0, "error": 0, "cached": 0}
+    skipped = 0
+
+    check_state(state, kind, analyzer.batch_namespace(), work_dir)
+
+    with output.open("a", encoding="utf-8") as out:
+        if not state.pending():
+            todo = [p for p in paths if str(p) not in done]
+            skipped = len(paths) - len(todo)
+            logger.info("%d photos, %d déjà traitées, %d à préparer", len(paths), len(paths) - len(todo), len(todo))
+            shards, owners, ready = write_shards(analyzer, todo, work_dir, use_cache, max_requests)
+            for record in ready:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                counts[record["status"]] += 1
+                if record["status"] == "ok":
+                    counts["cached"] += 1
+                    done.add(record["path"])
+            out.flush()
+            state.data = {"analyzer": kind, "namespace": analyzer.batch_namespace(),
+                          "owners": owners, "shards": shards}
+            state.save()
+        else:
+            logger.info("Reprise de %d lots en cours", sum(not s.get("ingested") for s in state.shards))
+        owners = state.data["owners"]
+
+        for shard in state.shards:
+            if not shard.get("batch_id"):
+                submit_shard(client, shard, kind)
+                # Sauvegardé aussitôt : un arrêt ne renverra pas ce lot
+                state.save()
+                logger.info("Lot %s envoyé (%d requêtes)", shard["batch_id"], shard["requests"])
+
+        while state.pending():
+            for shard in state.shards:
+                if shard.get("ingested"):
+                    continue
+                batch = client.batches.retrieve(shard["batch_id"])
+                shard.update(status=batch.status, output_file_id=batch.output_file_id,
+                             error_file_id=batch.error_file_id)
+                if batch.status not in TERMINAL_STATUSES:
+                    continue
+                ingest_shard(client, analyzer, shard, owners, out, done, use_cache, counts)
+                shard["ingested"] = True
+                state.save()
+                Path(shard["input"]).unlink(missing_ok=True)
+                logger.info("Lot %s %s : relu", shard["batch_id"], batch.status)
+            if not wait or not state.pending():
+                break
+            time.sleep(poll_interval)
+
+    batches = len(state.shards)
+    pending = [s["batch_id"] for s in state.shards if not s.get("ingested")]
+    if not pending:
+        state.clear()
+    return {**counts, "skipped": skipped, "batches": batches, "pending_batches": pending}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Analyse en masse via l'API Batch (rouge à lèvres ou barbe)")
+    parser.add_argument("analyzer", choices=sorted(APPS))
+    parser.add_argument("--input", type=Path, help="Dossier de photos (parcours récursif)")
+    parser.add_argument("--manifest", type=Path, help="Fichier listant les photos, une par ligne")
+    parser.add_argument("--output", type=Path, required=True, help="Fichier JSONL de résultats (sert de checkpoint)")
+    parser.add_argument("--work-dir", type=Path, required=True, help="Fichiers d'entrée et état des lots")
+    parser.add_argument("--poll-interval", type=float, default=60.0, help="Secondes entre deux relevés des lots")
+    parser.add_argument("--max-requests", type=int, default=MAX_REQUESTS_PER_FILE, help="Requêtes par lot")
+    parser.add_argument("--no-wait", action="store_true", help="Envoie et relève une fois, sans attendre la fin")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore le cache de résultats")
+    args = parser.parse_args(argv)
+
+    if args.input is None and args.manifest is None:
+        parser.error("--input ou --manifest est requis")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    paths = iter_inputs(args.input, args.manifest)
+    summary = run_bulk(args.analyzer, paths, args.output, args.work_dir, args.poll_interval,
+                       not args.no_cache, not args.no_wait, args.max_requests)
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+    return 0 if summary["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""Cascade de modèles : une passe rapide d'abord, la passe complète si besoin.
+
+La première passe envoie l'image en détail "low" (85 tokens d'image au lieu
+de plusieurs tuiles) avec un petit max_tokens et une consigne de concision ;
+elle suffit pour les champs catégoriels (style, couleur, teinte, forme du
+visage). On ne relance la passe complète (détail "high", réponse longue)
+que si la réponse rapide est invalide, tronquée ou si le modèle déclare une
+confiance insuffisante dans le champ `confidence` ajouté aux schémas.
+Chaque passe est tracée (durée, tokens, coût) et chaque escalade comptée
+avec sa raison, pour suivre le taux d'escalade.
+"""
+import os
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from image_prep import ImageOptions
+
+CASCADE_MIN_CONFIDENCE = float(os.getenv("BEAUTY_CASCADE_MIN_CONFIDENCE", "0.6"))
+
+CONFIDENCE_PROPERTY = {
+    "type": "number",
+    "description": "Ta confiance dans les champs catégoriels, de 0 (incertain) à 1 (certain)",
+}
+
+# Ajouté au prompt de la passe rapide : la réponse doit tenir dans max_tokens
+BRIEF_INSTRUCTION = ("\n\nRéponse courte : textes libres en une ou deux phrases, "
+                     "et une confiance honnête (basse si la photo est floue, sombre ou ambiguë).")
+
+
+def cascade_enabled_by_env() -> bool:
+    # BEAUTY_CASCADE=off : passe complète directement, comme avant
+    return os.getenv("BEAUTY_CASCADE", "on").strip().lower() not in ("off", "0", "false", "no")
+
+
+@dataclass(frozen=True)
+class Tier:
+    name: str
+    image_options: ImageOptions
+    max_tokens: int
+
+    def signature(self) -> str:
+        return f"{self.name}:{self.image_options.signature()}:{self.max_tokens}"
+
+
+def escalation_reason(data: Optional[Dict], finish_reason: Optional[str],
+                      min_confidence: float = CASCADE_MIN_CONFIDENCE) -> Optional[str]:
+    # data : réponse JSON brute déjà validée (None si invalide) ; None = réponse acceptée
+    if finish_reason == "length":
+        return "truncated"
+    if data is None:
+        return "invalid"
+    confidence = data.get("confidence")
+    if isinstance(confidence, bool) or not isinstance(confidence, (int, float)):
+        return "no_confidence"
+    if confidence < min_confidence:
+        return "low_confidence"
+    return None
@@ -0,0 +1,193 @@
+"""Enregistrement et rejeu des échanges avec l'API, pour les tests et l'évaluation.
+
+Un transport httpx placé sous le client OpenAI partagé (BEAUTY_CASSETTE) :
+
+    off      aucun effet (défaut)
+    record   chaque requête part sur le réseau ; la réponse est rangée dans la
+             cassette (BEAUTY_CASSETTE_DIR), en remplaçant l'entrée existante,
+             sauf si une réponse 2xx déjà enregistrée serait remplacée par une
+             erreur (429, 5xx...) : la bonne réponse est gardée
+    replay   la réponse vient de la cassette, sans réseau ni clé d'API ; une
+             requête absente reçoit une erreur 404 explicite
+
+La clé d'une entrée est la requête normalisée : méthode, chemin (sans l'hôte,
+pour passer du serveur local à l'API réelle) et corps JSON à clés triées,
+chaque image data: remplacée par le SHA-256 de son contenu. Les en-têtes
+(clé d'API, identifiants de requête) n'entrent pas dans la clé. Les réponses
+en streaming sont lues en entier à l'enregistrement puis rejouées d'un bloc :
+l'analyse du flux reste celle du SDK, mais sans délai entre fragments.
+
+L'entrée garde aussi la durée mesurée à l'enregistrement ; elle est renvoyée
+au rejeu dans l'en-tête x-cassette-elapsed, pour que les rapports d'évaluation
+citent la latence réelle plutôt que celle du disque.
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_MODES = ("off", "record", "replay")
+DEFAULT_CASSETTE_DIR = Path(os.getenv("BEAUTY_CASSETTE_DIR", "cassettes"))
+# En-têtes de réponse conservés : le reste (date, identifiants, quotas) varie d'un appel à l'autre
+KEPT_HEADERS = ("content-type",)
+ELAPSED_HEADER = "x-cassette-elapsed"
+STATUS_HEADER = "x-cassette"
+
+
+def cassette_mode_by_env() -> str:
+    mode = os.getenv("BEAUTY_CASSETTE", "off").strip().lower()
+    if mode not in CASSETTE_MODES:
+        raise ValueError(f"BEAUTY_CASSETTE invalide: {mode} (attendu: {', '.join(CASSETTE_MODES)})")
+    return mode
+
+
+def _normalize_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _normalize_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_normalize_value(v) for v in value]
+    if isinstance(value, str) and value.startswith("data:") and ";base64," in value:
+        # L'image elle-même, pas son encodage : quelques octets au lieu de centaines de Ko
+        header, payload = value.split(";base64,", 1)
+        digest = hashlib.sha256(base64.b64decode(payload)).hexdigest()
+        return f"{header};sha256,{digest}"
+    return value
+
+
+def normalize_request(method: str, path: str, body: bytes) -> Dict:
+    try:
+        payload = _normalize_value(json.loads(body)) if body else None
+    except (ValueError, UnicodeDecodeError):
+        # Corps non JSON (multipart d'un envoi de fichier) : seul son hash compte
+        payload = {"sha256": hashlib.sha256(body).hexdigest()}
+    return {"method": method.upper(), "path": path, "body": payload}
+
+
+def _is_success(status: int) -> bool:
+    return 200 <= status < 300
+
+
+def request_key(normalized: Dict) -> str:
+    canonical = json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CassetteStore:
+    def __init__(self, directory: Path = DEFAULT_CASSETTE_DIR):
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "recorded": 0, "kept": 0}
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _load(self, key: str) -> Optional[Dict]:
+        try:
+            return json.loads(self._path(key).read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def get(self, key: str) -> Optional[Dict]:
+        entry = self._load(key)
+        with self._lock:
+            self.stats["hits" if entry is not None else "misses"] += 1
+        return entry
+
+    def put(self, key: str, entry: Dict) -> bool:
+        # False si l'entrée est une erreur et qu'une réponse 2xx est déjà enregistrée
+        if not _is_success(entry["status"]):
+            existing = self._load(key)
+            if existing is not None and _is_success(existing["status"]):
+                with self._lock:
+                    self.stats["kept"] += 1
+                return False
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Écriture atomique : un rejeu concurrent ne lit jamais une entrée tronquée
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(entry, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, path)
+        with self._lock:
+            self.stats["recorded"] += 1
+        return True
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.directory.glob("*/*.json"))
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {**self.stats, "directory": str(self.directory)}
+
+
+class CassetteTransport(httpx.BaseTransport):
+    def __init__(self, store: CassetteStore, mode: str,
+                 inner: Optional[httpx.BaseTransport] = None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Mode de cassette invalide: {mode}")
+        self.store = store
+        self.mode = mode
+        self.inner = inner or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        normalized = normalize_request(request.method, request.url.path, request.read())
+        key = request_key(normalized)
+        if self.mode == "replay":
+            return self._replay(request, key)
+
+        start = time.perf_counter()
+        response = self.inner.handle_request(request)
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        elapsed = time.perf_counter() - start
+        headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+        recorded = self.store.put(key, {
+            "request": normalized,
+            "status": response.status_code,
+            "headers": headers,
+            "body": body.decode("utf-8", errors="replace"),
+            "elapsed_s": round(elapsed, 4),
+            "recorded_at": time.time(),
+        })
+        if not recorded:
+            logger.warning("Réponse %d non enregistrée pour %s %s : la réponse 2xx de la cassette est gardée",
+                           response.status_code, request.method, request.url.path)
+        return httpx.Response(response.status_code, request=request, content=body,
+                              headers={**headers, ELAPSED_HEADER: f"{elapsed:.4f}",
+                                       STATUS_HEADER: "recorded" if recorded else "kept"})
+
+    def _replay(self, request: httpx.Request, key: str) -> httpx.Response:
+        entry = self.store.get(key)
+        if entry is None:
+            logger.warning("Cassette absente pour %s %s (%s)", request.method, request.url.path, key[:12])
+            # 404 : erreur non relancée par ResilientCaller, visible telle quelle
+            return httpx.Response(404, request=request, json={"error": {
+                "message": f"Aucune cassette pour cette requête ({key[:12]}) : l'enregistrer avec BEAUTY_CASSETTE=record",
+                "type": "cassette_miss", "code": "cassette_miss"}},
+                headers={STATUS_HEADER: "miss"})
+        return httpx.Response(entry["status"], request=request, content=entry["body"].encode("utf-8"),
+                              headers={**entry.get("headers", {}),
+                                       ELAPSED_HEADER: str(entry.get("elapsed_s", 0)), STATUS_HEADER: "hit"})
+
+    def close(self) -> None:
+        self.inner.close()
+
+
+def cassette_transport(inner: httpx.BaseTransport, mode: Optional[str] = None,
+                       directory: Optional[Path] = None) -> Optional[CassetteTransport]:
+    # None en mode "off" : le client garde son transport normal
+    mode = cassette_mode_by_env() if mode is None else mode
+    if mode == "off":
+        return None
+    logger.info("Cassette en mode %s (%s)", mode, directory or DEFAULT_CASSETTE_DIR)
+    return CassetteTransport(CassetteStore(directory or DEFAULT_CASSETTE_DIR), mode, inner)
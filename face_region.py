@@ -0,0 +1,153 @@
+"""Recadrage local sur la zone du visage utile à l'analyse.
+
+Le fond de la photo ne sert à rien au modèle mais coûte des octets et des
+tokens d'image. On détecte le visage sans modèle téléchargé ni GPU : masque
+de peau YCbCr (le même que l'estimation du teint) sur une vignette,
+fermeture morphologique, puis composante connexe la plus proche du centre.
+La boîte du visage est déduite de la largeur de cette tache (une barbe ou
+un cou dégagé faussent sa hauteur), puis chaque région est un sous-cadre
+proportionnel avec une marge :
+
+    face        le visage entier
+    lips        bas du visage, joues comprises (teint + lèvres)
+    lower_face  des pommettes au cou (barbe, mâchoire)
+
+Si la détection n'est pas nette (tache trop petite, trop grande, de forme
+improbable), detect_face() renvoie None et l'image reste entière.
+"""
+import logging
+import os
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from skin_tone import skin_mask
+
+logger = logging.getLogger(__name__)
+
+VALID_REGIONS = ("full", "face", "lips", "lower_face")
+DETECTION_EDGE = 160
+# Marge ajoutée autour de la région, en fraction de sa taille
+REGION_MARGIN = float(os.getenv("BEAUTY_ROI_MARGIN", "0.15"))
+# Côté minimal du recadrage, en pixels de l'image d'origine
+MIN_CROP_EDGE = 256
+# Côté minimal après redimensionnement : la résolution du mode detail="low"
+MIN_REGION_EDGE = 512
+# Part de l'image occupée par la tache de peau retenue (vignette de détection)
+MIN_SKIN_FRACTION = 0.008
+MAX_SKIN_FRACTION = 0.85
+
+# (gauche, haut, droite, bas) en fractions de la boîte du visage
+_REGION_BOXES: Dict[str, Tuple[float, float, float, float]] = {
+    "face": (0.0, 0.0, 1.0, 1.0),
+    "lips": (0.1, 0.45, 0.9, 1.0),
+    "lower_face": (-0.05, 0.4, 1.05, 1.3),
+}
+# Rapport hauteur / largeur d'un visage, front compris
+FACE_ASPECT = 1.35
+
+
+def roi_enabled_by_env() -> bool:
+    # BEAUTY_ROI=off : la photo entière est toujours envoyée
+    return os.getenv("BEAUTY_ROI", "on").strip().lower() not in ("off", "0", "false", "no")
+
+
+@dataclass(frozen=True)
+class FaceBox:
+    # Coordonnées normalisées (0-1) dans l'image
+    left: float
+    top: float
+    right: float
+    bottom: float
+    skin_fraction: float
+
+
+def _largest_central_component(mask: np.ndarray) -> Optional[np.ndarray]:
+    # Remplissage par diffusion depuis le pixel de peau le plus proche du centre
+    ys, xs = np.nonzero(mask)
+    if len(ys) == 0:
+        return None
+    h, w = mask.shape
+    seed = int(np.argmin((ys - h / 2) ** 2 + (xs - w / 2) ** 2))
+    # copy() : une image créée par fromarray partage le tableau et ignore les écritures
+    image = Image.fromarray(mask.astype(np.uint8) * 255).copy()
+    ImageDraw.floodfill(image, (int(xs[seed]), int(ys[seed])), 128)
+    return np.asarray(image) == 128
+
+
+def detect_face(image: Image.Image) -> Optional[FaceBox]:
+    thumb = image.convert("RGB")
+    thumb.thumbnail((DETECTION_EDGE, DETECTION_EDGE))
+    mask = skin_mask(np.asarray(thumb))
+    # Fermeture : bouche, yeux et sourcils ne coupent pas la tache du visage
+    closed = (Image.fromarray(mask.astype(np.uint8) * 255)
+              .filter(ImageFilter.MaxFilter(5)).filter(ImageFilter.MinFilter(5)))
+    component = _largest_central_component(np.asarray(closed) > 0)
+    if component is None:
+        return None
+
+    h, w = component.shape
+    fraction = float(component.mean())
+    if not MIN_SKIN_FRACTION <= fraction <= MAX_SKIN_FRACTION:
+        return None
+    ys, xs = np.nonzero(component)
+    top, bottom = int(ys.min()), int(ys.max()) + 1
+    left, right = int(xs.min()), int(xs.max()) + 1
+    width = right - left
+    # Tache trop large pour être un visage (peau du torse, mur beige...)
+    if width / w > 0.95 or (bottom - top) / width < 0.6:
+        return None
+    # Remplissage de la boîte : une tache filiforme n'est pas un visage
+    if component[top:bottom, left:right].mean() < 0.35:
+        return None
+    face_bottom = min(bottom, top + FACE_ASPECT * width)
+    return FaceBox(left / w, top / h, right / w, face_bottom / h, round(fraction, 3))
+
+
+def region_box(face: FaceBox, region: str, size: Tuple[int, int],
+               margin: float = REGION_MARGIN) -> Tuple[int, int, int, int]:
+    width, height = size
+    fl, ft, fr, fb = _REGION_BOXES[region]
+    fw, fh = face.right - face.left, face.bottom - face.top
+    left, right = face.left + fl * fw, face.left + fr * fw
+    top, bottom = face.top + ft * fh, face.top + fb * fh
+    mx, my = margin * (right - left), margin * (bottom - top)
+    return (max(0, int((left - mx) * width)), max(0, int((top - my) * height)),
+            min(width, int((right + mx) * width)), min(height, int((bottom + my) * height)))
+
+
+def crop_to_region(image: Image.Image, region: str) -> Tuple[Image.Image, str]:
+    # Retourne (image recadrée, région appliquée) ; "full" si la détection n'est pas sûre
+    if region == "full" or not roi_enabled_by_env():
+        return image, "full"
+    if region not in VALID_REGIONS:
+        raise ValueError(f"Région invalide: {region}")
+    face = detect_face(image)
+    if face is None:
+        logger.info("Visage non détecté avec certitude : image entière conservée")
+        return image, "full"
+    box = _at_least(region_box(face, region, image.size), image.size, MIN_CROP_EDGE)
+    return image.crop(box), region
+
+
+def _at_least(box: Tuple[int, int, int, int], size: Tuple[int, int],
+              edge: int) -> Tuple[int, int, int, int]:
+    # Visage minuscule dans une grande photo : on garde un peu de contexte autour
+    left, top, right, bottom = box
+    grow_x, grow_y = max(0, edge - (right - left)), max(0, edge - (bottom - top))
+    left, right = left - grow_x // 2, right + grow_x - grow_x // 2
+    top, bottom = top - grow_y // 2, bottom + grow_y - grow_y // 2
+    # Décalage plutôt que troncature quand la région touche un bord
+    shift_x = max(0, -left) - max(0, right - size[0])
+    shift_y = max(0, -top) - max(0, bottom - size[1])
+    return (max(0, left + shift_x), max(0, top + shift_y),
+            min(size[0], right + shift_x), min(size[1], bottom + shift_y))
+
+
+def region_max_edge(max_edge: int, full_size: Tuple[int, int], crop_size: Tuple[int, int]) -> int:
+    # Même densité de pixels que la photo entière réduite à max_edge : le recadrage
+    # réduit la charge utile au lieu de zoomer, sans descendre sous MIN_REGION_EDGE
+    share = max(crop_size) / max(full_size)
+    return min(max_edge, max(MIN_REGION_EDGE, round(max_edge * share)))
@@ -0,0 +1,124 @@
+"""Préparation des photos avant envoi au modèle de vision.
+
+Orientation EXIF appliquée, métadonnées supprimées, redimensionnement au
+plus grand côté configuré puis ré-encodage JPEG/WebP avec le bon type MIME.
+Avec `region`, la photo est d'abord recadrée sur la zone du visage utile
+(voir face_region) ; la photo entière est gardée si la détection hésite.
+"""
+import io
+import logging
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from face_region import VALID_REGIONS, crop_to_region, region_max_edge
+from upload_buffer import check_image_pixels, check_upload_size
+
+logger = logging.getLogger(__name__)
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+VALID_DETAILS = ("low", "high", "auto")
+
+
+@dataclass(frozen=True)
+class ImageOptions:
+    max_edge: int = 1024
+    format: str = "JPEG"
+    quality: int = 85
+    detail: str = "auto"
+    region: str = "full"
+
+    def __post_init__(self):
+        if self.format not in ("JPEG", "WEBP"):
+            raise ValueError(f"Format d'encodage non supporté: {self.format}")
+        if self.detail not in VALID_DETAILS:
+            raise ValueError(f"Niveau de détail invalide: {self.detail}")
+        if self.region not in VALID_REGIONS:
+            raise ValueError(f"Région invalide: {self.region}")
+
+    def signature(self) -> str:
+        # Entre dans la clé de cache : changer les réglages change le résultat
+        signature = f"{self.format}-{self.max_edge}-{self.quality}-{self.detail}"
+        # Sans recadrage, la signature reste celle des entrées déjà en cache
+        return signature if self.region == "full" else f"{signature}-{self.region}"
+
+
+# Aperçu affiché dans la page : la photo d'origine n'est jamais encodée en base64
+PREVIEW_OPTIONS = ImageOptions(max_edge=640, quality=80)
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    original_bytes: int
+    detail: str = "auto"
+    # Région effectivement recadrée ("full" si le visage n'a pas été trouvé)
+    region: str = "full"
+
+    @property
+    def prepared_bytes(self) -> int:
+        return len(self.data)
+
+    @property
+    def savings_ratio(self) -> float:
+        if not self.original_bytes:
+            return 0.0
+        return 1 - self.prepared_bytes / self.original_bytes
+
+
+def sniff_mime_type(image_bytes: bytes) -> str:
+    if image_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def _flatten(image: Image.Image) -> Image.Image:
+    # JPEG ne gère pas la transparence : on compose sur fond blanc
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    if image.mode != "RGB":
+        return image.convert("RGB")
+    return image
+
+
+def prepare_image(image_bytes: bytes, options: ImageOptions = ImageOptions()) -> PreparedImage:
+    original_size = len(image_bytes)
+    # UploadTooLargeError avant tout décodage : octets, puis dimensions de l'en-tête
+    check_upload_size(original_size)
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as source:
+            check_image_pixels(*source.size)
+            image = ImageOps.exif_transpose(source)
+            image = _flatten(image)
+            full_size = image.size
+            image, region = crop_to_region(image, options.region)
+    except (UnidentifiedImageError, OSError) as e:
+        # Image illisible par Pillow : on laisse le modèle trancher sur l'original
+        logger.warning("Prétraitement impossible, envoi de l'image brute: %s", e)
+        return PreparedImage(image_bytes, sniff_mime_type(image_bytes), 0, 0,
+                             original_size, options.detail)
+
+    max_edge = options.max_edge
+    if region != "full":
+        max_edge = region_max_edge(max_edge, full_size, image.size)
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    # Aucun exif/icc transmis à save() : les métadonnées sont supprimées
+    image.save(buffer, format=options.format, quality=options.quality, optimize=True)
+    prepared = PreparedImage(buffer.getvalue(), MIME_TYPES[options.format],
+                             image.width, image.height, original_size, options.detail, region)
+
+    logger.info("Image préparée: %d -> %d octets (%.0f%% économisés), %dx%d %s, région %s",
+                original_size, prepared.prepared_bytes, prepared.savings_ratio * 100,
+                prepared.width, prepared.height, prepared.mime_type, prepared.region)
+    return prepared
@@ -0,0 +1,199 @@
+"""Parseur JSON incrémental pour les réponses du modèle en streaming.
+
+Le parseur reçoit les fragments de texte au fil de l'eau et maintient l'objet
+partiel : les chaînes en cours d'écriture y apparaissent déjà, ce qui permet
+d'afficher l'analyse avant la fin de la génération. Tout ce qui précède la
+première accolade (```json par exemple) et ce qui suit la dernière est ignoré.
+"""
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+LITERAL_CHARS = set("0123456789+-.eEtruefalsn")
+
+
+def streaming_enabled() -> bool:
+    # BEAUTY_STREAMING=off revient à l'affichage en un bloc en fin d'analyse
+    return os.getenv("BEAUTY_STREAMING", "on").strip().lower() not in ("off", "0", "false", "no")
+
+
+@dataclass
+class _Frame:
+    container: Any
+    key: Optional[str] = None
+    # Clé racine dont dépend ce conteneur, pour marquer sa complétion
+    root_key: Optional[str] = None
+
+
+class IncrementalJSONParser:
+    def __init__(self):
+        self.root: Optional[Dict] = None
+        self.completed: Set[str] = set()
+        self.done = False
+        self._stack: List[_Frame] = []
+        self._string: Optional[List[str]] = None
+        self._string_is_key = False
+        self._string_slot = None
+        self._escape: Optional[str] = None
+        self._literal: Optional[List[str]] = None
+
+    def feed(self, chunk: str) -> Dict:
+        for ch in chunk:
+            self._consume(ch)
+        if self._string is not None and self._string_slot is not None:
+            container, slot = self._string_slot
+            container[slot] = "".join(self._string)
+        return self.root or {}
+
+    def _consume(self, ch: str) -> None:
+        if self.done:
+            return
+
+        if self._string is not None:
+            self._consume_string(ch)
+            return
+
+        if self._literal is not None:
+            if ch in LITERAL_CHARS:
+                self._literal.append(ch)
+                return
+            self._finish_literal()
+
+        if self.root is None:
+            if ch == "{":
+                self.root = {}
+                self._stack.append(_Frame(self.root))
+            return
+
+        if ch.isspace() or ch == ":":
+            return
+
+        frame = self._stack[-1]
+        if ch == '"':
+            self._string = []
+            self._string_is_key = isinstance(frame.container, dict) and frame.key is None
+            self._string_slot = None if self._string_is_key else self._add_value("")
+        elif ch in "{[":
+            container = {} if ch == "{" else []
+            self._add_value(container)
+            root_key = frame.key if len(self._stack) == 1 else frame.root_key
+            self._stack.append(_Frame(container, root_key=root_key))
+        elif ch in "}]":
+            closed = self._stack.pop()
+            if not self._stack:
+                self.done = True
+            elif len(self._stack) == 1 and closed.root_key is not None:
+                self.completed.add(closed.root_key)
+        elif ch == ",":
+            if isinstance(frame.container, dict):
+                frame.key = None
+        else:
+            self._literal = [ch]
+
+    def _consume_string(self, ch: str) -> None:
+        if self._escape is not None:
+            if self._escape == "":
+                if ch == "u":
+                    self._escape = "u"
+                else:
+                    self._string.append(ESCAPES.get(ch, ch))
+                    self._escape = None
+                return
+            self._escape += ch
+            if len(self._escape) == 5:
+                self._string.append(chr(int(self._escape[1:], 16)))
+                self._escape = None
+            return
+
+        if ch == "\\":
+            self._escape = ""
+        elif ch == '"':
+            value = "".join(self._string)
+            self._string = None
+            if self._string_is_key:
+                self._stack[-1].key = value
+            else:
+                container, slot = self._string_slot
+                container[slot] = value
+                self._string_slot = None
+                self._mark_completed()
+        else:
+            self._string.append(ch)
+
+    def _finish_literal(self) -> None:
+        text = "".join(self._literal)
+        self._literal = None
+        try:
+            value = json.loads(text)
+        except json.JSONDecodeError:
+            value = text
+        self._add_value(value)
+        self._mark_completed()
+
+    def _add_value(self, value: Any):
+        frame = self._stack[-1]
+        if isinstance(frame.container, dict):
+            frame.container[frame.key] = value
+            return frame.container, frame.key
+        frame.container.append(value)
+        return frame.container, len(frame.container) - 1
+
+    def _mark_completed(self) -> None:
+        if len(self._stack) == 1 and self._stack[0].key is not None:
+            self.completed.add(self._stack[0].key)
+
+
+@dataclass
+class StreamTiming:
+    first_token_s: Optional[float] = None
+    first_content_s: Optional[float] = None
+    total_s: Optional[float] = None
+    chunks: int = 0
+    # Tokens facturés, envoyés dans le dernier fragment (stream_options.include_usage)
+    usage: Optional[Any] = None
+    # "length" : réponse coupée par max_tokens
+    finish_reason: Optional[str] = None
+
+
+def stream_completion(client, request: Dict,
+                      on_update: Callable[[Dict, Set[str]], None]) -> Tuple[str, IncrementalJSONParser, StreamTiming]:
+    # Lance chat.completions en streaming et notifie l'appelant à chaque fragment
+    parser = IncrementalJSONParser()
+    timing = StreamTiming()
+    parts: List[str] = []
+    start = time.perf_counter()
+
+    stream = client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **request)
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            timing.usage = chunk.usage
+        if not chunk.choices:
+            continue
+        if chunk.choices[0].finish_reason:
+            timing.finish_reason = chunk.choices[0].finish_reason
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        if timing.first_token_s is None:
+            timing.first_token_s = time.perf_counter() - start
+        timing.chunks += 1
+        parts.append(delta)
+
+        partial = parser.feed(delta)
+        # "Contenu visible" : au moins un champ terminé ou une chaîne non vide
+        if timing.first_content_s is None and (parser.completed or any(
+                isinstance(v, str) and v for v in partial.values())):
+            timing.first_content_s = time.perf_counter() - start
+        if partial:
+            on_update(partial, parser.completed)
+
+    timing.total_s = time.perf_counter() - start
+    logger.info("Streaming: premier token %.3fs, premier contenu visible %.3fs, total %.3fs (%d fragments)",
+                timing.first_token_s or -1, timing.first_content_s or -1, timing.total_s, timing.chunks)
+    return "".join(parts), parser, timing
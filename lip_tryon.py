@@ -0,0 +1,252 @@
+"""Essayage virtuel local : les lèvres de la photo teintées avec chaque teinte.
+
+Aucun appel au modèle. Le travail coûteux est fait une fois par photo :
+
+    1. décodage (orientation EXIF, plus grand côté borné à BEAUTY_TRYON_MAX_EDGE,
+       0 pour la pleine résolution) et détection du visage (face_region) ;
+    2. masque des lèvres dans la fenêtre de la bouche, calculé sur une vignette :
+       pixels plus rouges que la peau environnante en CIELAB (a* plus haut,
+       b* plus bas), pondérés par une ellipse centrée sur la bouche, lissés,
+       puis agrandis en bilinéaire jusqu'à la pleine résolution (bord adouci) ;
+    3. niveau L* quantifié (0-255) de chaque pixel de la boîte des lèvres ;
+    4. une table par teinte : niveau L* -> RGB de la teinte, dont la clarté
+       suit celle de la lèvre d'origine (reflets et plis conservés).
+
+Seule une copie de travail réduite à la taille d'affichage
+(BEAUTY_TRYON_PREVIEW_EDGE) est gardée dans la session, avec la boîte des
+lèvres, leur masque et leurs niveaux à cette échelle, et la vignette de la
+galerie : la pleine résolution ne sert qu'à la détection et au masque.
+Changer de teinte ne coûte ensuite qu'une indexation dans la table et un
+mélange alpha limité à la boîte des lèvres, vectorisés avec NumPy, puis un
+encodage JPEG à la taille d'affichage ; les six vignettes de la galerie sont
+calculées d'un seul bloc.
+"""
+import io
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+from face_region import detect_face
+from skin_tone import hex_to_rgb, lab_to_srgb, srgb_to_lab
+from upload_buffer import UploadTooLargeError, check_image_pixels
+
+logger = logging.getLogger(__name__)
+
+TRY_ON_MAX_EDGE = int(os.getenv("BEAUTY_TRYON_MAX_EDGE", "2048"))
+# Plus grand côté de l'aperçu affiché (et de la copie gardée en session)
+PREVIEW_EDGE = int(os.getenv("BEAUTY_TRYON_PREVIEW_EDGE", "720"))
+PREVIEW_QUALITY = 85
+DEFAULT_OPACITY = 0.8
+# Côté de la vignette de la galerie, en pixels
+GALLERY_EDGE = 240
+LEVELS = 256
+# Fenêtre de la bouche, en fractions de la boîte du visage (gauche, haut, droite, bas)
+MOUTH_BOX = (0.2, 0.6, 0.8, 0.95)
+# Largeur de la vignette sur laquelle le masque est calculé
+MASK_EDGE = 160
+# Écart de rougeur (ΔE partiel) à partir duquel un pixel est une lèvre, et rampe du bord
+LIP_THRESHOLD = 5.0
+LIP_RAMP = 6.0
+# Part de la fenêtre de la bouche couverte par les lèvres
+MIN_LIP_FRACTION = 0.02
+MAX_LIP_FRACTION = 0.5
+# Part des variations de clarté de la lèvre gardées sous la teinte
+TEXTURE_GAIN = 0.7
+# Contexte autour des lèvres dans la galerie, en fraction de leur boîte
+ZOOM_MARGIN = 0.6
+
+Box = Tuple[int, int, int, int]
+
+
+def _decode(image_bytes: bytes, max_edge: int) -> np.ndarray:
+    with Image.open(io.BytesIO(image_bytes)) as source:
+        check_image_pixels(*source.size)
+        if max_edge:
+            source.draft("RGB", (max_edge, max_edge))
+        image = ImageOps.exif_transpose(source).convert("RGB")
+    if max_edge:
+        image.thumbnail((max_edge, max_edge))
+    return np.asarray(image)
+
+
+def lip_alpha(window: np.ndarray) -> Optional[np.ndarray]:
+    # Masque doux (0-1) des lèvres dans la fenêtre de la bouche, à sa résolution
+    lab = srgb_to_lab(window)
+    # La peau domine la fenêtre : sa médiane sert de référence
+    a_ref, b_ref = np.median(lab[..., 1]), np.median(lab[..., 2])
+    redness = (lab[..., 1] - a_ref) - 0.3 * (lab[..., 2] - b_ref)
+    alpha = np.clip((redness - LIP_THRESHOLD) / LIP_RAMP, 0, 1)
+    h, w = alpha.shape
+    yy, xx = np.ogrid[:h, :w]
+    r2 = ((xx - w / 2) / (0.45 * w)) ** 2 + ((yy - h / 2) / (0.4 * h)) ** 2
+    alpha *= np.clip(3 * (1 - r2), 0, 1)
+    # Fermeture : les reflets et la commissure ne trouent pas le masque
+    smooth = (Image.fromarray((alpha * 255).astype(np.uint8))
+              .filter(ImageFilter.MaxFilter(3)).filter(ImageFilter.MinFilter(3))
+              .filter(ImageFilter.GaussianBlur(1)))
+    alpha = np.asarray(smooth, dtype=np.float32) / 255
+    fraction = float((alpha > 0.5).mean())
+    if not MIN_LIP_FRACTION <= fraction <= MAX_LIP_FRACTION:
+        return None
+    return alpha
+
+
+@dataclass
+class LipTryOn:
+    rgb: np.ndarray
+    # Boîte des lèvres et boîte de la galerie (lèvres + contexte), en pixels
+    box: Box
+    zoom: Box
+    # Dans la boîte des lèvres : opacité du masque et niveau L* quantifié
+    alpha: np.ndarray
+    levels: np.ndarray
+    names: List[str]
+    # (teintes, LEVELS, 3) : RGB float de chaque teinte par niveau L*
+    luts: np.ndarray
+    elapsed_ms: float = 0.0
+    # Zone de la bouche réduite pour la galerie, calculée au premier affichage
+    _thumbnail: Optional["LipTryOn"] = field(default=None, repr=False)
+
+    def _blend(self, patch: np.ndarray, shades: np.ndarray, opacity: float) -> np.ndarray:
+        # patch : (..., h, w, 3) float32 de la boîte des lèvres ; shades : indices de teintes
+        tint = self.luts[shades][..., self.levels, :]
+        a = (self.alpha * opacity)[..., None]
+        return patch + (tint - patch) * a
+
+    def render(self, shade: str, opacity: float = DEFAULT_OPACITY) -> np.ndarray:
+        # Photo entière avec une teinte ; seule la boîte des lèvres est recalculée
+        left, top, right, bottom = self.box
+        out = self.rgb.copy()
+        patch = out[top:bottom, left:right].astype(np.float32)
+        blended = self._blend(patch, np.array(self.names.index(shade)), opacity)
+        out[top:bottom, left:right] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+        return out
+
+    def render_jpeg(self, shade: str, opacity: float = DEFAULT_OPACITY,
+                    quality: int = PREVIEW_QUALITY) -> bytes:
+        # Aperçu encodé une fois, à la taille de la copie de travail (taille d'affichage)
+        buffer = io.BytesIO()
+        Image.fromarray(self.render(shade, opacity)).save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
+
+    def scaled(self, region: Box, edge: int) -> "LipTryOn":
+        # Région réduite (ou agrandie) à edge, masque et niveaux compris
+        zl, zt, zr, zb = region
+        left, top, right, bottom = self.box
+        scale = edge / max(zr - zl, zb - zt)
+        size = (max(1, round((zr - zl) * scale)), max(1, round((zb - zt) * scale)))
+        rgb = np.asarray(Image.fromarray(self.rgb[zt:zb, zl:zr]).resize(size, Image.LANCZOS))
+        box = (round((left - zl) * scale), round((top - zt) * scale),
+               max(round((right - zl) * scale), round((left - zl) * scale) + 1),
+               max(round((bottom - zt) * scale), round((top - zt) * scale) + 1))
+        alpha = np.asarray(Image.fromarray(self.alpha).resize((box[2] - box[0], box[3] - box[1]),
+                                                               Image.BILINEAR))
+        zoom = _expand(box, ZOOM_MARGIN, size)
+        return LipTryOn(rgb=rgb, box=box, zoom=zoom, alpha=alpha,
+                        levels=_levels(rgb[box[1]:box[3], box[0]:box[2]]),
+                        names=self.names, luts=self.luts, elapsed_ms=self.elapsed_ms)
+
+    def thumbnail(self, edge: int = GALLERY_EDGE) -> "LipTryOn":
+        # Boîte de la galerie réduite à edge : la galerie ne touche jamais la grande image
+        if self._thumbnail is None or max(self._thumbnail.rgb.shape[:2]) != edge:
+            self._thumbnail = self.scaled(self.zoom, edge)
+        return self._thumbnail
+
+    def gallery(self, opacity: float = DEFAULT_OPACITY, edge: int = GALLERY_EDGE) -> Dict[str, np.ndarray]:
+        # Toutes les teintes d'un seul bloc sur la vignette : (teintes, h, w, 3)
+        small = self.thumbnail(edge)
+        left, top, right, bottom = small.box
+        crops = np.repeat(small.rgb[None], len(self.names), axis=0)
+        lips = crops[:, top:bottom, left:right].astype(np.float32)
+        blended = small._blend(lips, np.arange(len(self.names)), opacity)
+        crops[:, top:bottom, left:right] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+        return dict(zip(self.names, crops))
+
+
+def shade_luts(shades: Mapping[str, str], lip_lightness: float) -> np.ndarray:
+    # Clarté de la teinte + variations de la lèvre autour de sa clarté moyenne
+    lightness = np.arange(LEVELS) * 100 / (LEVELS - 1)
+    luts = []
+    for color in shades.values():
+        L, a, b = srgb_to_lab(hex_to_rgb(color))
+        lab = np.stack([np.clip(L + TEXTURE_GAIN * (lightness - lip_lightness), 0, 100),
+                        np.full(LEVELS, a), np.full(LEVELS, b)], axis=-1)
+        luts.append(lab_to_srgb(lab))
+    return np.stack(luts).astype(np.float32)
+
+
+def _levels(rgb: np.ndarray) -> np.ndarray:
+    # Clarté L* quantifiée sur LEVELS niveaux : l'index des tables de teintes
+    lightness = srgb_to_lab(rgb)[..., 0]
+    return np.clip(np.rint(lightness * (LEVELS - 1) / 100), 0, LEVELS - 1).astype(np.uint8)
+
+
+def _expand(box: Box, margin: float, size: Tuple[int, int]) -> Box:
+    # Même marge sur les deux axes, proportionnelle à la largeur de la bouche
+    left, top, right, bottom = box
+    mx = my = int(margin * (right - left))
+    return max(0, left - mx), max(0, top - my), min(size[0], right + mx), min(size[1], bottom + my)
+
+
+def prepare_try_on(image_bytes: bytes, shades: Mapping[str, str],
+                   max_edge: int = TRY_ON_MAX_EDGE,
+                   preview_edge: int = PREVIEW_EDGE) -> Optional[LipTryOn]:
+    # None si la photo est illisible ou si les lèvres ne sont pas trouvées avec certitude ;
+    # le résultat ne garde que la copie réduite à preview_edge et la vignette de la galerie
+    start = time.perf_counter()
+    try:
+        rgb = _decode(image_bytes, max_edge)
+    except (OSError, UploadTooLargeError):
+        return None
+    height, width = rgb.shape[:2]
+    face = detect_face(Image.fromarray(rgb))
+    if face is None:
+        logger.info("Visage non détecté : essayage virtuel indisponible")
+        return None
+
+    fw, fh = face.right - face.left, face.bottom - face.top
+    ml, mt, mr, mb = MOUTH_BOX
+    window = (int((face.left + ml * fw) * width), int((face.top + mt * fh) * height),
+              min(width, int((face.left + mr * fw) * width)), min(height, int((face.top + mb * fh) * height)))
+    wl, wt, wr, wb = window
+    if wr - wl < 8 or wb - wt < 8:
+        return None
+    thumb = Image.fromarray(rgb[wt:wb, wl:wr])
+    thumb.thumbnail((MASK_EDGE, MASK_EDGE))
+    small = lip_alpha(np.asarray(thumb))
+    if small is None:
+        logger.info("Lèvres non détectées avec certitude : essayage virtuel indisponible")
+        return None
+
+    # Masque ramené à la pleine résolution de la fenêtre : le bilinéaire adoucit le bord
+    alpha = np.asarray(Image.fromarray(small).resize((wr - wl, wb - wt), Image.BILINEAR))
+    ys, xs = np.nonzero(alpha > 0.02)
+    box = (wl + int(xs.min()), wt + int(ys.min()), wl + int(xs.max()) + 1, wt + int(ys.max()) + 1)
+    left, top, right, bottom = box
+    alpha = np.ascontiguousarray(alpha[top - wt:bottom - wt, left - wl:right - wl], dtype=np.float32)
+
+    levels = _levels(rgb[top:bottom, left:right])
+    lip_lightness = float(np.average(levels, weights=alpha + 1e-6)) * 100 / (LEVELS - 1)
+
+    full = LipTryOn(
+        rgb=rgb,
+        box=box,
+        zoom=_expand(box, ZOOM_MARGIN, (width, height)),
+        alpha=alpha,
+        levels=levels,
+        names=list(shades),
+        luts=shade_luts(shades, lip_lightness),
+    )
+    # Vignette tirée de la grande image avant de la lâcher : la bouche y reste nette
+    thumbnail = full.thumbnail()
+    preview = full
+    if preview_edge and max(width, height) > preview_edge:
+        preview = full.scaled((0, 0, width, height), preview_edge)
+    preview._thumbnail = thumbnail
+    preview.elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+    return preview
@@ -1,7 +1,8 @@
 import base64
+import logging
 import os
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional, Set, Tuple, TypedDict
 import json
 import re
 
@@ -9,6 +10,32 @@ import streamlit as st
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from analysis_pool import Job, PoolFullError, get_analysis_pool
+from cascade import CONFIDENCE_PROPERTY, Tier, cascade_enabled_by_env, escalation_reason
+from image_prep import PREVIEW_OPTIONS, ImageOptions, PreparedImage, prepare_image
+from json_stream import StreamTiming, stream_completion, streaming_enabled
+from lip_tryon import DEFAULT_OPACITY, prepare_try_on
+from metrics import AnalysisTrace, start_exporter, start_trace, timed
+from multi_photo import (MAX_SESSION_PHOTOS, check_session, photo_key, session_cache_key,
+                         session_content, session_max_tokens, session_result, session_schema,
+                         split_session)
+from openai_client import get_openai_client, start_warm_up
+from rate_limiter import RateLimitExceeded, estimate_request_tokens
+from resilience import CircuitOpenError, ResilientCaller, get_resilient_caller, latency_class
+from near_duplicate import NearDuplicateIndex, get_near_duplicate_index
+from result_cache import ResultCache, cache_namespace, get_result_cache, make_cache_key
+from session_memo import (RETRY_OUTCOMES, SessionMemo, claim_speculation, poll_job,
+                          start_speculation)
+from single_flight import SingleFlight, get_single_flight
+from skin_tone import SkinToneAnalyzer, SkinToneEstimate
+from structured_output import (SchemaValidationError, enum_property, json_schema_format,
+                               repair_enum, strict_object)
+from upload_buffer import MAX_UPLOAD_BYTES, UploadTooLargeError, upload_bytes
+
+logger = logging.getLogger(__name__)
+
+DEGRADED_NOTICE = "Service d'analyse momentanément indisponible : résultat simplifié."
+
 # Configuration des couleurs de rouge à lèvres avec leurs codes hex
 LIPSTICK_COLORS = {
     'Ruby': '#932432',
@@ -19,45 +46,20 @@ LIPSTICK_COLORS = {
     'Soft Coral': '#DB8075'
 }
 
-class LipstickAnalyzer:
-    def __init__(self):
-        # load_dotenv()
-        # self.api_key = os.getenv("OPENAI_API_KEY")
-        # self.client = OpenAI()
-        self.api_key = st.secrets["OPENAI_API_KEY"]
-        self.client = OpenAI()
+class LipstickResult(TypedDict):
+    chosen_color: str
+    analysis: str
 
-    def _encode_image(self, image_bytes: bytes) -> str:
-        return base64.b64encode(image_bytes).decode("utf-8")
+# Schéma imposé au modèle : la teinte ne peut être qu'une clé de LIPSTICK_COLORS
+LIPSTICK_SCHEMA = strict_object({
+    "chosen_color": enum_property(LIPSTICK_COLORS),
+    "analysis": {"type": "string"},
+    "confidence": CONFIDENCE_PROPERTY
+})
 
-    def _clean_response(self, response: str) -> Dict:
-        # Supprimer les balises code et json
-        cleaned = re.sub(r'```json\s*|\s*```', '', response)
-        try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError:
-            return {
-                "chosen_color": "Ruby",
-                "analysis": "Désolé, une erreur s'est produite pendant l'analyse."
-            }
+SYSTEM_PROMPT = "Tu es une conseillère beauté experte et amicale. Tu dois analyser les photos et suggérer le meilleur rouge à lèvres. Ta réponse doit TOUJOURS être en JSON valide."
 
-    def analyze_image(self, image_bytes: bytes) -> Optional[Dict]:
-        try:
-            base64_image = self._encode_image(image_bytes)
-            
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Tu es une conseillère beauté experte et amicale. Tu dois analyser les photos et suggérer le meilleur rouge à lèvres. Ta réponse doit TOUJOURS être en JSON valide."
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": """Analyse cette photo et suggère la meilleure teinte de rouge à lèvres parmi ces options uniquement:
+ANALYSIS_PROMPT = """Analyse cette photo et suggère la meilleure teinte de rouge à lèvres parmi ces options uniquement:
                                 - Ruby (rouge classique)
                                 - Terracotta (orangé nude)
                                 - Dusty Rose (rose naturel)
@@ -66,31 +68,588 @@ class LipstickAnalyzer:
                                 - Soft Coral (corail doux)
                                 
                                 Tu DOIS répondre EXACTEMENT dans ce format JSON :
-                                {"chosen_color": "EXACTEMENT UN DES NOMS CI-DESSUS", "analysis": "Ton analyse friendly en français qui commence par Hey beauty! ou Coucou beauté!"}"""
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=150
-            )
-            
-            response_content = response.choices[0].message.content
-            return self._clean_response(response_content)
-            
-        except Exception as e:
-            st.error(f"Erreur d'analyse: {str(e)}")
-            return {
-                "chosen_color": "Ruby",
-                "analysis": "Désolé, une erreur s'est produite pendant l'analyse. Veuillez réessayer."
+                                {"chosen_color": "EXACTEMENT UN DES NOMS CI-DESSUS", "analysis": "Ton analyse friendly en français qui commence par Hey beauty! ou Coucou beauté!", "confidence": NOMBRE ENTRE 0 ET 1}"""
+
+class LipstickAnalyzer:
+    MODEL = "gpt-4o-mini"
+    MAX_TOKENS = 150
+    # À incrémenter à chaque modification du prompt pour invalider le cache
+    PROMPT_VERSION = "lipstick-v3"
+    # Recadrage sur le bas du visage : lèvres et joues suffisent (teint + bouche)
+    IMAGE_OPTIONS = ImageOptions(max_edge=768, detail="low", region="lips")
+    # La requête par défaut est déjà la passe rapide ; la cascade ne relance en
+    # détail "high" que les réponses peu sûres
+    ESCALATION_IMAGE_OPTIONS = ImageOptions(max_edge=1024, detail="high", region="lips")
+    # Analyse locale du teint : "off", "provisional" (teinte instantanée en attendant
+    # le modèle) ou "skip" (pas d'appel API si la confiance locale suffit)
+    LOCAL_MODE = os.getenv("LIPSTICK_LOCAL_MODE", "provisional")
+    LOCAL_CONFIDENCE_THRESHOLD = float(os.getenv("LIPSTICK_LOCAL_THRESHOLD", "0.85"))
+
+    def __init__(self, cache: Optional[ResultCache] = None,
+                 image_options: Optional[ImageOptions] = None,
+                 client: Optional[OpenAI] = None,
+                 single_flight: Optional[SingleFlight] = None,
+                 resilience: Optional[ResilientCaller] = None,
+                 near_index: Optional[NearDuplicateIndex] = None,
+                 cascade: Optional[bool] = None):
+        try:
+            self.api_key = st.secrets["OPENAI_API_KEY"]
+        except Exception:
+            # Hors Streamlit (batch, service) : variables d'environnement / .env
+            load_dotenv()
+            self.api_key = os.getenv("OPENAI_API_KEY")
+        # Client partagé par tout le processus : pas de nouvelle connexion par clic
+        self.client = client or get_openai_client(self.api_key)
+        self.cache = cache if cache is not None else get_result_cache()
+        self.single_flight = single_flight if single_flight is not None else get_single_flight()
+        self.resilience = resilience if resilience is not None else get_resilient_caller()
+        self.near_index = near_index if near_index is not None else get_near_duplicate_index()
+        self.image_options = image_options or self.IMAGE_OPTIONS
+        self.cascade = cascade_enabled_by_env() if cascade is None else cascade
+        self.last_prepared: Optional[PreparedImage] = None
+        self.last_stream_timing: Optional[StreamTiming] = None
+        self.last_trace: Optional[AnalysisTrace] = None
+        # (niveau, message) pour la page : l'analyse tourne dans un worker, où st.* ne s'affiche pas
+        self.last_notice: Optional[Tuple[str, str]] = None
+        self.local_analyzer = SkinToneAnalyzer(LIPSTICK_COLORS)
+        self.last_local_estimate: Optional[SkinToneEstimate] = None
+
+    def tiers(self) -> List[Tier]:
+        if not self.cascade:
+            return [Tier("full", self.image_options, self.MAX_TOKENS)]
+        return [Tier("fast", self.image_options, self.MAX_TOKENS),
+                Tier("full", self.ESCALATION_IMAGE_OPTIONS, self.MAX_TOKENS)]
+
+    def _prepare_image(self, image_bytes: bytes, options: Optional[ImageOptions] = None) -> PreparedImage:
+        # Réduit la photo avant l'upload : le modèle la redimensionne de toute façon
+        prepared = prepare_image(image_bytes, options or self.image_options)
+        self.last_prepared = prepared
+        return prepared
+
+    def _encode_image(self, image_bytes: bytes) -> str:
+        return base64.b64encode(image_bytes).decode("utf-8")
+
+    def _fallback_result(self, analysis: str) -> LipstickResult:
+        return {
+            "chosen_color": "Ruby",
+            "analysis": analysis
+        }
+
+    def estimate_locally(self, image_bytes: bytes) -> Optional[SkinToneEstimate]:
+        if self.LOCAL_MODE == "off":
+            return None
+        estimate = self.local_analyzer.analyze(image_bytes)
+        self.last_local_estimate = estimate
+        return estimate
+
+    def _local_result(self, image_bytes: bytes) -> Optional[LipstickResult]:
+        # En mode "skip", une estimation locale assez sûre remplace l'appel au modèle
+        if self.LOCAL_MODE != "skip":
+            return None
+        estimate = self.estimate_locally(image_bytes)
+        if estimate is None or estimate.confidence < self.LOCAL_CONFIDENCE_THRESHOLD:
+            return None
+        return self._estimate_result(estimate)
+
+    def _degraded_result(self, image_bytes: bytes) -> LipstickResult:
+        # Disjoncteur ouvert : l'estimation locale remplace le modèle, quelle que soit sa confiance
+        estimate = self.local_analyzer.analyze(image_bytes)
+        if estimate is None:
+            return self._fallback_result("Notre service d'analyse est momentanément surchargé. Veuillez réessayer dans quelques instants.")
+        self.last_local_estimate = estimate
+        return self._estimate_result(estimate)
+
+    def _estimate_result(self, estimate: SkinToneEstimate) -> LipstickResult:
+        return {
+            "chosen_color": estimate.chosen_color,
+            "analysis": f"Coucou beauté! Avec ta carnation {estimate.depth} et ton sous-ton {estimate.undertone}, "
+                        f"la teinte {estimate.chosen_color} est celle qui s'accorde le mieux avec ton teint : "
+                        f"elle illuminera ton visage tout en restant parfaitement harmonieuse."
+        }
+
+    def _validate(self, data) -> LipstickResult:
+        if not isinstance(data, dict):
+            raise SchemaValidationError("La réponse n'est pas un objet JSON")
+        repairs = []
+        repair_enum(data, "chosen_color", LIPSTICK_COLORS, repairs)
+        analysis = data.get("analysis")
+        if not isinstance(analysis, str) or not analysis.strip():
+            raise SchemaValidationError("analysis manquante ou vide")
+        if repairs:
+            logger.warning("Réponse réparée localement: %s", "; ".join(repairs))
+        return {"chosen_color": data["chosen_color"], "analysis": analysis}
+
+    def _load_response(self, response: str):
+        # Supprimer les balises code et json (réponses antérieures au schéma strict)
+        return json.loads(re.sub(r'```json\s*|\s*```', '', response))
+
+    def _parse_response(self, response: str) -> LipstickResult:
+        return self._validate(self._load_response(response))
+
+    def _parse_tier(self, response: str, finish_reason: Optional[str]) -> Tuple[Optional[LipstickResult], Optional[str]]:
+        # (résultat validé ou None, raison d'escalader ou None)
+        try:
+            data = self._load_response(response)
+            confidence = data.get("confidence") if isinstance(data, dict) else None
+            result = self._validate(data)
+        except ValueError:
+            return None, escalation_reason(None, finish_reason)
+        return result, escalation_reason({"confidence": confidence}, finish_reason)
+
+    def _clean_response(self, response: str) -> LipstickResult:
+        try:
+            return self._parse_response(response)
+        except ValueError:
+            return self._fallback_result("Désolé, une erreur s'est produite pendant l'analyse.")
+
+    def _prompt_version(self) -> str:
+        # Toutes les passes de la cascade entrent dans la clé : un résultat rapide
+        # n'est pas servi à une configuration sans cascade
+        return "|".join([self.PROMPT_VERSION] + [t.signature() for t in self.tiers()])
+
+    def cache_key(self, image_bytes: bytes) -> str:
+        return make_cache_key(image_bytes, "lipstick", self.MODEL,
+                              self._prompt_version(), self.MAX_TOKENS)
+
+    def _single_pass_version(self) -> str:
+        # Une seule requête aux options d'image de l'analyseur, sans cascade ni pipeline
+        # en deux temps (sessions multi-photos, batch_analyze, bulk_analyze) : ces
+        # réglages n'entrent pas dans la clé
+        return f"{self.PROMPT_VERSION}|{self.image_options.signature()}"
+
+    def batch_cache_key(self, image_bytes: bytes) -> str:
+        return make_cache_key(image_bytes, "lipstick-batch", self.MODEL,
+                              self._single_pass_version(), self.MAX_TOKENS)
+
+    def batch_namespace(self) -> str:
+        return cache_namespace("lipstick-batch", self.MODEL, self._single_pass_version(), self.MAX_TOKENS)
+
+    def result_namespace(self) -> str:
+        # Partition de l'index des quasi-doublons : mêmes paramètres que la clé de cache
+        return cache_namespace("lipstick", self.MODEL, self._prompt_version(), self.MAX_TOKENS)
+
+    def build_request(self, prepared: PreparedImage, max_tokens: Optional[int] = None) -> Dict:
+        # Paramètres chat.completions, réutilisés par le mode batch
+        return {
+            "model": self.MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": ANALYSIS_PROMPT
+                        },
+                        self._image_part(prepared)
+                    ]
+                }
+            ],
+            "max_tokens": max_tokens or self.MAX_TOKENS,
+            "response_format": json_schema_format("lipstick_recommendation", LIPSTICK_SCHEMA)
+        }
+
+    def _image_part(self, prepared: PreparedImage) -> Dict:
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{prepared.mime_type};base64,{self._encode_image(prepared.data)}",
+                "detail": prepared.detail
             }
+        }
+
+    def build_session_request(self, prepared: List[PreparedImage], mode: str) -> Dict:
+        # Toutes les photos d'une session dans un seul message : prompt système et
+        # consignes payés une fois pour toutes
+        return {
+            "model": self.MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": session_content(
+                    ANALYSIS_PROMPT, [self._image_part(p) for p in prepared], mode)}
+            ],
+            "max_tokens": session_max_tokens(self.MAX_TOKENS, len(prepared), mode),
+            "response_format": json_schema_format(
+                f"lipstick_session_{mode}", session_schema(LIPSTICK_SCHEMA, len(prepared), mode))
+        }
+
+    def _request_model(self, image_bytes: bytes, cache_key: str, use_cache: bool,
+                       on_update: Optional[Callable[[Dict, Set[str]], None]],
+                       trace: AnalysisTrace, fingerprint: Optional[int] = None) -> LipstickResult:
+        # Exécuté une seule fois par clé en cours : les exceptions remontent à tous les appelants
+        if use_cache:
+            # L'appel précédent pour cette clé a pu se terminer entre-temps
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                trace.outcome = "cache_hit"
+                return cached
+
+        # Cascade : détail "low", puis "high" si la réponse est invalide, tronquée
+        # ou peu sûre ; la dernière passe est acceptée telle quelle
+        tiers = self.tiers()
+        for i, tier in enumerate(tiers):
+            last = i == len(tiers) - 1
+            with trace.tier(tier.name) as record:
+                with trace.stage("prepare"):
+                    prepared = self._prepare_image(image_bytes, tier.image_options)
+                with trace.stage("encode"):
+                    request = self.build_request(prepared, tier.max_tokens)
+                trace.payload_bytes += len(json.dumps(request))
+                with trace.stage("model"):
+                    response_content, finish_reason = self._call_model(request, on_update, trace)
+                trace.outcome = "model"
+                with trace.stage("parse"):
+                    result, reason = self._parse_tier(response_content, finish_reason)
+                if last or reason is None:
+                    break
+                record.update(decision="escalated", reason=reason)
+                logger.info("Passe %s insuffisante (%s) : escalade", tier.name, reason)
+
+        if result is None:
+            # Réponse inexploitable : ni cache ni résultat définitif, un nouveau clic relance
+            trace.outcome = "error"
+            return self._clean_response(response_content)
+
+        if use_cache:
+            self.cache.set(cache_key, result)
+            if fingerprint is not None:
+                self.near_index.add(self.result_namespace(), fingerprint, cache_key)
+        return result
+
+    def _call_model(self, request: Dict, on_update: Optional[Callable[[Dict, Set[str]], None]],
+                    trace: AnalysisTrace) -> Tuple[str, Optional[str]]:
+        # Échéance par tentative, relances sur 429/5xx, disjoncteur partagé
+        if on_update is None:
+            response = self.resilience.call(
+                lambda timeout: self.client.with_options(timeout=timeout).chat.completions.create(**request),
+                hedge=True, tokens=estimate_request_tokens(request),
+                request_class=latency_class("lipstick", request))
+            trace.add_usage(response.usage)
+            return response.choices[0].message.content, response.choices[0].finish_reason
+        # Pas de hedging en streaming : deux flux se disputeraient l'affichage
+        response_content, _, timing = self.resilience.call(
+            lambda timeout: stream_completion(self.client.with_options(timeout=timeout), request, on_update),
+            tokens=estimate_request_tokens(request))
+        self.last_stream_timing = timing
+        trace.add_usage(timing.usage)
+        if timing.first_token_s is not None:
+            # Premier token de la première passe : celui que voit l'utilisateur
+            trace.stages.setdefault("first_token", timing.first_token_s)
+        if timing.first_content_s is not None:
+            # Premier champ lisible à l'écran : la latence perçue, exportée avec les étapes
+            trace.stages.setdefault("first_content", timing.first_content_s)
+        return response_content, timing.finish_reason
+
+    def _analyze(self, image_bytes: bytes, use_cache: bool,
+                 on_update: Optional[Callable[[Dict, Set[str]], None]] = None) -> LipstickResult:
+        with start_trace("lipstick", self.MODEL) as trace:
+            self.last_trace = trace
+            self.last_notice = None
+            cache_key = self.cache_key(image_bytes)
+            if use_cache:
+                with trace.stage("cache"):
+                    cached = self.cache.get(cache_key)
+                if cached is not None:
+                    trace.outcome = "cache_hit"
+                    return cached
+
+            fingerprint = None
+            if use_cache:
+                # Même photo recadrée ou recompressée : résultat d'une image quasi identique
+                with trace.stage("phash"):
+                    near, fingerprint = self.near_index.find(self.cache, self.result_namespace(), image_bytes)
+                if near is not None:
+                    trace.outcome = "near_hit"
+                    return near
+
+            local = self._local_result(image_bytes)
+            if local is not None:
+                trace.outcome = "local"
+                return local
+
+            try:
+                # Même photo déjà en cours d'analyse dans une autre session : on partage l'appel ;
+                # les sessions en attente reçoivent le résultat complet d'un coup
+                result, shared = self.single_flight.do(
+                    cache_key, lambda: self._request_model(image_bytes, cache_key, use_cache, on_update,
+                                                  trace, fingerprint))
+                if shared:
+                    trace.outcome = "coalesced"
+                return result
+
+            except (CircuitOpenError, RateLimitExceeded):
+                # API indisponible ou débit saturé : réponse locale immédiate plutôt qu'une erreur
+                trace.outcome = "degraded"
+                self.last_notice = ("warning", DEGRADED_NOTICE)
+                return self._degraded_result(image_bytes)
+            except Exception as e:
+                trace.outcome = "error"
+                logger.warning("Analyse en échec: %s", e)
+                self.last_notice = ("error", f"Erreur d'analyse: {str(e)}")
+                return self._fallback_result("Désolé, une erreur s'est produite pendant l'analyse. Veuillez réessayer.")
+
+    def analyze_image(self, image_bytes: bytes, use_cache: bool = True) -> Optional[LipstickResult]:
+        return self._analyze(image_bytes, use_cache)
+
+    def analyze_image_stream(self, image_bytes: bytes,
+                             on_update: Callable[[Dict, Set[str]], None],
+                             use_cache: bool = True) -> Optional[LipstickResult]:
+        # Variante streaming : on_update(résultat partiel, clés terminées) à chaque
+        # fragment ; l'appelant affiche ensuite le résultat complet retourné
+        return self._analyze(image_bytes, use_cache, on_update)
+
+    def _request_session(self, images: List[bytes], mode: str, cache_key: str,
+                         use_cache: bool, trace: AnalysisTrace) -> Dict:
+        if use_cache:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                trace.outcome = "cache_hit"
+                return cached
+        # Une seule requête aux options complètes : pas de cascade pour une session
+        options = self.image_options
+        with trace.tier("session") as record:
+            record["photos"] = len(images)
+            with trace.stage("prepare"):
+                prepared = [self._prepare_image(image, options) for image in images]
+            with trace.stage("encode"):
+                request = self.build_session_request(prepared, mode)
+            trace.payload_bytes += len(json.dumps(request))
+            with trace.stage("model"):
+                response_content, finish_reason = self._call_model(request, None, trace)
+            trace.outcome = "model"
+            with trace.stage("parse"):
+                try:
+                    results, invalid = split_session(self._load_response(response_content),
+                                                     len(images), mode, self._validate)
+                except ValueError:
+                    results, invalid = {}, ["session"]
+        result = session_result(results, len(images), mode, lambda i: self._fallback_result(
+            "Désolé, une erreur s'est produite pendant l'analyse de cette photo."))
+        # Session incomplète ou tronquée : rien en cache, un nouvel essai repart du modèle
+        if invalid or finish_reason == "length":
+            trace.outcome = "incomplete"
+        elif use_cache:
+            self.cache.set(cache_key, result)
+        return result
+
+    def analyze_session(self, images: List[bytes], mode: str = "per_photo",
+                        use_cache: bool = True) -> Dict:
+        # Plusieurs photos en une requête : {"photo_1": résultat, ...} en mode
+        # per_photo, un seul résultat en mode consensus
+        check_session(images, mode)
+        if len(images) == 1:
+            # Une seule photo : l'analyse classique, avec sa cascade et son cache
+            result = self.analyze_image(images[0], use_cache)
+            return result if mode == "consensus" else {photo_key(0): result}
+        with start_trace("lipstick", self.MODEL) as trace:
+            self.last_trace = trace
+            self.last_notice = None
+            cache_key = session_cache_key(images, "lipstick", self.MODEL, self._single_pass_version(),
+                                          self.MAX_TOKENS, mode)
+            if use_cache:
+                with trace.stage("cache"):
+                    cached = self.cache.get(cache_key)
+                if cached is not None:
+                    trace.outcome = "cache_hit"
+                    return cached
+            try:
+                result, shared = self.single_flight.do(
+                    cache_key, lambda: self._request_session(images, mode, cache_key, use_cache, trace))
+                if shared:
+                    trace.outcome = "coalesced"
+                return result
+            except (CircuitOpenError, RateLimitExceeded):
+                trace.outcome = "degraded"
+                self.last_notice = ("warning", DEGRADED_NOTICE)
+                return session_result({}, len(images), mode,
+                                      lambda i: self._degraded_result(images[i or 0]))
+            except Exception as e:
+                trace.outcome = "error"
+                logger.warning("Analyse en échec: %s", e)
+                self.last_notice = ("error", f"Erreur d'analyse: {str(e)}")
+                return session_result({}, len(images), mode, lambda i: self._fallback_result(
+                    "Désolé, une erreur s'est produite pendant l'analyse. Veuillez réessayer."))
+
+def render_palette(chosen_color: Optional[str]) -> None:
+    # Grille des couleurs améliorée
+    col1, col2, col3 = st.columns(3)
+    cols = [col1, col2, col3]
+    for idx, (name, color) in enumerate(LIPSTICK_COLORS.items()):
+        with cols[idx % 3]:
+            st.markdown(f"""
+                <div style="text-align: center;">
+                    <div class="color-box {'selected-color-box' if name == chosen_color else ''}" 
+                         style="background-color: {color};">
+                    </div>
+                    <div class="color-name">{name}</div>
+                </div>
+            """, unsafe_allow_html=True)
+
+def analysis_html(analysis: str) -> str:
+    return f'<div class="analysis-text">{analysis}</div>'
+
+def final_choice_html(chosen_color: str) -> str:
+    # Choix final
+    return f"""
+        <div class="final-choice">
+            <div class="color-indicator" 
+                 style="background-color: {LIPSTICK_COLORS[chosen_color]};">
+            </div>
+            <strong>Votre Teinte Idéale:</strong> {chosen_color}
+        </div>
+    """
+
+def preview_html(image_bytes: bytes) -> str:
+    # Vignette ré-encodée : quelques dizaines de Ko en base64 au lieu de la photo entière
+    preview = prepare_image(image_bytes, PREVIEW_OPTIONS)
+    return f'<img src="data:{preview.mime_type};base64,{base64.b64encode(preview.data).decode()}" class="uploaded-image" style="width:100%">'
+
+def try_on_panel(memo: SessionMemo, images: List[bytes]) -> None:
+    # Essayage local : masque et tables calculés une fois par photo, puis chaque
+    # changement de teinte ou d'intensité ne refait qu'un mélange sur les lèvres ;
+    # la session ne garde que la copie réduite à la taille d'affichage
+    st.markdown('<h2 class="analysis-title">Essayage Virtuel</h2>', unsafe_allow_html=True)
+    index = 0
+    if len(images) > 1:
+        index = st.selectbox("Photo essayée", range(len(images)), format_func=lambda i: f"Photo {i + 1}")
+    with memo.measure("try_on"):
+        try_on = memo.cached(f"try_on:{index}", lambda: prepare_try_on(images[index], LIPSTICK_COLORS))
+    if try_on is None:
+        st.info("Lèvres non détectées avec certitude : essayage virtuel indisponible pour cette photo.")
+        return
+
+    opacity = st.slider("Intensité", 0.3, 1.0, DEFAULT_OPACITY, 0.05)
+    gallery = memo.get("try_on_gallery")
+    if gallery is None or gallery[:2] != (index, opacity):
+        gallery = (index, opacity, try_on.gallery(opacity))
+        memo.set("try_on_gallery", gallery)
+    for col, (name, thumb) in zip(st.columns(len(LIPSTICK_COLORS)), gallery[2].items()):
+        with col:
+            st.image(thumb, caption=name)
+
+    # Teinte recommandée présélectionnée une fois l'analyse terminée
+    names = list(LIPSTICK_COLORS)
+    result = memo.get("result")
+    chosen = result.get("chosen_color") if result else None
+    shade = st.radio("Teinte essayée", names, index=names.index(chosen) if chosen in names else 0,
+                     horizontal=True)
+    # Aperçu déjà à la taille d'affichage : encodé une fois par teinte et intensité
+    preview = memo.get("try_on_preview")
+    if preview is None or preview[:3] != (index, shade, opacity):
+        preview = (index, shade, opacity, try_on.render_jpeg(shade, opacity))
+        memo.set("try_on_preview", preview)
+    st.image(preview[3], caption=shade)
+
+def render_result(result: Dict, completed: Set[str], palette_slot,
+                  analysis_slot, final_choice_slot) -> Dict[str, str]:
+    # Dessine un résultat partiel ou final ; retourne le HTML écrit par emplacement
+    fragments = {}
+    chosen_color = result.get("chosen_color") if "chosen_color" in completed else None
+    if chosen_color not in LIPSTICK_COLORS:
+        # Teinte pas encore validée : elle sera réparée dans le résultat final
+        chosen_color = None
+    with palette_slot.container():
+        render_palette(chosen_color)
+    if chosen_color:
+        fragments["final_choice"] = final_choice_html(chosen_color)
+        final_choice_slot.markdown(fragments["final_choice"], unsafe_allow_html=True)
+
+    analysis = result.get("analysis")
+    if analysis:
+        # Affichage de l'analyse sans formatage JSON
+        fragments["analysis"] = analysis_html(analysis)
+        analysis_slot.markdown(fragments["analysis"], unsafe_allow_html=True)
+    return fragments
+
+def analysis_job(job: Job, image_bytes: bytes) -> Optional[LipstickResult]:
+    # Exécuté dans un worker du pool : pas d'affichage ici, la page relit job.progress()
+    analyzer = LipstickAnalyzer()
+    if analyzer.LOCAL_MODE == "provisional":
+        # Teinte provisoire calculée localement en quelques millisecondes
+        estimate = analyzer.estimate_locally(image_bytes)
+        if estimate:
+            job.update({"chosen_color": estimate.chosen_color}, {"chosen_color"})
+    if streaming_enabled():
+        result = analyzer.analyze_image_stream(image_bytes, job.update)
+    else:
+        result = analyzer.analyze_image(image_bytes)
+    job.report(analyzer.last_trace.outcome if analyzer.last_trace else "model", analyzer.last_notice)
+    return result
+
+def session_job(job: Job, images: List[bytes]) -> Optional[LipstickResult]:
+    # Plusieurs photos : une seule requête, teinte commune à tous les angles
+    analyzer = LipstickAnalyzer()
+    result = analyzer.analyze_session(images, mode="consensus")
+    job.report(analyzer.last_trace.outcome if analyzer.last_trace else "model", analyzer.last_notice)
+    return result
+
+def results_panel(memo: SessionMemo) -> None:
+    st.markdown('<h1 class="main-title">Votre Palette Personnalisée</h1>', 
+              unsafe_allow_html=True)
+    
+    palette_slot = st.empty()
+    
+    # Détails de l'analyse
+    st.markdown('<h2 class="analysis-title">Votre Analyse Beauté Exclusive</h2>', 
+              unsafe_allow_html=True)
+    analysis_slot = st.empty()
+    final_choice_slot = st.empty()
+    status_slot = st.empty()
+
+    if memo.has("result"):
+        # Rerun : simple relecture de la session, aucun appel au modèle
+        with palette_slot.container():
+            render_palette(memo.get("result")["chosen_color"])
+        fragments = memo.get("fragments")
+        for name, slot in (("analysis", analysis_slot), ("final_choice", final_choice_slot)):
+            if name in fragments:
+                slot.markdown(fragments[name], unsafe_allow_html=True)
+        notice = memo.get("notice")
+        if notice is not None:
+            # Message du worker, affiché ici dans le thread du script
+            level, message = notice
+            getattr(status_slot, level)(message)
+        elif memo.get("outcome") in RETRY_OUTCOMES:
+            status_slot.warning("Analyse incomplète : cliquez à nouveau pour réessayer.")
+        return
+
+    pool = get_analysis_pool()
+    job = pool.get(memo.get("job_id"))
+    if job is None:
+        # Processus redémarré ou job expiré
+        memo.discard("job_id")
+        status_slot.warning("L'analyse a été interrompue, cliquez à nouveau pour la relancer.")
+        return
+
+    if not job.done():
+        # Résultat partiel publié par le worker (streaming ou teinte provisoire)
+        render_result(*job.progress(), palette_slot, analysis_slot, final_choice_slot)
+        if job.state == "queued":
+            status_slot.info(f"En file d'attente (position {pool.queue_position(job) + 1})…")
+        else:
+            status_slot.info("Analyse en cours…")
+        return
+
+    pool.forget(job.id)
+    memo.discard("job_id")
+    try:
+        result = job.result()
+    except Exception as e:
+        status_slot.error(f"Erreur d'analyse: {str(e)}")
+        return
+    with timed("lipstick", "render"):
+        fragments = render_result(result, set(result), palette_slot, analysis_slot, final_choice_slot)
+    memo.set("result", result)
+    memo.set("fragments", fragments)
+    memo.set("outcome", job.outcome)
+    memo.set("notice", job.notice)
+    # Rerun complet : arrête l'interrogation périodique du job
+    st.rerun()
 
 def main():
+    start_warm_up()
+    start_exporter()
+
     st.set_page_config(
         page_title="Analyse Rouge à Lèvres",
         page_icon="💄",
@@ -245,60 +804,64 @@ def main():
     with left_col:
         st.markdown('<h1 class="main-title">Votre Analyse Beauté Personnalisée</h1>', unsafe_allow_html=True)
         
-        uploaded_file = st.file_uploader(
+        uploaded_files = st.file_uploader(
             "Déposez votre photo ici pour une analyse sur mesure",
             type=['png', 'jpg', 'jpeg'],
-            help="Limite 200MB par fichier • PNG, JPG, JPEG"
+            accept_multiple_files=True,
+            help=f"Limite {MAX_UPLOAD_BYTES / 2**20:.0f} Mo par fichier • PNG, JPG, JPEG • jusqu'à {MAX_SESSION_PHOTOS} photos analysées ensemble"
         )
 
-        if uploaded_file:
-            st.markdown(f'<img src="data:image/jpeg;base64,{base64.b64encode(uploaded_file.getvalue()).decode()}" class="uploaded-image" style="width:100%">', unsafe_allow_html=True)
+        if not uploaded_files:
+            SessionMemo.clear("lipstick")
+        else:
+            if len(uploaded_files) > MAX_SESSION_PHOTOS:
+                st.warning(f"Seules les {MAX_SESSION_PHOTOS} premières photos sont analysées.")
+                uploaded_files = uploaded_files[:MAX_SESSION_PHOTOS]
+            try:
+                # Taille vérifiée avant lecture, pixels dès l'en-tête ; octets partagés avec l'envoi
+                images = [upload_bytes(f) for f in uploaded_files]
+            except UploadTooLargeError as e:
+                st.error(str(e))
+                st.stop()
+            # Résultat, aperçu et HTML rendus conservés pour ces photos : un rerun ne relance rien
+            memo = SessionMemo("lipstick", uploaded_files)
+            with memo.measure("preview"):
+                preview = memo.cached("preview_html", lambda: "".join(preview_html(i) for i in images))
+            st.markdown(preview, unsafe_allow_html=True)
+            # Plusieurs photos : une requête commune plutôt qu'une analyse par photo
+            job_fn, job_input = (analysis_job, images[0]) if len(images) == 1 else (session_job, images)
+            # Mode spéculatif : l'analyse démarre avant même le clic
+            start_speculation(memo, job_fn, job_input)
             
             st.markdown('<div class="style-id">Style ID: LOOK_001</div>', 
                        unsafe_allow_html=True)
             
-            if st.button("Révélez Votre Teinte Parfaite"):
-                with right_col:
-                    st.markdown('<h1 class="main-title">Votre Palette Personnalisée</h1>', 
-                              unsafe_allow_html=True)
-                    
-                    analyzer = LipstickAnalyzer()
-                    result = analyzer.analyze_image(uploaded_file.getvalue())
-                    
-                    if result:
-                        chosen_color = result["chosen_color"]
-                        
-                        # Grille des couleurs améliorée
-                        col1, col2, col3 = st.columns(3)
-                        cols = [col1, col2, col3]
-                        for idx, (name, color) in enumerate(LIPSTICK_COLORS.items()):
-                            with cols[idx % 3]:
-                                st.markdown(f"""
-                                    <div style="text-align: center;">
-                                        <div class="color-box {'selected-color-box' if name == chosen_color else ''}" 
-                                             style="background-color: {color};">
-                                        </div>
-                                        <div class="color-name">{name}</div>
-                                    </div>
-                                """, unsafe_allow_html=True)
-                        
-                        # Détails de l'analyse
-                        st.markdown('<h2 class="analysis-title">Votre Analyse Beauté Exclusive</h2>', 
-                                  unsafe_allow_html=True)
-                        
-                        # Affichage de l'analyse sans formatage JSON
-                        st.markdown(f'<div class="analysis-text">{result["analysis"]}</div>', 
-                                  unsafe_allow_html=True)
-                        
-                        # Choix final
-                        st.markdown(f"""
-                            <div class="final-choice">
-                                <div class="color-indicator" 
-                                     style="background-color: {LIPSTICK_COLORS[chosen_color]};">
-                                </div>
-                                <strong>Votre Teinte Idéale:</strong> {chosen_color}
-                            </div>
-                        """, unsafe_allow_html=True)
+            clicked = st.button("Révélez Votre Teinte Parfaite")
+            if clicked:
+                claim_speculation(memo)
+            if clicked and not memo.has("job_id") and (
+                    not memo.has("result") or memo.get("outcome") in RETRY_OUTCOMES):
+                # L'analyse part dans le pool partagé : le thread du script est libéré
+                try:
+                    job = get_analysis_pool().submit(job_fn, job_input, session=memo.session)
+                    memo.discard("result", "fragments", "outcome", "notice")
+                    memo.set("job_id", job.id)
+                except PoolFullError:
+                    st.warning("Beaucoup de demandes en ce moment : réessayez dans quelques secondes.")
+
+            # Résultats au-dessus de l'essayage, qui est dessiné d'abord : sans
+            # fragments, poll_job interrompt le script par un rerun
+            results_slot, try_on_slot = right_col.container(), right_col.container()
+            with try_on_slot:
+                try_on_panel(memo, images)
+
+            # Un job spéculatif non réclamé tourne sans être affiché
+            if memo.has("result") or (memo.has("job_id") and not memo.get("speculative")):
+                with results_slot:
+                    if memo.has("job_id"):
+                        poll_job(results_panel, memo)
+                    else:
+                        results_panel(memo)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,122 @@
+"""Mémoire par session : tampons retenus et allocations mesurées par tracemalloc.
+
+Chaque session Streamlit déclare la taille des photos qu'elle retient ; avec
+BEAUTY_TRACEMALLOC=on, les étapes lourdes (aperçu, analyse dans le pool)
+sont aussi mesurées avec tracemalloc : octets encore alloués à la fin de
+l'étape et pic atteint pendant celle-ci. Les valeurs alimentent un
+histogramme Prometheus par étape et un relevé par session (snapshot()).
+
+tracemalloc ne distingue pas les threads et son pic est global : quand
+plusieurs analyses se chevauchent, le pic d'une étape inclut celles des
+autres. Le pic n'est remis à zéro que si aucune autre mesure n'est en cours,
+pour qu'une étape qui démarre n'efface pas celui d'une étape en cours : la
+valeur relevée est une borne haute, suffisante pour repérer les sessions qui
+font exploser un worker.
+tracemalloc ralentit les allocations : il reste désactivé par défaut.
+"""
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+TRACE_FRAMES = int(os.getenv("BEAUTY_TRACEMALLOC_FRAMES", "1"))
+# Session sans nouvelle mesure depuis ce délai (onglet fermé) : oubliée
+SESSION_TTL_SECONDS = int(os.getenv("BEAUTY_MEMORY_SESSION_TTL", "3600"))
+
+
+def tracing_enabled_by_env() -> bool:
+    return os.getenv("BEAUTY_TRACEMALLOC", "off").strip().lower() in ("on", "1", "true", "yes")
+
+
+class MemoryLedger:
+    def __init__(self, tracing: Optional[bool] = None):
+        self.tracing = tracing_enabled_by_env() if tracing is None else tracing
+        if self.tracing and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, Dict] = {}
+        # Mesures en cours : le pic global n'est remis à zéro que lorsqu'il n'y en a aucune
+        self._active = 0
+
+    def _entry(self, session: str) -> Dict:
+        # Appelé avec self._lock déjà acquis
+        now = time.time()
+        for stale in [s for s, e in self._sessions.items() if now - e["updated"] > SESSION_TTL_SECONDS]:
+            del self._sessions[stale]
+        entry = self._sessions.setdefault(session, {"upload_bytes": 0, "peak_bytes": {}, "retained_bytes": {}})
+        entry["updated"] = now
+        return entry
+
+    def record_upload(self, session: str, nbytes: int) -> None:
+        with self._lock:
+            self._entry(session)["upload_bytes"] = nbytes
+
+    def forget(self, session: str) -> None:
+        with self._lock:
+            self._sessions.pop(session, None)
+
+    @contextmanager
+    def measure(self, session: Optional[str], stage: str) -> Iterator[None]:
+        if not self.tracing or session is None:
+            yield
+            return
+        with self._lock:
+            if self._active == 0:
+                tracemalloc.reset_peak()
+            self._active += 1
+            before = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            peak_delta, retained = max(0, peak - before), current - before
+            with self._lock:
+                self._active -= 1
+                entry = self._entry(session)
+                entry["peak_bytes"][stage] = max(entry["peak_bytes"].get(stage, 0), peak_delta)
+                entry["retained_bytes"][stage] = retained
+            get_metrics().observe_session_memory(stage, peak_delta)
+            logger.debug("Mémoire %s/%s : pic +%d octets, retenu %+d", session, stage, peak_delta, retained)
+
+    def held_bytes(self) -> int:
+        with self._lock:
+            return sum(e["upload_bytes"] for e in self._sessions.values())
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            sessions = {s: {k: v for k, v in e.items() if k != "updated"} for s, e in self._sessions.items()}
+        traced = tracemalloc.get_traced_memory()[0] if self.tracing else None
+        return {"tracing": self.tracing, "traced_bytes": traced, "sessions": sessions}
+
+    def top_allocations(self, limit: int = 10) -> List[str]:
+        # Lignes de code qui retiennent le plus de mémoire, pour le diagnostic
+        if not self.tracing:
+            return []
+        stats = tracemalloc.take_snapshot().statistics("lineno")
+        return [str(stat) for stat in stats[:limit]]
+
+
+_ledger: Optional[MemoryLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_memory_ledger() -> MemoryLedger:
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = MemoryLedger()
+            metrics = get_metrics()
+            metrics.register_callback("beauty_session_upload_bytes",
+                                      "Octets de photos retenus par les sessions ouvertes",
+                                      _ledger.held_bytes)
+            if _ledger.tracing:
+                metrics.register_callback("beauty_traced_memory_bytes", "Mémoire suivie par tracemalloc",
+                                          lambda: tracemalloc.get_traced_memory()[0])
+        return _ledger
@@ -0,0 +1,346 @@
+"""Mesures par étape du pipeline d'analyse : latences, tokens, taille des requêtes.
+
+Chaque analyse ouvre une trace (start_trace) qui chronomètre ses étapes
+(préparation de l'image, encodage, appel au modèle, parsing) et relève les
+tokens facturés. À la fin, la trace alimente des histogrammes et des compteurs
+partagés par le processus, exportables au format texte Prometheus
+(BEAUTY_METRICS_PORT=9108 ouvre /metrics) ; si BEAUTY_METRICS_JSONL est
+défini, chaque analyse y est aussi écrite sur une ligne JSON.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (16e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 5e6)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000)
+MEMORY_BUCKETS = (1e6, 4e6, 16e6, 64e6, 128e6, 256e6, 512e6, 1e9)
+
+# Prix en dollars par million de tokens (entrée, sortie)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # Par jeu de labels : [compteurs cumulés par borne..., somme, nombre]
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, labels: Labels) -> None:
+        series = self._series.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def quantile(self, q: float, labels: Labels) -> Optional[float]:
+        # Approximation par borne supérieure du bucket, comme histogram_quantile
+        series = self._series.get(labels)
+        if not series or not series[-1]:
+            return None
+        rank = q * series[-1]
+        for i, bound in enumerate(self.buckets):
+            if series[i] >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return "\n".join(lines)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, value: float, labels: Labels) -> None:
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return "\n".join(lines)
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class MetricsRegistry:
+    def __init__(self, jsonl_path: Optional[Path] = None):
+        self._lock = threading.Lock()
+        self.jsonl_path = jsonl_path
+        self.stage_seconds = Histogram("beauty_stage_seconds", "Durée de chaque étape de l'analyse", LATENCY_BUCKETS)
+        self.analysis_seconds = Histogram("beauty_analysis_seconds", "Durée totale d'une analyse", LATENCY_BUCKETS)
+        self.payload_bytes = Histogram("beauty_request_payload_bytes", "Taille de la requête envoyée au modèle", BYTES_BUCKETS)
+        self.tokens = Histogram("beauty_tokens_per_analysis", "Tokens facturés par analyse", TOKEN_BUCKETS)
+        self.analyses = Counter("beauty_analyses_total", "Analyses par issue (model, cache_hit, near_hit, local, coalesced, degraded, error)")
+        self.tokens_total = Counter("beauty_tokens_total", "Tokens facturés")
+        self.cost_total = Counter("beauty_cost_usd_total", "Coût estimé des appels au modèle, en dollars")
+        self.speculation = Counter("beauty_speculation_total",
+                                   "Analyses spéculatives (started, claimed_ready, claimed_pending, cancelled, unused)")
+        self.head_start = Histogram("beauty_speculation_head_start_seconds",
+                                    "Temps de modèle déjà écoulé au moment du clic", LATENCY_BUCKETS)
+        self.near_duplicates = Counter("beauty_near_duplicate_hits_total",
+                                       "Résultats réutilisés pour une photo quasi identique, par distance de Hamming")
+        self.tier_seconds = Histogram("beauty_cascade_tier_seconds", "Durée de chaque passe de la cascade",
+                                      LATENCY_BUCKETS)
+        self.tier_tokens = Counter("beauty_cascade_tier_tokens_total", "Tokens facturés par passe de la cascade")
+        self.tier_cost = Counter("beauty_cascade_tier_cost_usd_total", "Coût estimé par passe de la cascade")
+        self.rate_limit_wait = Histogram("beauty_ratelimit_wait_seconds",
+                                         "Attente d'un budget de débit avant l'appel", LATENCY_BUCKETS)
+        self.rate_limit = Counter("beauty_ratelimit_total", "Appels admis ou refusés par le limiteur de débit")
+        self.session_memory = Histogram("beauty_session_memory_peak_bytes",
+                                        "Pic d'allocation d'une étape de session (tracemalloc)", MEMORY_BUCKETS)
+        self.cascade = Counter("beauty_cascade_total",
+                               "Passes de la cascade par décision (accepted, escalated) et raison d'escalade")
+        # Valeurs lues au moment de l'export (profondeur de file, etc.) : nom -> (type, aide, fonction)
+        self._callbacks: Dict[str, Tuple[str, str, Callable[[], float]]] = {}
+
+    def register_callback(self, name: str, help_text: str, fn: Callable[[], float],
+                          kind: str = "gauge") -> None:
+        with self._lock:
+            self._callbacks[name] = (kind, help_text, fn)
+
+    def count_speculation(self, event: str) -> None:
+        with self._lock:
+            self.speculation.inc(1, (("event", event),))
+
+    def count_near_duplicate(self, distance: int) -> None:
+        with self._lock:
+            self.near_duplicates.inc(1, (("distance", str(distance)),))
+
+    def count_rate_limit(self, event: str) -> None:
+        with self._lock:
+            self.rate_limit.inc(1, (("event", event),))
+
+    def observe_rate_limit_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.rate_limit_wait.observe(seconds, ())
+
+    def observe_session_memory(self, stage: str, nbytes: int) -> None:
+        with self._lock:
+            self.session_memory.observe(nbytes, (("stage", stage),))
+
+    def observe_head_start(self, seconds: float) -> None:
+        with self._lock:
+            self.head_start.observe(seconds, ())
+
+    def observe_stage(self, analyzer: str, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_seconds.observe(seconds, (("analyzer", analyzer), ("stage", stage)))
+
+    def record(self, trace: "AnalysisTrace") -> None:
+        labels = (("analyzer", trace.analyzer),)
+        record = trace.as_dict()
+        with self._lock:
+            for stage, seconds in trace.stages.items():
+                self.stage_seconds.observe(seconds, labels + (("stage", stage),))
+            self.analysis_seconds.observe(trace.total_s, labels)
+            self.analyses.inc(1, labels + (("outcome", trace.outcome),))
+            if trace.payload_bytes:
+                self.payload_bytes.observe(trace.payload_bytes, labels)
+            if trace.prompt_tokens or trace.completion_tokens:
+                self.tokens.observe(trace.prompt_tokens + trace.completion_tokens, labels)
+                self.tokens_total.inc(trace.prompt_tokens, labels + (("kind", "prompt"),))
+                self.tokens_total.inc(trace.completion_tokens, labels + (("kind", "completion"),))
+                self.cost_total.inc(record["cost_usd"], labels + (("model", trace.model),))
+            for tier in record["tiers"]:
+                tier_labels = labels + (("tier", tier["tier"]),)
+                self.tier_seconds.observe(tier["seconds"], tier_labels)
+                self.tier_tokens.inc(tier["prompt_tokens"], tier_labels + (("kind", "prompt"),))
+                self.tier_tokens.inc(tier["completion_tokens"], tier_labels + (("kind", "completion"),))
+                self.tier_cost.inc(tier["cost_usd"], tier_labels)
+                self.cascade.inc(1, tier_labels + (("decision", tier["decision"]),
+                                                   ("reason", tier.get("reason", "none")),))
+            if self.jsonl_path is not None:
+                try:
+                    with self.jsonl_path.open("a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    logger.warning("Écriture des mesures impossible (%s): %s", self.jsonl_path, e)
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            metrics = (self.stage_seconds, self.analysis_seconds, self.payload_bytes, self.tokens,
+                       self.analyses, self.tokens_total, self.cost_total, self.speculation, self.head_start,
+                       self.near_duplicates, self.tier_seconds, self.tier_tokens, self.tier_cost, self.cascade,
+                       self.rate_limit_wait, self.rate_limit, self.session_memory)
+            lines = [m.render() for m in metrics]
+            callbacks = list(self._callbacks.items())
+        # Hors verrou : une fonction enregistrée peut elle-même prendre un verrou
+        for name, (kind, help_text, fn) in callbacks:
+            lines.append(f"# HELP {name} {help_text}\n# TYPE {name} {kind}\n{name} {fn()}")
+        return "\n".join(lines) + "\n"
+
+    def stage_quantiles(self, analyzer: str, stage: str) -> Dict[str, Optional[float]]:
+        labels = (("analyzer", analyzer), ("stage", stage))
+        with self._lock:
+            return {"p50": self.stage_seconds.quantile(0.5, labels),
+                    "p99": self.stage_seconds.quantile(0.99, labels)}
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+class AnalysisTrace:
+    def __init__(self, analyzer: str, model: str, registry: MetricsRegistry):
+        self.analyzer = analyzer
+        self.model = model
+        self.registry = registry
+        self.stages: Dict[str, float] = {}
+        self.outcome = "error"
+        self.payload_bytes = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_s = 0.0
+        # Passes de la cascade : tier, decision, reason, seconds, tokens
+        self.tiers: List[Dict] = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Cumulé : une étape relancée (retry) compte pour sa durée totale
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    @contextmanager
+    def tier(self, name: str) -> Iterator[Dict]:
+        # L'appelant passe "decision" à "escalated" (et "reason") s'il relance la passe suivante
+        record = {"tier": name, "decision": "accepted"}
+        prompt, completion = self.prompt_tokens, self.completion_tokens
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 4)
+            record["prompt_tokens"] = self.prompt_tokens - prompt
+            record["completion_tokens"] = self.completion_tokens - completion
+            record["cost_usd"] = round(estimate_cost(self.model, record["prompt_tokens"],
+                                                     record["completion_tokens"]), 8)
+            self.tiers.append(record)
+
+    def add_usage(self, usage: Any) -> None:
+        # usage : objet CompletionUsage du SDK ou dict équivalent
+        if usage is None:
+            return
+        get = usage.get if isinstance(usage, dict) else lambda k, d=0: getattr(usage, k, d)
+        self.prompt_tokens += get("prompt_tokens", 0) or 0
+        self.completion_tokens += get("completion_tokens", 0) or 0
+
+    def finish(self) -> None:
+        self.total_s = time.perf_counter() - self._start
+        self.registry.record(self)
+
+    def as_dict(self) -> Dict:
+        return {
+            "ts": time.time(),
+            "analyzer": self.analyzer,
+            "model": self.model,
+            "outcome": self.outcome,
+            "total_s": round(self.total_s, 4),
+            "stages": {k: round(v, 4) for k, v in self.stages.items()},
+            "payload_bytes": self.payload_bytes,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_usd": round(estimate_cost(self.model, self.prompt_tokens, self.completion_tokens), 8),
+            "tiers": self.tiers,
+        }
+
+    def __enter__(self) -> "AnalysisTrace":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.finish()
+
+
+_registry: Optional[MetricsRegistry] = None
+_registry_lock = threading.Lock()
+_exporter_started = False
+
+
+def get_metrics() -> MetricsRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            jsonl = os.getenv("BEAUTY_METRICS_JSONL")
+            _registry = MetricsRegistry(Path(jsonl) if jsonl else None)
+        return _registry
+
+
+def start_trace(analyzer: str, model: str) -> AnalysisTrace:
+    return AnalysisTrace(analyzer, model, get_metrics())
+
+
+@contextmanager
+def timed(analyzer: str, stage: str) -> Iterator[None]:
+    # Pour les étapes hors analyse, comme le rendu Streamlit du résultat
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_metrics().observe_stage(analyzer, stage, time.perf_counter() - start)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_exporter() -> None:
+    # Une seule fois par processus, et seulement si BEAUTY_METRICS_PORT est défini
+    global _exporter_started
+    port = os.getenv("BEAUTY_METRICS_PORT")
+    with _registry_lock:
+        if _exporter_started or not port:
+            return
+        _exporter_started = True
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsHandler)
+    except (OSError, ValueError) as e:
+        logger.warning("Exporteur Prometheus non démarré sur le port %s: %s", port, e)
+        return
+    threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
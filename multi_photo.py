@@ -0,0 +1,109 @@
+"""Sessions multi-photos : plusieurs selfies dans une seule requête.
+
+Comparer deux angles (face et profil pour la barbe) coûtait un appel complet
+par photo : prompt système et consignes répétés, et une latence aller-retour
+par image. Ici les photos partent ensemble dans un seul message, chacune
+précédée de son identifiant (photo_1, photo_2...). Deux modes :
+
+    per_photo   un résultat par photo, sous la clé de la photo
+    consensus   un seul résultat qui croise toutes les photos
+
+Le schéma strict est dérivé de celui de l'analyseur : un objet dont chaque
+propriété photo_N reprend le schéma d'une photo, ou le schéma tel quel en
+mode consensus. Les sessions ne passent pas par la cascade : une seule
+requête, aux options d'image de la première passe.
+"""
+import hashlib
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from result_cache import make_cache_key
+from structured_output import SchemaValidationError, strict_object
+
+logger = logging.getLogger(__name__)
+
+MAX_SESSION_PHOTOS = int(os.getenv("BEAUTY_MAX_PHOTOS", "4"))
+SESSION_MODES = ("per_photo", "consensus")
+
+
+def photo_key(index: int) -> str:
+    return f"photo_{index + 1}"
+
+
+def check_session(images: Sequence[bytes], mode: str) -> None:
+    if mode not in SESSION_MODES:
+        raise ValueError(f"Mode de session invalide: {mode} (attendu: {', '.join(SESSION_MODES)})")
+    if not images:
+        raise ValueError("Session sans photo")
+    if len(images) > MAX_SESSION_PHOTOS:
+        raise ValueError(f"Trop de photos: {len(images)} (max {MAX_SESSION_PHOTOS})")
+
+
+def session_schema(item_schema: Dict, count: int, mode: str) -> Dict:
+    if mode == "consensus":
+        return item_schema
+    return strict_object({photo_key(i): item_schema for i in range(count)})
+
+
+def session_instruction(count: int, mode: str) -> str:
+    # Ajouté aux consignes d'une photo : le format par photo reste celui décrit plus haut
+    keys = ", ".join(photo_key(i) for i in range(count))
+    if mode == "consensus":
+        return (f"\n\nTu reçois {count} photos de la même personne ({keys}), sous des angles "
+                "ou éclairages différents. Croise-les et donne UNE seule réponse au format "
+                "ci-dessus, qui vaut pour toutes les photos.")
+    return (f"\n\nTu reçois {count} photos ({keys}), chacune précédée de son identifiant. "
+            "Réponds avec un objet JSON dont chaque clé est l'identifiant d'une photo et "
+            "la valeur la réponse au format ci-dessus pour cette photo seule.")
+
+
+def session_content(instruction: str, image_parts: List[Dict], mode: str) -> List[Dict]:
+    # Contenu du message utilisateur : consignes une fois, puis chaque photo étiquetée
+    content = [{"type": "text", "text": instruction + session_instruction(len(image_parts), mode)}]
+    for i, part in enumerate(image_parts):
+        content.append({"type": "text", "text": f"{photo_key(i)} :"})
+        content.append(part)
+    return content
+
+
+def session_max_tokens(max_tokens: int, count: int, mode: str) -> int:
+    return max_tokens if mode == "consensus" else max_tokens * count
+
+
+def session_cache_key(images: Sequence[bytes], namespace: str, model: str,
+                      prompt_version: str, max_tokens: int, mode: str) -> str:
+    # Ordre des photos compris : photo_1 n'est pas la même clé de résultat que photo_2
+    digests = b"".join(hashlib.sha256(image).digest() for image in images)
+    return make_cache_key(digests, namespace, model,
+                          f"{prompt_version}|session-{mode}-{len(images)}", max_tokens)
+
+
+def split_session(data, count: int, mode: str,
+                  validate: Callable[[Dict], Dict]) -> Tuple[Dict, List[str]]:
+    # Retourne (résultats validés par clé de photo, clés invalides) ; en mode
+    # consensus la clé unique "consensus" porte le résultat commun
+    if mode == "consensus":
+        try:
+            return {"consensus": validate(data)}, []
+        except ValueError:
+            return {}, ["consensus"]
+    if not isinstance(data, dict):
+        raise SchemaValidationError("La réponse n'est pas un objet JSON")
+    results, invalid = {}, []
+    for i in range(count):
+        key = photo_key(i)
+        try:
+            results[key] = validate(data.get(key))
+        except ValueError as e:
+            logger.warning("Résultat de %s invalide: %s", key, e)
+            invalid.append(key)
+    return results, invalid
+
+
+def session_result(results: Dict, count: int, mode: str,
+                   fallback: Callable[[Optional[int]], Dict]) -> Dict:
+    # Complète les résultats manquants : fallback(index de photo, None en consensus)
+    if mode == "consensus":
+        return results.get("consensus") or fallback(None)
+    return {photo_key(i): results.get(photo_key(i)) or fallback(i) for i in range(count)}
@@ -0,0 +1,279 @@
+"""Index des quasi-doublons : retrouver l'analyse d'une photo déjà vue.
+
+Le cache exact rate une même photo recadrée, recompressée ou passée par une
+capture d'écran. On calcule un pHash 64 bits (DCT de l'image réduite à 32x32
+en niveaux de gris) et on cherche une empreinte déjà analysée à distance de
+Hamming ≤ max_distance.
+
+Recherche par multi-index hashing plutôt que BK-tree : l'empreinte est
+découpée en max_distance + 1 blocs, et deux empreintes assez proches ont
+forcément un bloc identique (principe des tiroirs). Chaque bloc indexe un
+tableau NumPy des empreintes candidates, comparées en une opération
+vectorisée : la recherche reste sous la milliseconde avec des millions
+d'entrées. L'index est persisté en journal texte à côté du cache disque ;
+au chargement, le journal est compacté (une ligne par empreinte, la dernière
+clé l'emporte) et les entrées dont le résultat a quitté le cache sont
+abandonnées. Une entrée trouvée périmée pendant une recherche est oubliée.
+"""
+import io
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from metrics import get_metrics
+from result_cache import ResultCache, get_result_cache
+from upload_buffer import UploadTooLargeError, check_image_pixels
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_DISTANCE = int(os.getenv("BEAUTY_NEAR_DUP_DISTANCE", "6"))
+INDEX_FILENAME = "near-duplicates.log"
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def near_duplicates_enabled_by_env() -> bool:
+    # BEAUTY_NEAR_DUP=off : seules les photos identiques octet par octet sont retrouvées
+    return os.getenv("BEAUTY_NEAR_DUP", "on").strip().lower() not in ("off", "0", "false", "no")
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def phash(image_bytes: bytes) -> Optional[int]:
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            check_image_pixels(*img.size)
+            # Décodage JPEG à échelle réduite : bien plus rapide que l'image pleine
+            img.draft("L", (DCT_SIZE * 4, DCT_SIZE * 4))
+            img = ImageOps.exif_transpose(img).convert("L").resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS)
+            pixels = np.asarray(img, dtype=np.float64)
+    except (OSError, UnidentifiedImageError, UploadTooLargeError):
+        return None
+    coefficients = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    # Le coefficient continu (luminosité moyenne) est exclu de la médiane
+    bits = coefficients > np.median(coefficients[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def hamming(a: np.ndarray, b: int) -> np.ndarray:
+    x = np.bitwise_xor(a, np.uint64(b))
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return _POPCOUNT8[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class _Bucket:
+    # Tableau NumPy extensible (doublement de capacité) : insertion en O(1) amorti
+    __slots__ = ("hashes", "ids", "size")
+
+    def __init__(self):
+        self.hashes = np.empty(8, dtype=np.uint64)
+        self.ids = np.empty(8, dtype=np.int64)
+        self.size = 0
+
+    def append(self, value: int, entry_id: int) -> None:
+        if self.size == len(self.hashes):
+            self.hashes = np.resize(self.hashes, self.size * 2)
+            self.ids = np.resize(self.ids, self.size * 2)
+        self.hashes[self.size] = value
+        self.ids[self.size] = entry_id
+        self.size += 1
+
+
+class NearDuplicateIndex:
+    def __init__(self, directory: Optional[Path] = None,
+                 max_distance: int = DEFAULT_MAX_DISTANCE,
+                 enabled: Optional[bool] = None,
+                 cache: Optional[ResultCache] = None):
+        self.max_distance = max_distance
+        self.enabled = near_duplicates_enabled_by_env() if enabled is None else enabled
+        self.path = Path(directory) / INDEX_FILENAME if directory else None
+        # Découpage en blocs : (décalage, masque) ; max_distance + 1 blocs
+        blocks = max_distance + 1
+        widths = [64 // blocks + (1 if i < 64 % blocks else 0) for i in range(blocks)]
+        offsets = np.cumsum([0] + widths[:-1])
+        self._blocks = [(int(o), (1 << w) - 1) for o, w in zip(offsets, widths)]
+        self._lock = threading.Lock()
+        # Par espace de noms (analyseur + modèle + prompt) : index de blocs, clé de cache
+        # par entrée (None une fois oubliée) et entrée de chaque empreinte
+        self._buckets: Dict[str, Dict[Tuple[int, int], _Bucket]] = {}
+        self._keys: Dict[str, List[Optional[str]]] = {}
+        self._known: Dict[str, Dict[int, int]] = {}
+        self.stats = {"lookups": 0, "hits": 0, "adds": 0, "stale": 0}
+        if self.enabled and self.path is not None:
+            self._load(cache)
+
+    def lookup(self, namespace: str, value: int) -> List[Tuple[str, int]]:
+        # Retourne les (clé de cache, distance) à distance ≤ max_distance, les plus proches d'abord
+        return [(cache_key, distance) for _, cache_key, distance in self._matches(namespace, value)]
+
+    def _matches(self, namespace: str, value: int) -> List[Tuple[int, str, int]]:
+        # (empreinte, clé de cache, distance) des entrées encore actives, triées par distance
+        if not self.enabled:
+            return []
+        with self._lock:
+            self.stats["lookups"] += 1
+            buckets = self._buckets.get(namespace)
+            if not buckets:
+                return []
+            keys = self._keys[namespace]
+            matches: Dict[int, Tuple[int, int]] = {}
+            for block, (offset, mask) in enumerate(self._blocks):
+                bucket = buckets.get((block, (value >> offset) & mask))
+                if bucket is None:
+                    continue
+                distances = hamming(bucket.hashes[:bucket.size], value)
+                for i in np.flatnonzero(distances <= self.max_distance):
+                    # Une même entrée peut partager plusieurs blocs avec l'empreinte
+                    matches[int(bucket.ids[i])] = (int(bucket.hashes[i]), int(distances[i]))
+            return sorted(((candidate, keys[entry_id], distance)
+                           for entry_id, (candidate, distance) in matches.items()
+                           if keys[entry_id] is not None), key=lambda match: match[2])
+
+    def add(self, namespace: str, value: int, cache_key: str) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            if not self._insert(namespace, value, cache_key):
+                return
+            self.stats["adds"] += 1
+        self._append_log(namespace, value, cache_key)
+
+    def _insert(self, namespace: str, value: int, cache_key: str) -> bool:
+        # Appelé avec self._lock déjà acquis ; une empreinte déjà vue prend la nouvelle clé
+        known = self._known.setdefault(namespace, {})
+        keys = self._keys.setdefault(namespace, [])
+        entry_id = known.get(value)
+        if entry_id is not None:
+            if keys[entry_id] == cache_key:
+                return False
+            keys[entry_id] = cache_key
+            return True
+        known[value] = len(keys)
+        buckets = self._buckets.setdefault(namespace, {})
+        for block, (offset, mask) in enumerate(self._blocks):
+            slot = (block, (value >> offset) & mask)
+            bucket = buckets.get(slot)
+            if bucket is None:
+                bucket = buckets[slot] = _Bucket()
+            bucket.append(value, len(keys))
+        keys.append(cache_key)
+        return True
+
+    def _forget(self, namespace: str, value: int, cache_key: str) -> None:
+        # Résultat expiré ou évincé : l'entrée n'est plus proposée (les tableaux des blocs
+        # gardent l'empreinte jusqu'au prochain chargement, qui compacte l'index)
+        with self._lock:
+            keys = self._keys.get(namespace, [])
+            entry_id = self._known.get(namespace, {}).get(value)
+            # Clé remplacée entre-temps par add() : l'entrée est de nouveau valable
+            if entry_id is not None and keys[entry_id] == cache_key:
+                keys[entry_id] = None
+                del self._known[namespace][value]
+                self.stats["stale"] += 1
+
+    def _append_log(self, namespace: str, value: int, cache_key: str) -> None:
+        if self.path is None:
+            return
+        try:
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(f"{namespace}\t{value:016x}\t{cache_key}\n")
+        except OSError as e:
+            logger.warning("Index des quasi-doublons non persisté: %s", e)
+
+    def _load(self, cache: Optional[ResultCache]) -> None:
+        try:
+            lines = self.path.read_text(encoding="utf-8").splitlines()
+        except OSError:
+            return
+        # Dernière clé par empreinte : une clé remplacée a été rajoutée plus bas dans le journal
+        latest: Dict[Tuple[str, int], str] = {}
+        for line in lines:
+            try:
+                namespace, value, cache_key = line.split("\t")
+                latest[namespace, int(value, 16)] = cache_key
+            except ValueError:
+                # Ligne tronquée par un arrêt brutal
+                continue
+        live = {entry: cache_key for entry, cache_key in latest.items()
+                if cache is None or cache.contains(cache_key)}
+        with self._lock:
+            for (namespace, value), cache_key in live.items():
+                self._insert(namespace, value, cache_key)
+        if len(live) < len(lines):
+            self._compact(live)
+
+    def _compact(self, live: Dict[Tuple[str, int], str]) -> None:
+        # Réécriture atomique ; un autre processus peut ajouter entre-temps, au pire
+        # son entrée est perdue et la photo sera simplement réanalysée
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with tmp.open("w", encoding="utf-8") as f:
+                for (namespace, value), cache_key in live.items():
+                    f.write(f"{namespace}\t{value:016x}\t{cache_key}\n")
+            os.replace(tmp, self.path)
+        except OSError as e:
+            tmp.unlink(missing_ok=True)
+            logger.warning("Index des quasi-doublons non compacté: %s", e)
+
+    def find(self, cache: ResultCache, namespace: str,
+             image_bytes: bytes) -> Tuple[Optional[Dict], Optional[int]]:
+        # Retourne (résultat d'une photo quasi identique, empreinte de celle-ci)
+        if not self.enabled:
+            return None, None
+        value = phash(image_bytes)
+        if value is None:
+            return None, None
+        for candidate, cache_key, distance in self._matches(namespace, value):
+            result = cache.get(cache_key)
+            if result is None:
+                # Entrée expirée ou évincée du cache : on passe à la suivante
+                self._forget(namespace, candidate, cache_key)
+                continue
+            with self._lock:
+                self.stats["hits"] += 1
+            # Distance journalisée et comptée pour ajuster le seuil
+            logger.info("Quasi-doublon réutilisé : distance %d (seuil %d)", distance, self.max_distance)
+            get_metrics().count_near_duplicate(distance)
+            return result, value
+        return None, value
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(known) for known in self._known.values())
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            entries = sum(len(known) for known in self._known.values())
+            return {**self.stats, "entries": entries, "max_distance": self.max_distance,
+                    "enabled": self.enabled}
+
+
+_shared_index: Optional[NearDuplicateIndex] = None
+_shared_lock = threading.Lock()
+
+
+def get_near_duplicate_index() -> NearDuplicateIndex:
+    # Persisté dans le répertoire du cache de résultats, dont il référence les clés
+    global _shared_index
+    with _shared_lock:
+        if _shared_index is None:
+            cache = get_result_cache()
+            _shared_index = NearDuplicateIndex(cache.directory, cache=cache)
+        return _shared_index
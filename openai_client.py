@@ -0,0 +1,162 @@
+"""Client OpenAI unique par processus, avec pool de connexions keep-alive.
+
+Les analyseurs étaient reconstruits à chaque clic, chacun avec son propre
+client HTTP : nouvelle connexion TCP et nouvelle poignée de main TLS à chaque
+analyse. Ici le client est créé une seule fois et partagé par les threads.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+from openai import DefaultHttpxClient, OpenAI
+
+from cassette import cassette_mode_by_env, cassette_transport
+from rate_limiter import get_rate_limiter
+from resilience import ATTEMPT_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+POOL_MAX_CONNECTIONS = int(os.getenv("OPENAI_POOL_MAX_CONNECTIONS", "32"))
+POOL_MAX_KEEPALIVE = int(os.getenv("OPENAI_POOL_MAX_KEEPALIVE", "16"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_POOL_KEEPALIVE_EXPIRY", "120"))
+WARMUP_MODEL = os.getenv("OPENAI_WARMUP_MODEL", "gpt-4o-mini")
+
+
+class PoolStats:
+    # Alimenté par CountingTransport, donc indépendant des internes du SDK
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.responses = 0
+        self.transport_errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.warmup_seconds: Optional[float] = None
+
+    def on_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def on_done(self, ok: bool) -> None:
+        # Appelé une fois par requête, réponse reçue ou erreur réseau / délai dépassé
+        with self._lock:
+            if ok:
+                self.responses += 1
+            else:
+                self.transport_errors += 1
+            self.in_flight = max(0, self.in_flight - 1)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "responses": self.responses,
+                "transport_errors": self.transport_errors,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "warmup_seconds": self.warmup_seconds,
+                "max_connections": POOL_MAX_CONNECTIONS,
+                "max_keepalive_connections": POOL_MAX_KEEPALIVE,
+            }
+
+
+class CountingTransport(httpx.BaseTransport):
+    # Un event hook "response" ne voit pas les erreurs réseau : compter autour de l'envoi
+    def __init__(self, inner: httpx.BaseTransport, counts: PoolStats):
+        self.inner = inner
+        self.stats = counts
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.stats.on_request()
+        ok = False
+        try:
+            response = self.inner.handle_request(request)
+            ok = True
+            return response
+        finally:
+            self.stats.on_done(ok)
+
+    def close(self) -> None:
+        self.inner.close()
+
+
+_client: Optional[OpenAI] = None
+_http_transport: Optional[httpx.HTTPTransport] = None
+_client_lock = threading.Lock()
+_warmup_started = False
+stats = PoolStats()
+
+
+def _observe_rate_limits(response: httpx.Response) -> None:
+    get_rate_limiter().observe_headers(response.headers)
+
+
+def get_openai_client(api_key: Optional[str] = None) -> OpenAI:
+    global _client, _http_transport
+    with _client_lock:
+        if _client is None:
+            limits = httpx.Limits(
+                max_connections=POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+            )
+            _http_transport = httpx.HTTPTransport(limits=limits)
+            # BEAUTY_CASSETTE=record|replay : échanges enregistrés ou rejoués (voir cassette)
+            transport = cassette_transport(_http_transport) or _http_transport
+            http_client = DefaultHttpxClient(
+                limits=limits,
+                transport=CountingTransport(transport, stats),
+                # En-têtes x-ratelimit-* : recalage du limiteur de débit partagé
+                event_hooks={"response": [_observe_rate_limits]},
+            )
+            if api_key is None and cassette_mode_by_env() == "replay":
+                # Rejeu hors ligne : le SDK exige une clé, aucune requête ne part
+                api_key = "replay"
+            # Relances et délais gérés par resilience.ResilientCaller, pas par le SDK
+            _client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0,
+                             timeout=httpx.Timeout(ATTEMPT_TIMEOUT_SECONDS, connect=5.0))
+        return _client
+
+
+def warm_up(client: Optional[OpenAI] = None) -> Optional[float]:
+    # Requête légère (sans tokens facturés) pour ouvrir la connexion TLS
+    try:
+        # Dans le try : sans clé API, la construction du client échoue aussi
+        client = client or get_openai_client()
+        start = time.perf_counter()
+        client.with_options(max_retries=0, timeout=10).models.retrieve(WARMUP_MODEL)
+    except Exception as e:
+        logger.warning("Préchauffage du client OpenAI échoué: %s", e)
+        return None
+    elapsed = time.perf_counter() - start
+    stats.warmup_seconds = elapsed
+    return elapsed
+
+
+def start_warm_up() -> None:
+    # Lancé au démarrage de l'app, une seule fois par processus, sans bloquer le rendu
+    global _warmup_started
+    with _client_lock:
+        if _warmup_started:
+            return
+        _warmup_started = True
+    threading.Thread(target=warm_up, name="openai-warmup", daemon=True).start()
+
+
+def _open_connections() -> Optional[int]:
+    # Introspection best-effort du pool httpcore (API privée, peut disparaître)
+    try:
+        return len(_http_transport._pool.connections)
+    except AttributeError:
+        return None
+
+
+def pool_stats() -> Dict:
+    snapshot = stats.snapshot()
+    snapshot["open_connections"] = _open_connections() if _http_transport is not None else 0
+    return snapshot
@@ -0,0 +1,228 @@
+"""Évaluation hors ligne de variantes de prompt sur un jeu de photos.
+
+    python prompt_eval.py lipstick --input photos/ --variants variants.json --cassette record
+    python prompt_eval.py lipstick --input photos/ --variants variants.json --cassette replay --save eval.json
+
+Le fichier de variantes est une liste JSON d'objets {"name": ..., CONSTANTE: valeur}.
+Chaque constante remplace, le temps de la variante, celle de l'analyseur
+(MAX_TOKENS, MODEL) ou du module de l'application (ANALYSIS_PROMPT,
+SYSTEM_PROMPT) ; une valeur "@chemin" est lue dans un fichier texte. La
+variante "baseline" (les prompts actuels) est toujours évaluée en premier.
+
+Chaque photo part en une seule requête, sans cascade ni cache : build_request
+sur l'image préparée avec analyzer.image_options (le palier complet, comme
+le traitement par lots), avec le MODEL et les MAX_TOKENS de la variante ; la
+passe économique de la cascade interactive n'est pas mesurée. Par variante :
+taux de réponses conformes au schéma, tokens de prompt et de complétion,
+latence p50/p95, et accord avec la baseline sur le champ principal (teinte,
+style de barbe). Au rejeu
+(--cassette replay), la latence citée est celle de l'enregistrement.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+from openai import DefaultHttpxClient, OpenAI
+
+from app_loader import APPS, load_app
+from batch_analyze import iter_inputs, percentile
+from cassette import (CASSETTE_MODES, DEFAULT_CASSETTE_DIR, ELAPSED_HEADER, CassetteStore,
+                      CassetteTransport)
+from rate_limiter import RateLimiter
+from resilience import ResilientCaller
+from result_cache import ResultCache
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Champ comparé à la baseline : la recommandation principale de chaque analyseur
+AGREEMENT_FIELDS = {"lipstick": "chosen_color", "beard": "recommended_style"}
+
+
+def load_variants(path: Optional[Path]) -> List[Dict]:
+    variants = [{"name": "baseline"}]
+    if path is None:
+        return variants
+    for variant in json.loads(path.read_text(encoding="utf-8")):
+        if not isinstance(variant, dict) or not variant.get("name"):
+            raise ValueError(f"Variante sans nom dans {path}")
+        if variant["name"] == "baseline":
+            raise ValueError("Le nom « baseline » est réservé aux prompts actuels")
+        overrides = {}
+        for name, value in variant.items():
+            if isinstance(value, str) and value.startswith("@"):
+                value = (path.parent / value[1:]).read_text(encoding="utf-8")
+            overrides[name] = value
+        variants.append(overrides)
+    return variants
+
+
+@contextmanager
+def applied(app, analyzer, variant: Dict) -> Iterator[None]:
+    # Attributs de l'analyseur sur l'instance, constantes du module le temps de la variante
+    saved = {}
+    try:
+        for name, value in variant.items():
+            if name == "name":
+                continue
+            if hasattr(type(analyzer), name):
+                setattr(analyzer, name, value)
+            elif hasattr(app, name):
+                saved[name] = getattr(app, name)
+                setattr(app, name, value)
+            else:
+                raise ValueError(f"Constante inconnue dans la variante {variant['name']}: {name}")
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(app, name, value)
+
+
+def make_client(base_url: Optional[str], cassette: str, store: Optional[CassetteStore]) -> OpenAI:
+    transport = httpx.HTTPTransport()
+    if store is not None:
+        transport = CassetteTransport(store, cassette, transport)
+    load_dotenv()
+    api_key = os.getenv("OPENAI_API_KEY")
+    if api_key is None and (cassette == "replay" or base_url is not None):
+        # Rejeu ou serveur local : le SDK exige une clé, qui ne sert à rien ici
+        api_key = "stub"
+    # Au rejeu, une requête absente de la cassette ne sera pas plus présente au second essai
+    return OpenAI(base_url=base_url, api_key=api_key, http_client=DefaultHttpxClient(transport=transport),
+                  max_retries=0 if cassette == "replay" else 2)
+
+
+def evaluate_photo(kind: str, analyzer, path: Path) -> Dict:
+    record: Dict = {"path": str(path)}
+    try:
+        request = analyzer.build_request(analyzer._prepare_image(path.read_bytes()))
+        start = time.perf_counter()
+        raw = analyzer.client.chat.completions.with_raw_response.create(**request)
+        completion = raw.parse()
+        elapsed = time.perf_counter() - start
+    except Exception as e:
+        logger.warning("%s : %s", path, e)
+        record.update(status="error", error=str(e))
+        return record
+
+    recorded = raw.headers.get(ELAPSED_HEADER)
+    choice = completion.choices[0]
+    usage = completion.usage
+    record.update(
+        status="ok",
+        latency_s=round(float(recorded) if recorded is not None else elapsed, 4),
+        prompt_tokens=usage.prompt_tokens if usage else None,
+        completion_tokens=usage.completion_tokens if usage else None,
+        finish_reason=choice.finish_reason,
+    )
+    try:
+        result = analyzer._validate(analyzer._load_response(choice.message.content))
+    except ValueError as e:
+        record.update(valid=False, reason=str(e))
+        return record
+    record.update(valid=choice.finish_reason != "length", answer=result.get(AGREEMENT_FIELDS[kind]))
+    return record
+
+
+def summarize(name: str, records: List[Dict], baseline: Optional[Dict[str, Dict]]) -> Dict:
+    ok = [r for r in records if r["status"] == "ok"]
+    valid = [r for r in ok if r.get("valid")]
+    latencies = [r["latency_s"] for r in ok]
+    prompt_tokens = [r["prompt_tokens"] for r in ok if r["prompt_tokens"] is not None]
+    completion_tokens = [r["completion_tokens"] for r in ok if r["completion_tokens"] is not None]
+    summary = {
+        "variant": name,
+        "photos": len(records),
+        "errors": len(records) - len(ok),
+        "valid_rate": round(len(valid) / len(records), 3) if records else 0.0,
+        "prompt_tokens_mean": round(statistics.mean(prompt_tokens), 1) if prompt_tokens else None,
+        "completion_tokens_mean": round(statistics.mean(completion_tokens), 1) if completion_tokens else None,
+        "latency_p50_s": round(percentile(latencies, 50), 3),
+        "latency_p95_s": round(percentile(latencies, 95), 3),
+        "agreement": None,
+    }
+    if baseline is not None:
+        # Accord mesuré sur les photos où les deux réponses sont valides
+        pairs = [(r["answer"], baseline[r["path"]]["answer"]) for r in valid
+                 if baseline.get(r["path"], {}).get("valid")]
+        summary["agreement"] = round(sum(a == b for a, b in pairs) / len(pairs), 3) if pairs else None
+        summary["compared"] = len(pairs)
+    return summary
+
+
+def run_variants(kind: str, paths: List[Path], variants: List[Dict], client: OpenAI,
+                 concurrency: int) -> Dict:
+    app = load_app(kind)
+    analyzer_cls = getattr(app, APPS[kind][2])
+    report: Dict = {"analyzer": kind, "photos": len(paths), "variants": [], "records": {}}
+    baseline: Optional[Dict[str, Dict]] = None
+    for variant in variants:
+        # Une instance par variante, sans cache ni coalescence : chaque photo atteint le modèle
+        analyzer = analyzer_cls(cache=ResultCache(directory=None, enabled=False), client=client,
+                                single_flight=SingleFlight(),
+                                resilience=ResilientCaller(hedging=False, limiter=RateLimiter(enabled=False)),
+                                cascade=False)
+        with applied(app, analyzer, variant), ThreadPoolExecutor(max_workers=concurrency) as pool:
+            records = list(pool.map(lambda path: evaluate_photo(kind, analyzer, path), paths))
+        summary = summarize(variant["name"], records, baseline)
+        if baseline is None:
+            baseline = {r["path"]: r for r in records}
+        report["variants"].append(summary)
+        report["records"][variant["name"]] = records
+    return report
+
+
+def format_table(summaries: List[Dict]) -> str:
+    columns = ("variant", "valid_rate", "prompt_tokens_mean", "completion_tokens_mean",
+               "latency_p50_s", "latency_p95_s", "agreement", "errors")
+    widths = [max(len(c), *(len(str(s.get(c))) for s in summaries)) for c in columns]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    for summary in summaries:
+        lines.append("  ".join(str(summary.get(c)).ljust(w) for c, w in zip(columns, widths)))
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compare des variantes de prompt sur un jeu de photos")
+    parser.add_argument("analyzer", choices=sorted(APPS))
+    parser.add_argument("--input", type=Path, help="Dossier de photos (parcours récursif)")
+    parser.add_argument("--manifest", type=Path, help="Fichier listant les photos, une par ligne")
+    parser.add_argument("--variants", type=Path, help="Liste JSON des variantes (la baseline est implicite)")
+    parser.add_argument("--cassette", choices=CASSETTE_MODES, default="off",
+                        help="record : enregistre les échanges ; replay : rejoue sans réseau")
+    parser.add_argument("--cassette-dir", type=Path, default=DEFAULT_CASSETTE_DIR)
+    parser.add_argument("--base-url", help="API compatible OpenAI (ex. stub_server)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Appels simultanés par variante")
+    parser.add_argument("--save", type=Path, help="Écrit le rapport complet (résumés et réponses) en JSON")
+    args = parser.parse_args(argv)
+
+    if args.input is None and args.manifest is None:
+        parser.error("--input ou --manifest est requis")
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    paths = iter_inputs(args.input, args.manifest)
+    store = CassetteStore(args.cassette_dir) if args.cassette != "off" else None
+    client = make_client(args.base_url, args.cassette, store)
+    report = run_variants(args.analyzer, paths, load_variants(args.variants), client, args.concurrency)
+    if store is not None:
+        report["cassette"] = {"mode": args.cassette, **store.snapshot()}
+
+    print(format_table(report["variants"]))
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        args.save.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    return 0 if all(s["errors"] == 0 for s in report["variants"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
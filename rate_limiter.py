@@ -0,0 +1,309 @@
+"""Limiteur de débit partagé (requêtes et tokens par minute) pour l'API OpenAI.
+
+Deux seaux à jetons, requêtes et tokens, rechargés en continu à limite / 60 s.
+Chaque appel réserve une requête et une estimation de ses tokens (texte,
+image, max_tokens : c'est aussi ce que compte OpenAI) avant de partir. Les
+en-têtes x-ratelimit-* de chaque réponse, relevés par un event hook httpx du
+client partagé, recalent limites et niveaux sur ce que voit le serveur.
+
+Les appelants sont servis dans l'ordre d'arrivée ; si l'attente prévue pour
+un nouvel appel dépasse BEAUTY_RATE_MAX_WAIT ou que la file est pleine, il
+est refusé tout de suite (RateLimitExceeded) plutôt que d'aller chercher un
+429. Par défaut l'état est propre au processus ; BEAUTY_RATE_LIMIT_STATE
+désigne un fichier d'état verrouillé (fcntl) partagé par plusieurs processus
+de la même machine (workers uvicorn, plusieurs apps Streamlit).
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, Mapping, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows : pas de backend partagé, le limiteur reste local au processus
+    fcntl = None
+
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+# Limites du palier 1 pour gpt-4o-mini, remplacées dès la première réponse
+DEFAULT_RPM = int(os.getenv("BEAUTY_RATE_RPM", "500"))
+DEFAULT_TPM = int(os.getenv("BEAUTY_RATE_TPM", "200000"))
+MAX_WAIT_SECONDS = float(os.getenv("BEAUTY_RATE_MAX_WAIT", "10"))
+MAX_QUEUE = int(os.getenv("BEAUTY_RATE_MAX_QUEUE", "64"))
+
+# Tokens image facturés selon le niveau de détail (approximation, 4 tuiles en "high")
+IMAGE_TOKENS = {"low": 85, "high": 765, "auto": 765}
+
+
+def rate_limit_enabled_by_env() -> bool:
+    # BEAUTY_RATE_LIMIT=off : les appels partent sans réservation
+    return os.getenv("BEAUTY_RATE_LIMIT", "on").strip().lower() not in ("off", "0", "false", "no")
+
+
+class RateLimitExceeded(RuntimeError):
+    """Budget de débit insuffisant : l'appel est refusé avant d'atteindre l'API."""
+
+
+def estimate_request_tokens(request: Mapping) -> int:
+    # Estimation grossière (4 caractères par token) : les en-têtes corrigent la dérive
+    chars = 0
+    image_tokens = 0
+    for message in request.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                chars += len(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                image_tokens += IMAGE_TOKENS.get(part["image_url"].get("detail", "auto"), 765)
+    return chars // 4 + image_tokens + int(request.get("max_tokens") or 0)
+
+
+def _new_bucket(limit: float) -> Dict[str, float]:
+    return {"level": float(limit), "capacity": float(limit), "updated": time.time()}
+
+
+def _refill(bucket: Dict[str, float], now: float) -> None:
+    rate = bucket["capacity"] / 60.0
+    bucket["level"] = min(bucket["capacity"], bucket["level"] + (now - bucket["updated"]) * rate)
+    bucket["updated"] = now
+
+
+def _wait_for(bucket: Dict[str, float], amount: float) -> float:
+    # Temps avant que le seau contienne amount ; une demande plus grosse que le seau
+    # entier n'attend que de le voir plein (sinon elle ne partirait jamais)
+    missing = min(amount, bucket["capacity"]) - bucket["level"]
+    return max(0.0, missing / (bucket["capacity"] / 60.0))
+
+
+class _Budgets:
+    # Calculs sur l'état {"requests": seau, "tokens": seau} ; le stockage est aux sous-classes
+    def _reserve(self, state: Dict, tokens: int, now: float) -> float:
+        for bucket in state.values():
+            _refill(bucket, now)
+        wait = max(_wait_for(state["requests"], 1), _wait_for(state["tokens"], tokens))
+        if wait == 0:
+            state["requests"]["level"] -= 1
+            state["tokens"]["level"] -= min(tokens, state["tokens"]["capacity"])
+        return wait
+
+    def _predict(self, state: Dict, requests: int, tokens: int, now: float) -> float:
+        for bucket in state.values():
+            _refill(bucket, now)
+        return max(_wait_for(state["requests"], requests), _wait_for(state["tokens"], tokens))
+
+    @staticmethod
+    def _sync(state: Dict, kind: str, limit: Optional[int], remaining: Optional[int], now: float) -> None:
+        bucket = state[kind]
+        _refill(bucket, now)
+        if limit:
+            # Changement de limite (premier en-tête, changement de palier) : le niveau suit
+            bucket["level"] = max(0.0, bucket["level"] + float(limit) - bucket["capacity"])
+            bucket["capacity"] = float(limit)
+        if remaining is not None:
+            # Pessimiste : nos réservations en vol ne sont pas encore comptées par le serveur
+            bucket["level"] = min(bucket["level"], float(remaining))
+
+
+class LocalBackend(_Budgets):
+    def __init__(self, rpm: int = DEFAULT_RPM, tpm: int = DEFAULT_TPM):
+        self._lock = threading.Lock()
+        self._state = {"requests": _new_bucket(rpm), "tokens": _new_bucket(tpm)}
+
+    def reserve(self, tokens: int) -> float:
+        # 0 : réservé ; sinon temps d'attente estimé avant de pouvoir réserver
+        with self._lock:
+            return self._reserve(self._state, tokens, time.time())
+
+    def predict(self, requests: int, tokens: int) -> float:
+        with self._lock:
+            return self._predict(self._state, requests, tokens, time.time())
+
+    def sync(self, kind: str, limit: Optional[int], remaining: Optional[int]) -> None:
+        with self._lock:
+            self._sync(self._state, kind, limit, remaining, time.time())
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            now = time.time()
+            for bucket in self._state.values():
+                _refill(bucket, now)
+            return {kind: dict(bucket) for kind, bucket in self._state.items()}
+
+
+class FileBackend(_Budgets):
+    # État dans un petit fichier JSON, lu et réécrit sous verrou exclusif à chaque opération
+    def __init__(self, path: Path, rpm: int = DEFAULT_RPM, tpm: int = DEFAULT_TPM):
+        if fcntl is None:
+            raise RuntimeError("Backend partagé indisponible sur cette plateforme (fcntl)")
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._defaults = (rpm, tpm)
+        self._lock = threading.Lock()
+
+    def _update(self, operation):
+        with self._lock, self.path.open("a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    # Fichier neuf ou tronqué : seaux pleins aux limites par défaut
+                    state = {"requests": _new_bucket(self._defaults[0]), "tokens": _new_bucket(self._defaults[1])}
+                result = operation(state, time.time())
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reserve(self, tokens: int) -> float:
+        return self._update(lambda state, now: self._reserve(state, tokens, now))
+
+    def predict(self, requests: int, tokens: int) -> float:
+        return self._update(lambda state, now: self._predict(state, requests, tokens, now))
+
+    def sync(self, kind: str, limit: Optional[int], remaining: Optional[int]) -> None:
+        self._update(lambda state, now: self._sync(state, kind, limit, remaining, now))
+
+    def snapshot(self) -> Dict:
+        def read(state, now):
+            for bucket in state.values():
+                _refill(bucket, now)
+            return {kind: dict(bucket) for kind, bucket in state.items()}
+        return self._update(read)
+
+
+class RateLimiter:
+    def __init__(self, backend=None, max_wait: float = MAX_WAIT_SECONDS,
+                 max_queue: int = MAX_QUEUE, enabled: Optional[bool] = None):
+        self.backend = backend or LocalBackend()
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.enabled = rate_limit_enabled_by_env() if enabled is None else enabled
+        self._cond = threading.Condition()
+        # Tickets en attente, servis dans l'ordre d'arrivée
+        self._queue: Deque[int] = deque()
+        self._queued_tokens = 0
+        self._next_ticket = 0
+        self.stats = {"admitted": 0, "shed": 0, "waited": 0}
+
+    def acquire(self, tokens: int) -> float:
+        # Bloque jusqu'à la réservation ; retourne l'attente subie, lève si l'appel est refusé
+        if not self.enabled:
+            return 0.0
+        metrics = get_metrics()
+        start = time.monotonic()
+        with self._cond:
+            predicted = self.backend.predict(len(self._queue) + 1, self._queued_tokens + tokens)
+            if len(self._queue) >= self.max_queue or predicted > self.max_wait:
+                self.stats["shed"] += 1
+                metrics.count_rate_limit("shed")
+                raise RateLimitExceeded(f"Débit OpenAI saturé (attente prévue {predicted:.1f}s), "
+                                        "réessayez dans quelques secondes")
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._queue.append(ticket)
+            self._queued_tokens += tokens
+            try:
+                while True:
+                    wait = self.backend.reserve(tokens) if self._queue[0] == ticket else None
+                    if wait == 0:
+                        break
+                    if time.monotonic() - start > self.max_wait:
+                        # Budget consommé ailleurs (autre processus) plus vite que prévu
+                        self.stats["shed"] += 1
+                        metrics.count_rate_limit("shed")
+                        raise RateLimitExceeded("Débit OpenAI saturé, réessayez dans quelques secondes")
+                    # Réveil à l'échéance estimée, ou quand le ticket précédent sort de la file
+                    self._cond.wait(timeout=min(wait, 0.25) if wait is not None else 0.25)
+            finally:
+                self._queue.remove(ticket)
+                self._queued_tokens -= tokens
+                self._cond.notify_all()
+            self.stats["admitted"] += 1
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            self.stats["waited"] += 1
+        metrics.count_rate_limit("admitted")
+        metrics.observe_rate_limit_wait(waited)
+        return waited
+
+    def try_acquire(self, tokens: int) -> bool:
+        # Sans attente ni file : pour les requêtes facultatives (hedging)
+        if not self.enabled:
+            return True
+        with self._cond:
+            if self._queue:
+                return False
+            return self.backend.reserve(tokens) == 0
+
+    def observe_headers(self, headers: Mapping[str, str]) -> None:
+        # Event hook httpx : toutes les réponses, y compris les 429
+        for kind in ("requests", "tokens"):
+            limit = _int_header(headers, f"x-ratelimit-limit-{kind}")
+            remaining = _int_header(headers, f"x-ratelimit-remaining-{kind}")
+            if limit is None and remaining is None:
+                continue
+            self.backend.sync(kind, limit, remaining)
+        with self._cond:
+            self._cond.notify_all()
+
+    def queue_length(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def snapshot(self) -> Dict:
+        with self._cond:
+            stats = {**self.stats, "queued": len(self._queue)}
+        return {**stats, "enabled": self.enabled, "budgets": self.backend.snapshot()}
+
+
+def _int_header(headers: Mapping[str, str], name: str) -> Optional[int]:
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+_shared: Optional[RateLimiter] = None
+_shared_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    # Un limiteur par processus ; l'état peut être partagé via BEAUTY_RATE_LIMIT_STATE
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            state_path = os.getenv("BEAUTY_RATE_LIMIT_STATE")
+            backend = None
+            if state_path:
+                try:
+                    backend = FileBackend(Path(state_path))
+                except (OSError, RuntimeError) as e:
+                    logger.warning("Limiteur partagé indisponible (%s), état local au processus: %s",
+                                   state_path, e)
+            limiter = _shared = RateLimiter(backend)
+            metrics = get_metrics()
+            metrics.register_callback("beauty_ratelimit_requests_available",
+                                      "Requêtes disponibles dans le budget par minute",
+                                      lambda: round(limiter.backend.snapshot()["requests"]["level"], 2))
+            metrics.register_callback("beauty_ratelimit_tokens_available",
+                                      "Tokens disponibles dans le budget par minute",
+                                      lambda: round(limiter.backend.snapshot()["tokens"]["level"]))
+            metrics.register_callback("beauty_ratelimit_queue_length",
+                                      "Appels en attente de budget", limiter.queue_length)
+        return _shared
@@ -0,0 +1,311 @@
+"""Délais, relances et disjoncteur autour des appels au modèle.
+
+Chaque analyse a une échéance globale : les tentatives successives se
+partagent ce budget au lieu de bloquer un worker Streamlit indéfiniment.
+Seules les erreurs transitoires (429, 5xx, délai, connexion) sont relancées,
+avec un backoff exponentiel à gigue complète qui respecte Retry-After.
+Quand l'API enchaîne les échecs, le disjoncteur s'ouvre et les appels
+échouent immédiatement (CircuitOpenError) jusqu'à la fin du refroidissement.
+Un appel non streamé qui dépasse le p95 observé peut être doublé (« hedging ») :
+la première réponse arrivée gagne. Le p95 est suivi par classe de requête
+(analyseur, budget de sortie, images) : une passe rapide n'est pas comparée à
+un rapport complet. Chaque tentative réserve d'abord son budget
+auprès du limiteur de débit partagé (rate_limiter).
+"""
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, Mapping, Optional, TypeVar
+
+import openai
+
+from rate_limiter import RateLimiter, get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CALL_DEADLINE_SECONDS = float(os.getenv("OPENAI_CALL_DEADLINE", "45"))
+ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("OPENAI_ATTEMPT_TIMEOUT", "30"))
+MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "3"))
+BACKOFF_BASE_SECONDS = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+BACKOFF_CAP_SECONDS = float(os.getenv("OPENAI_BACKOFF_CAP", "8"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "20"))
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+def hedging_enabled_by_env() -> bool:
+    # OPENAI_HEDGE=off désactive la seconde requête (elle double le coût de l'appel)
+    return os.getenv("OPENAI_HEDGE", "on").strip().lower() not in ("off", "0", "false", "no")
+
+
+def latency_class(name: str, request: Mapping) -> str:
+    # Classe de latence d'une requête : analyseur (ou étape), max_tokens, nombre et détail des images
+    details = [part["image_url"].get("detail", "auto")
+               for message in request.get("messages", []) if isinstance(message.get("content"), list)
+               for part in message["content"] if part.get("type") == "image_url"]
+    images = f"{len(details)}x{'/'.join(sorted(set(details)))}" if details else "text"
+    return f"{name}:{request.get('max_tokens')}:{images}"
+
+
+class CircuitOpenError(RuntimeError):
+    """L'API est jugée indisponible : l'appel n'a pas été tenté."""
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, openai.APIConnectionError):
+        # Inclut APITimeoutError
+        return True
+    if isinstance(error, openai.APIStatusError):
+        if getattr(error, "code", None) == "insufficient_quota":
+            # Quota épuisé : relancer ne changera rien
+            return False
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return max(0.0, float(value) * scale)
+        except ValueError:
+            # Retry-After au format date HTTP : ignoré, le backoff prend le relais
+            continue
+    return None
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 cooldown_seconds: float = BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self.stats = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        # Appelé avec self._lock déjà acquis
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.cooldown_seconds:
+            return "half_open"
+        return "open"
+
+    def before_call(self) -> None:
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return
+            if state == "half_open" and not self._probe_in_flight:
+                # Un seul appel d'essai laissé passer après le refroidissement
+                self._probe_in_flight = True
+                return
+            self.stats["rejected"] += 1
+        raise CircuitOpenError("API OpenAI indisponible, nouvel essai dans quelques secondes")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_ignored(self) -> None:
+        # Erreur de la requête elle-même (400, authentification...) : elle ne dit rien
+        # de l'état de l'API, qui reste tel quel ; seul l'essai en demi-ouverture est libéré
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            was_probe = self._probe_in_flight
+            self._probe_in_flight = False
+            if was_probe or (self._opened_at is None and self._failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    self.stats["opened"] += 1
+                    logger.warning("Disjoncteur ouvert après %d échecs consécutifs", self._failures)
+                self._opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {**self.stats, "state": self._state(), "consecutive_failures": self._failures}
+
+
+class LatencyWindow:
+    # Latences des derniers appels réussis, pour le seuil de hedging
+    def __init__(self, size: int = 200):
+        self._lock = threading.Lock()
+        self._values: Deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._values.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self._values) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class ResilientCaller:
+    def __init__(self, breaker: Optional[CircuitBreaker] = None,
+                 deadline_seconds: float = CALL_DEADLINE_SECONDS,
+                 attempt_timeout: float = ATTEMPT_TIMEOUT_SECONDS,
+                 max_attempts: int = MAX_ATTEMPTS,
+                 hedging: Optional[bool] = None,
+                 limiter: Optional[RateLimiter] = None):
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter if limiter is not None else get_rate_limiter()
+        self.deadline_seconds = deadline_seconds
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.hedging = hedging_enabled_by_env() if hedging is None else hedging
+        # Une fenêtre par classe de requête (latency_class)
+        self._latency: Dict[str, LatencyWindow] = {}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.stats = {"calls": 0, "retries": 0, "failures": 0, "hedges": 0, "hedge_wins": 0}
+
+    def call(self, fn: Callable[[float], T], hedge: bool = False, tokens: int = 0,
+             request_class: str = "default") -> T:
+        # fn(timeout) effectue une tentative ; timeout = budget restant pour cette tentative.
+        # tokens : estimation réservée auprès du limiteur (rate_limiter.estimate_request_tokens)
+        # request_class : fenêtre de latence du seuil de hedging (latency_class)
+        deadline = time.monotonic() + self.deadline_seconds
+        with self._lock:
+            self.stats["calls"] += 1
+
+        attempt = 0
+        while True:
+            # Avant le disjoncteur : un refus du limiteur ne doit pas bloquer l'essai en demi-ouverture.
+            # RateLimitExceeded n'est pas relancé : l'appelant dégrade aussitôt
+            self.limiter.acquire(tokens)
+            self.breaker.before_call()
+            remaining = deadline - time.monotonic()
+            timeout = max(1.0, min(self.attempt_timeout, remaining))
+            start = time.monotonic()
+            try:
+                if hedge and self.hedging:
+                    result = self._hedged(fn, timeout, tokens, request_class)
+                else:
+                    result = fn(timeout)
+            except Exception as e:
+                if not is_retryable(e):
+                    self.breaker.record_ignored()
+                    raise
+                self.breaker.record_failure()
+                attempt += 1
+                delay = self._backoff(attempt, e)
+                if attempt >= self.max_attempts or time.monotonic() + delay >= deadline:
+                    with self._lock:
+                        self.stats["failures"] += 1
+                    raise
+                logger.warning("Appel OpenAI échoué (%s), tentative %d/%d dans %.2fs",
+                               type(e).__name__, attempt + 1, self.max_attempts, delay)
+                with self._lock:
+                    self.stats["retries"] += 1
+                time.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            if hedge:
+                # Seuls les appels éligibles au hedging alimentent les fenêtres (pas le streaming)
+                self._window(request_class).add(time.monotonic() - start)
+            return result
+
+    def _window(self, request_class: str) -> LatencyWindow:
+        with self._lock:
+            window = self._latency.get(request_class)
+            if window is None:
+                window = self._latency[request_class] = LatencyWindow()
+            return window
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        # Gigue complète : évite que tous les workers relancent au même instant
+        delay = random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _hedged(self, fn: Callable[[float], T], timeout: float, tokens: int, request_class: str) -> T:
+        hedge_after = self._window(request_class).p95()
+        if hedge_after is None or hedge_after >= timeout:
+            return fn(timeout)
+
+        executor = self._get_executor()
+        first = executor.submit(fn, timeout)
+        done, _ = wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+        if not self.limiter.try_acquire(tokens):
+            # Pas de budget libre tout de suite : la seconde requête n'est pas prioritaire
+            return first.result()
+
+        with self._lock:
+            self.stats["hedges"] += 1
+        second = executor.submit(fn, max(1.0, timeout - hedge_after))
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                if future is second:
+                    with self._lock:
+                        self.stats["hedge_wins"] += 1
+                # La requête perdante se termine en arrière-plan (un appel HTTP ne s'annule pas)
+                return future.result()
+        raise error
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="openai-hedge")
+            return self._executor
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            stats = dict(self.stats)
+            windows = dict(self._latency)
+        return {**stats, "p95_s": {name: window.p95() for name, window in sorted(windows.items())},
+                "breaker": self.breaker.snapshot(),
+                "rate_limit": self.limiter.snapshot()}
+
+
+_shared: Optional[ResilientCaller] = None
+_shared_lock = threading.Lock()
+
+
+def get_resilient_caller() -> ResilientCaller:
+    # Disjoncteur commun à toutes les sessions : c'est l'état de l'API qui compte
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = ResilientCaller()
+        return _shared
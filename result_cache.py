@@ -0,0 +1,224 @@
+"""Cache des résultats d'analyse, partagé par les deux applications.
+
+Deux niveaux : un LRU en mémoire (par processus) et un répertoire sur disque
+(persistant entre redémarrages) avec expiration TTL et limite de taille.
+get() et set() copient les résultats : un appelant qui répare ou complète
+un résultat ne modifie pas celui que les autres sessions liront.
+"""
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+DEFAULT_CACHE_DIR = Path(os.getenv("BEAUTY_CACHE_DIR", Path.home() / ".cache" / "beauty_genius"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("BEAUTY_CACHE_MAX_ENTRIES", "512"))
+DEFAULT_MAX_DISK_BYTES = int(os.getenv("BEAUTY_CACHE_MAX_DISK_BYTES", str(200 * 1024 * 1024)))
+DEFAULT_TTL_SECONDS = int(os.getenv("BEAUTY_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+
+def cache_enabled_by_env() -> bool:
+    # BEAUTY_CACHE=off (ou 0/false/no) désactive complètement le cache
+    return os.getenv("BEAUTY_CACHE", "on").strip().lower() not in ("off", "0", "false", "no")
+
+
+def cache_namespace(namespace: str, model: str, prompt_version: str, max_tokens: int) -> str:
+    # Tout ce qui, hors image, détermine le résultat
+    return f"{namespace}|{model}|{prompt_version}|{max_tokens}"
+
+
+def make_cache_key(image_bytes: bytes, namespace: str, model: str,
+                   prompt_version: str, max_tokens: int) -> str:
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    params = cache_namespace(namespace, model, prompt_version, max_tokens)
+    return hashlib.sha256(f"{digest}|{params}".encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory: Optional[Path] = DEFAULT_CACHE_DIR,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES,
+                 ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 enabled: Optional[bool] = None):
+        self.directory = Path(directory) if directory else None
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = cache_enabled_by_env() if enabled is None else enabled
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+        if self.directory is not None:
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                self._disk_bytes = sum(p.stat().st_size for p in self.directory.glob("*/*.json"))
+            except OSError:
+                # Disque indisponible (lecture seule, quota...) : mémoire seule
+                self.directory = None
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - stored_at > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[Dict]:
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if not self._expired(stored_at):
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return copy.deepcopy(value)
+                del self._memory[key]
+
+        value = self._read_disk(key)
+        with self._lock:
+            if value is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            self._remember(key, time.time(), value)
+        return copy.deepcopy(value)
+
+    def contains(self, key: str) -> bool:
+        # Présence seule, sans lecture ni contrôle d'expiration (get() le fera)
+        with self._lock:
+            if key in self._memory:
+                return True
+        return self.directory is not None and self._path(key).exists()
+
+    def set(self, key: str, value: Dict) -> None:
+        if not self.enabled:
+            return
+        now = time.time()
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._remember(key, now, value)
+            self.stats["writes"] += 1
+        self._write_disk(key, now, value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        if self.directory is not None:
+            for path in self.directory.glob("*/*.json"):
+                path.unlink(missing_ok=True)
+            self._disk_bytes = 0
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            hits = lookups - self.stats["misses"]
+            return {
+                **self.stats,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "enabled": self.enabled,
+            }
+
+    def _remember(self, key: str, stored_at: float, value: Dict) -> None:
+        # Appelé avec self._lock déjà acquis
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _read_disk(self, key: str) -> Optional[Dict]:
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            payload = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return None
+        if self._expired(payload.get("stored_at", 0)):
+            self._unlink(path)
+            return None
+        # Le mtime sert d'horodatage LRU pour l'éviction disque
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return payload.get("value")
+
+    def _write_disk(self, key: str, stored_at: float, value: Dict) -> None:
+        if self.directory is None:
+            return
+        path = self._path(key)
+        # Nom propre à l'écrivain : deux threads ou processus qui écrivent la même
+        # clé ne se partagent pas le fichier temporaire
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        data = json.dumps({"stored_at": stored_at, "value": value}, ensure_ascii=False)
+        try:
+            path.parent.mkdir(exist_ok=True)
+            previous = path.stat().st_size if path.exists() else 0
+            tmp.write_text(data, encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            return
+        with self._lock:
+            self._disk_bytes += path.stat().st_size - previous
+            over_budget = self._disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        entries = []
+        for path in self.directory.glob("*/*.json"):
+            try:
+                st_ = path.stat()
+            except OSError:
+                continue
+            entries.append((st_.st_mtime, st_.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        # On redescend à 90 % du budget pour ne pas évincer à chaque écriture
+        target = int(self.max_disk_bytes * 0.9)
+        with self._lock:
+            self._disk_bytes = total
+        for _, size, path in entries:
+            if total <= target:
+                break
+            if self._unlink(path):
+                total -= size
+                with self._lock:
+                    self.stats["evictions"] += 1
+
+    def _unlink(self, path: Path) -> bool:
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except OSError:
+            return False
+        with self._lock:
+            self._disk_bytes = max(0, self._disk_bytes - size)
+        return True
+
+
+_shared_cache: Optional[ResultCache] = None
+_shared_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    # Instance unique par processus : Streamlit réexécute le script à chaque
+    # interaction, mais les modules importés restent en mémoire.
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = ResultCache()
+        return _shared_cache
@@ -0,0 +1,167 @@
+"""Service HTTP sans Streamlit pour les analyses rouge à lèvres et barbe.
+
+    python service.py --host 0.0.0.0 --port 8080 --workers 4
+
+    curl -F image=@selfie.jpg http://localhost:8080/v1/lipstick/analyze
+    curl --data-binary @selfie.jpg -H "Content-Type: image/jpeg" \\
+        http://localhost:8080/v1/beard/analyze
+    curl -F image=@face.jpg -F image=@profil.jpg \\
+        "http://localhost:8080/v1/beard/analyze?mode=consensus"
+
+Les analyseurs sont ceux des applications (chargés via app_loader) et
+s'exécutent dans le pool de workers partagé : la boucle asyncio reste libre
+pendant l'appel au modèle, et un pool plein répond 503 avec Retry-After.
+Le service ne garde aucun état de session : plusieurs processus (--workers)
+ou plusieurs machines derrière un répartiteur de charge se partagent le
+trafic, chaque nœud avec son propre cache de résultats.
+"""
+import argparse
+import asyncio
+import email.parser
+import email.policy
+import time
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from analysis_pool import Job, PoolFullError, get_analysis_pool
+from app_loader import APPS, load_analyzer_class
+from metrics import get_metrics
+from multi_photo import MAX_SESSION_PHOTOS, check_session
+from resilience import get_resilient_caller
+from upload_buffer import MAX_UPLOAD_BYTES, UploadTooLargeError, check_image_header, check_upload_size
+
+# Corps de requête : jusqu'à MAX_SESSION_PHOTOS photos, chacune sous MAX_UPLOAD_BYTES
+MAX_BODY_BYTES = MAX_UPLOAD_BYTES * MAX_SESSION_PHOTOS
+IMAGE_FIELDS = ("image", "file", "photo")
+
+app = FastAPI(title="Beauty Genius API", version="1")
+
+
+def is_supported_image(data: bytes) -> bool:
+    return (data.startswith(b"\xff\xd8\xff") or data.startswith(b"\x89PNG\r\n\x1a\n")
+            or (data[:4] == b"RIFF" and data[8:12] == b"WEBP"))
+
+
+async def read_body(request: Request) -> bytes:
+    # Limite vérifiée sur l'en-tête puis pendant la lecture (corps chunked sans Content-Length)
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > MAX_BODY_BYTES:
+        raise HTTPException(413, f"Requête trop volumineuse (max {MAX_BODY_BYTES} octets)")
+    chunks = []
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > MAX_BODY_BYTES:
+            raise HTTPException(413, f"Requête trop volumineuse (max {MAX_BODY_BYTES} octets)")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def extract_images(content_type: str, body: bytes) -> List[bytes]:
+    if not content_type.startswith("multipart/form-data"):
+        # Corps brut : image/jpeg, image/png, application/octet-stream...
+        return [body]
+    # Le parseur MIME de la bibliothèque standard suffit pour un formulaire simple ;
+    # un champ image répété forme une session multi-photos
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body)
+    if not message.is_multipart():
+        raise HTTPException(400, "Formulaire multipart illisible")
+    images = [part.get_payload(decode=True) or b"" for part in message.iter_parts()
+              if part.get_param("name", header="content-disposition") in IMAGE_FIELDS]
+    if not images:
+        raise HTTPException(400, f"Champ image manquant (attendu: {', '.join(IMAGE_FIELDS)})")
+    return images
+
+
+def analysis_job(job: Job, kind: str, images: List[bytes], use_cache: bool,
+                 mode: Optional[str]) -> Optional[Dict]:
+    # Exécuté dans un worker du pool ; un analyseur par requête, sans état partagé
+    analyzer = load_analyzer_class(kind)()
+    if mode is None:
+        result = analyzer.analyze_image(images[0], use_cache=use_cache)
+    else:
+        result = analyzer.analyze_session(images, mode, use_cache=use_cache)
+    job.report(analyzer.last_trace.outcome if analyzer.last_trace else "model", analyzer.last_notice)
+    return result
+
+
+@app.post("/v1/{kind}/analyze")
+async def analyze(kind: str, request: Request, no_cache: bool = False, mode: Optional[str] = None):
+    # mode : per_photo ou consensus ; implicite (per_photo) dès qu'il y a plusieurs photos
+    if kind not in APPS:
+        raise HTTPException(404, f"Analyseur inconnu: {kind} (attendu: {', '.join(APPS)})")
+    body = await read_body(request)
+    images = extract_images(request.headers.get("content-type", ""), body)
+    if mode is None and len(images) > 1:
+        mode = "per_photo"
+    if mode is not None:
+        try:
+            check_session(images, mode)
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+    for image_bytes in images:
+        if not image_bytes:
+            raise HTTPException(400, "Image vide")
+        if not is_supported_image(image_bytes):
+            raise HTTPException(415, "Format non supporté (JPEG, PNG ou WebP)")
+        try:
+            # Octets puis dimensions de l'en-tête : refusée avant d'occuper un worker
+            check_upload_size(len(image_bytes))
+            check_image_header(image_bytes)
+        except UploadTooLargeError as e:
+            raise HTTPException(413, str(e))
+
+    start = time.perf_counter()
+    try:
+        job = get_analysis_pool().submit(analysis_job, kind, images, not no_cache, mode)
+    except PoolFullError as e:
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": "2"})
+    try:
+        result = await asyncio.wrap_future(job.future)
+    finally:
+        # Aussi en cas d'échec du worker ou de client déconnecté
+        get_analysis_pool().forget(job.id)
+    outcome = job.outcome
+
+    payload = {
+        "analyzer": kind,
+        "outcome": outcome,
+        "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+        "result": result,
+    }
+    if job.notice is not None:
+        payload["message"] = job.notice[1]
+    if outcome == "error":
+        # Le résultat de secours est joint, mais l'appelant doit savoir que c'est un échec
+        return JSONResponse(payload, status_code=502)
+    return payload
+
+
+@app.get("/healthz")
+async def healthz():
+    breaker = get_resilient_caller().breaker.snapshot()
+    return {"status": "degraded" if breaker["state"] != "closed" else "ok",
+            "pool": get_analysis_pool().snapshot(), "breaker": breaker}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return get_metrics().render_prometheus()
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Service HTTP des analyseurs (sans Streamlit)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="Processus uvicorn")
+    args = parser.parse_args()
+    uvicorn.run("service:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
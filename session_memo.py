@@ -0,0 +1,162 @@
+"""Mémoïsation par session et par photo dans st.session_state.
+
+Streamlit réexécute tout le script à chaque interaction : sans mémoire, le
+résultat produit sous `if st.button(...)` disparaît au rerun suivant, et
+l'aperçu de la photo est ré-encodé en base64 à chaque fois. Les valeurs sont
+rangées sous la photo courante, identifiée par son file_id ; un nouvel envoi
+(nouveau file_id, même pour un fichier identique) vide la mémoire. poll_job()
+redessine un panneau tant que l'analyse tourne dans le pool de workers.
+
+En mode spéculatif (BEAUTY_SPECULATIVE=on), l'analyse est soumise dès
+l'envoi de la photo ; le clic ne fait que la réclamer. Le job est annulé si
+la photo change, est retirée ou si la session se ferme avant son démarrage.
+La déduplication par contenu entre sessions est assurée par le cache de
+résultats et le single-flight. Chaque mémoire déclare la taille des photos
+qu'elle retient au relevé de memory_report.
+"""
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+import streamlit as st
+
+from analysis_pool import PoolFullError, get_analysis_pool
+from memory_report import get_memory_ledger
+from metrics import get_metrics
+
+POLL_INTERVAL_SECONDS = float(os.getenv("BEAUTY_POLL_INTERVAL", "0.5"))
+# Issues d'analyse affichées mais pas définitives : un nouveau clic relance
+RETRY_OUTCOMES = ("error", "degraded", "incomplete")
+
+
+def speculation_enabled() -> bool:
+    # Opt-in : chaque photo envoyée coûte un appel, même sans clic
+    return os.getenv("BEAUTY_SPECULATIVE", "off").strip().lower() in ("on", "1", "true", "yes")
+
+
+def _file_id(uploaded_file) -> str:
+    if isinstance(uploaded_file, (list, tuple)):
+        # Session multi-photos : ajouter, retirer ou réordonner une photo change la clé
+        return "+".join(_file_id(f) for f in uploaded_file)
+    # file_id existe depuis Streamlit 1.30 ; à défaut, nom + taille
+    file_id = getattr(uploaded_file, "file_id", None)
+    return file_id or f"{uploaded_file.name}:{uploaded_file.size}"
+
+
+def _upload_size(uploaded_file) -> int:
+    if isinstance(uploaded_file, (list, tuple)):
+        return sum(_upload_size(f) for f in uploaded_file)
+    return uploaded_file.size
+
+
+def _session_id() -> str:
+    # Identifiant de la session Streamlit (API interne, best-effort)
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+    except Exception:
+        ctx = None
+    return ctx.session_id if ctx is not None else "local"
+
+
+class SessionMemo:
+    def __init__(self, namespace: str, uploaded_file):
+        # uploaded_file : un fichier du file_uploader, ou la liste des photos d'une session
+        self._state: Dict[str, Any] = st.session_state.setdefault(f"memo:{namespace}", {})
+        # Clé de la session dans le relevé mémoire (memory_report)
+        self.session = f"{namespace}:{_session_id()}"
+        file_id = _file_id(uploaded_file)
+        if self._state.get("file_id") != file_id:
+            _cancel_job(self._state)
+            self._state.clear()
+            self._state.update(file_id=file_id, values={})
+            get_memory_ledger().record_upload(self.session, _upload_size(uploaded_file))
+        self._values: Dict[str, Any] = self._state["values"]
+
+    def has(self, name: str) -> bool:
+        return name in self._values
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self._values.get(name, default)
+
+    def set(self, name: str, value: Any) -> None:
+        self._values[name] = value
+
+    def discard(self, *names: str) -> None:
+        for name in names:
+            self._values.pop(name, None)
+
+    def cached(self, name: str, compute: Callable[[], Any]) -> Any:
+        if name not in self._values:
+            self._values[name] = compute()
+        return self._values[name]
+
+    def measure(self, stage: str):
+        # Allocations d'une étape de rendu imputées à cette session
+        return get_memory_ledger().measure(self.session, stage)
+
+    @staticmethod
+    def clear(namespace: str) -> None:
+        # Photo retirée du file_uploader : on oublie tout
+        state = st.session_state.pop(f"memo:{namespace}", None)
+        if state:
+            _cancel_job(state)
+        get_memory_ledger().forget(f"{namespace}:{_session_id()}")
+
+
+def _cancel_job(state: Dict[str, Any]) -> None:
+    job_id = state.get("values", {}).get("job_id")
+    if job_id:
+        get_analysis_pool().cancel(job_id)
+
+
+def _session_alive_check() -> Optional[Callable[[], bool]]:
+    # API interne de Streamlit, best-effort : sans elle, le job part quoi qu'il arrive
+    try:
+        from streamlit.runtime import Runtime
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        runtime = Runtime.instance()
+    except Exception:
+        return None
+    if ctx is None:
+        return None
+    session_id = ctx.session_id
+    return lambda: runtime.is_active_session(session_id)
+
+
+def start_speculation(memo: SessionMemo, fn: Callable[..., Any], image_bytes: Any) -> None:
+    # Une seule tentative par photo ; rien si un job ou un résultat existe déjà
+    if not speculation_enabled() or memo.has("speculated") or memo.has("job_id") or memo.has("result"):
+        return
+    memo.set("speculated", True)
+    try:
+        job = get_analysis_pool().submit(fn, image_bytes, speculative=True,
+                                         precondition=_session_alive_check(), session=memo.session)
+    except PoolFullError:
+        # Pool chargé : pas de spéculation, l'analyse partira au clic
+        return
+    get_metrics().count_speculation("started")
+    memo.set("job_id", job.id)
+    memo.set("speculative", True)
+
+
+def claim_speculation(memo: SessionMemo) -> None:
+    # Au clic : le job spéculatif devient le job affiché par la page
+    if not memo.get("speculative"):
+        return
+    memo.discard("speculative")
+    if get_analysis_pool().claim(memo.get("job_id")) is None:
+        memo.discard("job_id")
+
+
+def poll_job(render: Callable[["SessionMemo"], None], memo: SessionMemo) -> None:
+    # Redessine render(memo) périodiquement tant qu'un job du pool est en cours ;
+    # render appelle st.rerun() quand le résultat est prêt
+    if hasattr(st, "fragment"):
+        st.fragment(run_every=POLL_INTERVAL_SECONDS)(render)(memo)
+        return
+    # Streamlit sans fragments : rerun complet après une courte attente
+    render(memo)
+    time.sleep(POLL_INTERVAL_SECONDS)
+    st.rerun()
@@ -0,0 +1,71 @@
+"""Regroupement des analyses identiques en cours (« single-flight »).
+
+Quand plusieurs sessions envoient la même photo en même temps, un seul appel
+au modèle part : les autres appelants attendent sa fin et partagent son
+résultat (ou son exception). La clé est la clé de cache de l'analyseur, qui
+inclut déjà le hash de l'image, l'analyseur, le modèle et la version du prompt.
+"""
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self.stats = {"calls": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        # Retourne (résultat, partagé) ; partagé=True si on a attendu l'appel d'un autre
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.stats["coalesced"] += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.stats["calls"] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {**self.stats, "in_flight": len(self._calls)}
+
+
+_shared = SingleFlight()
+
+
+def get_single_flight() -> SingleFlight:
+    return _shared
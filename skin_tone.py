@@ -0,0 +1,156 @@
+"""Estimation locale du teint et choix de teinte, sans appel au modèle.
+
+La photo est réduite, convertie en CIELAB, puis les pixels de peau sont isolés
+par un seuillage YCbCr classique. La médiane Lab de la peau donne la carnation
+(profondeur L*) et le sous-ton (angle de teinte h = atan2(b*, a*)). Chaque
+teinte est notée par sa distance ΔE à une couleur de lèvres « idéale » dérivée
+de la peau, plus des pénalités d'harmonie (sous-ton, contraste).
+"""
+import io
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Mapping, Optional
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from upload_buffer import UploadTooLargeError, check_image_pixels
+
+ANALYSIS_EDGE = 256
+MIN_SKIN_FRACTION = 0.03
+
+# Blanc de référence D65
+_WHITE = np.array([0.95047, 1.0, 1.08883])
+_RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+
+
+def srgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    # rgb : (..., 3) en uint8 ou float 0-255
+    c = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ _RGB_TO_XYZ.T / _WHITE
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    L = 116 * f[..., 1] - 16
+    a = 500 * (f[..., 0] - f[..., 1])
+    b = 200 * (f[..., 1] - f[..., 2])
+    return np.stack([L, a, b], axis=-1)
+
+
+def lab_to_srgb(lab: np.ndarray) -> np.ndarray:
+    # Inverse de srgb_to_lab ; float 0-255, couleurs hors gamut ramenées au bord
+    lab = np.asarray(lab, dtype=np.float64)
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+    xyz = np.where(f > 6 / 29, f ** 3, 3 * (6 / 29) ** 2 * (f - 4 / 29)) * _WHITE
+    linear = np.clip(xyz @ np.linalg.inv(_RGB_TO_XYZ).T, 0, 1)
+    c = np.where(linear <= 0.0031308, 12.92 * linear, 1.055 * linear ** (1 / 2.4) - 0.055)
+    return c * 255
+
+
+def hex_to_rgb(color: str) -> np.ndarray:
+    color = color.lstrip("#")
+    return np.array([int(color[i:i + 2], 16) for i in (0, 2, 4)], dtype=np.float64)
+
+
+def skin_mask(rgb: np.ndarray) -> np.ndarray:
+    # Seuils YCbCr usuels pour la peau, toutes carnations confondues
+    r, g, b = (rgb[..., i].astype(np.float64) for i in range(3))
+    y = 0.299 * r + 0.587 * g + 0.114 * b
+    cb = 128 - 0.168736 * r - 0.331264 * g + 0.5 * b
+    cr = 128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+    return (cr >= 133) & (cr <= 173) & (cb >= 77) & (cb <= 127) & (y > 40) & (y < 250)
+
+
+@dataclass
+class SkinToneEstimate:
+    chosen_color: str
+    confidence: float
+    undertone: str
+    depth: str
+    skin_lab: tuple
+    skin_fraction: float
+    scores: Dict[str, float] = field(default_factory=dict)
+    elapsed_ms: float = 0.0
+
+
+class SkinToneAnalyzer:
+    def __init__(self, shades: Mapping[str, str]):
+        self.names = list(shades)
+        self.shade_lab = srgb_to_lab(np.stack([hex_to_rgb(shades[n]) for n in self.names]))
+        hue = np.degrees(np.arctan2(self.shade_lab[:, 2], self.shade_lab[:, 1]))
+        # Teintes orangées (h élevé) = chaudes, rouges bleutés / prunes = froides
+        self.shade_warmth = np.clip((hue - 20) / 15, -1, 1)
+
+    def _decode(self, image_bytes: bytes) -> np.ndarray:
+        with Image.open(io.BytesIO(image_bytes)) as source:
+            check_image_pixels(*source.size)
+            # Décodage JPEG directement à échelle réduite (DCT 1/2 à 1/8) : l'essentiel du gain
+            source.draft("RGB", (ANALYSIS_EDGE, ANALYSIS_EDGE))
+            image = ImageOps.exif_transpose(source).convert("RGB")
+        image.thumbnail((ANALYSIS_EDGE, ANALYSIS_EDGE))
+        return np.asarray(image)
+
+    def analyze(self, image_bytes: bytes) -> Optional[SkinToneEstimate]:
+        start = time.perf_counter()
+        try:
+            rgb = self._decode(image_bytes)
+        except (OSError, UploadTooLargeError):
+            return None
+
+        mask = skin_mask(rgb)
+        # On privilégie le centre de l'image, où se trouve généralement le visage
+        h, w = mask.shape
+        yy, xx = np.ogrid[:h, :w]
+        central = ((yy - h / 2) / (h / 2)) ** 2 + ((xx - w / 2) / (w / 2)) ** 2 <= 0.8
+        if (mask & central).sum() >= MIN_SKIN_FRACTION * mask.size:
+            mask = mask & central
+        skin_fraction = float(mask.mean())
+        if skin_fraction < MIN_SKIN_FRACTION:
+            return None
+
+        skin = srgb_to_lab(rgb[mask])
+        L, a, b = np.median(skin, axis=0)
+        hue = float(np.degrees(np.arctan2(b, a)))
+
+        if hue >= 58:
+            undertone, warmth = "chaud", 1.0
+        elif hue <= 48:
+            undertone, warmth = "froid", -1.0
+        else:
+            undertone, warmth = "neutre", 0.0
+        if L >= 68:
+            depth = "claire"
+        elif L >= 50:
+            depth = "moyenne"
+        else:
+            depth = "foncée"
+
+        # Lèvres idéales : plus saturées et un peu plus profondes que la peau ;
+        # l'écart de luminosité attendu croît avec la clarté de la peau
+        target = np.array([L - (18 + 0.25 * max(L - 50, 0)), a + 22, b * 0.6])
+        delta_e = np.linalg.norm(self.shade_lab - target, axis=1)
+        undertone_penalty = 12 * np.abs(self.shade_warmth - warmth) * (warmth != 0)
+        contrast_penalty = 0.5 * np.maximum(0, self.shade_lab[:, 0] - (L - 5))
+        scores = delta_e + undertone_penalty + contrast_penalty
+
+        order = np.argsort(scores)
+        best, second = scores[order[0]], scores[order[1]]
+        # Confiance : écart relatif avec la 2e teinte, pondéré par la quantité de peau vue
+        margin = (second - best) / max(second, 1e-6)
+        coverage = min(1.0, skin_fraction / 0.15)
+        confidence = float(np.clip(0.3 + 3 * margin, 0, 1) * (0.6 + 0.4 * coverage))
+
+        return SkinToneEstimate(
+            chosen_color=self.names[order[0]],
+            confidence=round(confidence, 3),
+            undertone=undertone,
+            depth=depth,
+            skin_lab=(round(float(L), 1), round(float(a), 1), round(float(b), 1)),
+            skin_fraction=round(skin_fraction, 3),
+            scores={self.names[i]: round(float(scores[i]), 2) for i in order},
+            elapsed_ms=round((time.perf_counter() - start) * 1000, 2),
+        )
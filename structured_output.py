@@ -0,0 +1,90 @@
+"""Sorties structurées : schéma JSON imposé au modèle et réparation locale.
+
+Le modèle reçoit un `response_format` de type json_schema (mode strict) dont
+les énumérations sont générées depuis les dictionnaires des applications.
+Si une réponse ne respecte malgré tout pas le schéma (ancien modèle, cache,
+réponse tronquée), les valeurs sont ramenées à la valeur valide la plus proche
+plutôt que de basculer directement sur le résultat par défaut.
+"""
+import difflib
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+
+class SchemaValidationError(ValueError):
+    pass
+
+
+def enum_property(choices: Iterable[str], description: str = "") -> Dict:
+    prop = {"type": "string", "enum": list(choices)}
+    if description:
+        prop["description"] = description
+    return prop
+
+
+def strict_object(properties: Dict[str, Dict]) -> Dict:
+    # Le mode strict exige que toutes les propriétés soient requises
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def json_schema_format(name: str, schema: Dict) -> Dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "strict": True, "schema": schema},
+    }
+
+
+def _normalize(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold().strip()
+
+
+def nearest_choice(value, choices: Iterable[str], cutoff: float = 0.6) -> Optional[str]:
+    if not isinstance(value, str) or not value.strip():
+        return None
+    choices = list(choices)
+    if value in choices:
+        return value
+
+    normalized = {_normalize(c): c for c in choices}
+    target = _normalize(value)
+    if target in normalized:
+        return normalized[target]
+
+    # "Rouge Ruby" -> "Ruby", "Gris" -> "Gris/Poivre et Sel"
+    contained = [c for n, c in normalized.items() if n in target or target in n]
+    if len(contained) == 1:
+        return contained[0]
+
+    matches = difflib.get_close_matches(target, list(normalized), n=1, cutoff=cutoff)
+    return normalized[matches[0]] if matches else None
+
+
+def repair_enum(data: Dict, key: str, choices: Iterable[str], repairs: List[str]) -> None:
+    # Remplace data[key] par la valeur valide la plus proche ; lève si aucune ne convient
+    value = data.get(key)
+    choice = nearest_choice(value, choices)
+    if choice is None:
+        raise SchemaValidationError(f"{key}: valeur hors énumération {value!r}")
+    if choice != value:
+        repairs.append(f"{key}: {value!r} -> {choice!r}")
+        data[key] = choice
+
+
+def coerce_bool(value) -> Optional[bool]:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        lowered = _normalize(value)
+        if lowered in ("true", "oui", "yes", "1"):
+            return True
+        if lowered in ("false", "non", "no", "0"):
+            return False
+    if isinstance(value, (int, float)):
+        return bool(value)
+    return None
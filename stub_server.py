@@ -0,0 +1,433 @@
+"""Serveur local compatible OpenAI pour mesurer les applications sans appel facturé.
+
+    python stub_server.py --port 8900 --latency 0.8 --error-rate 0.02
+
+Implémente POST /v1/chat/completions (réponse complète ou streaming SSE) et
+GET /v1/models/<id> (préchauffage du client). La réponse est un JSON figé dans
+le format attendu par LipstickAnalyzer ou BeardAnalyzer, choisi d'après le nom
+du schéma response_format. Latence, gigue, débit du streaming et taux
+d'erreurs (429 avec retry-after-ms, ou 500) sont réglables.
+
+Avec --batch-dir, le serveur imite aussi l'API Batch : POST /v1/files,
+GET /v1/files/<id>/content, POST /v1/batches, GET /v1/batches/<id> et
+POST /v1/batches/<id>/cancel. Fichiers et lots sont rangés sur disque, un
+redémarrage du serveur ne perd donc rien ; un lot est traité (réponses
+figées, erreurs par ligne selon --error-rate) une fois --batch-delay écoulé.
+"""
+import argparse
+import email.parser
+import email.policy
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+LIPSTICK_BODY = {
+    "chosen_color": "Dusty Rose",
+    "analysis": "Coucou beauté! Ta carnation claire aux sous-tons rosés s'illumine avec un rose naturel : "
+                "le Dusty Rose souligne tes lèvres sans durcir ton visage, pour un effet frais et lumineux.",
+    "confidence": 0.9
+}
+
+BEARD_BODY = {
+    "recommended_style": "Barbe Courte",
+    "recommended_color": "Naturel",
+    "trim_length_mm": "6-8",
+    "has_gray": False,
+    "face_shape": "ovale",
+    "problem_areas": ["Zones clairsemées sur les joues", "Contours irréguliers sous la mâchoire"],
+    "recommendations": {
+        "trim": "Dégradé de 8 mm au menton vers 4 mm sur les pattes, contours nets à la tondeuse.",
+        "products": ["L'Oréal Men Expert Barber Club Huile", "L'Oréal Men Expert Barber Club Gel"],
+        "routine": "Lavage quotidien au gel 3-en-1, deux gouttes d'huile le matin, taille des contours tous les 4 jours."
+    },
+    "analysis": "Visage ovale aux proportions équilibrées, densité moyenne avec quelques zones clairsemées. "
+                "Une barbe courte et structurée renforce la ligne de mâchoire tout en masquant les irrégularités.",
+    "confidence": 0.85
+}
+
+# Rapport barbe en deux temps : verdict puis une requête par section
+BEARD_VERDICT_BODY = {
+    **{key: BEARD_BODY[key] for key in ("recommended_style", "recommended_color", "trim_length_mm",
+                                        "has_gray", "face_shape", "problem_areas", "confidence")},
+    "trim": BEARD_BODY["recommendations"]["trim"],
+}
+
+CANNED_BODIES = {
+    "lipstick_recommendation": LIPSTICK_BODY,
+    "beard_analysis": BEARD_BODY,
+    "beard_verdict": BEARD_VERDICT_BODY,
+    "beard_section_products": {"products": BEARD_BODY["recommendations"]["products"]},
+    "beard_section_routine": {"routine": BEARD_BODY["recommendations"]["routine"]},
+    "beard_section_analysis": {"analysis": BEARD_BODY["analysis"]},
+}
+
+# Schémas "<analyseur>_session_<mode>" des sessions multi-photos
+SESSION_BODIES = {"lipstick": LIPSTICK_BODY, "beard": BEARD_BODY}
+
+# Tokens image facturés par OpenAI selon le niveau de détail (approximation)
+IMAGE_TOKENS = {"low": 85, "high": 765, "auto": 765}
+
+
+@dataclass
+class StubConfig:
+    latency_s: float = 0.5
+    jitter_s: float = 0.1
+    error_rate: float = 0.0
+    # Part des erreurs renvoyées en 429 (le reste en 500)
+    rate_limit_share: float = 0.5
+    chunk_chars: int = 12
+    chunk_delay_s: float = 0.01
+    # API Batch : répertoire des fichiers et lots (None = endpoints désactivés)
+    batch_dir: Optional[str] = None
+    batch_delay_s: float = 1.0
+
+
+class StubStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def enter(self) -> None:
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self, error: bool) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.errors += int(error)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors, "peak_in_flight": self.peak_in_flight}
+
+
+def _usage(request: Dict, content: str) -> Dict:
+    prompt_chars = 0
+    image_tokens = 0
+    for message in request.get("messages", []):
+        parts = message.get("content")
+        if isinstance(parts, str):
+            prompt_chars += len(parts)
+            continue
+        for part in parts or []:
+            if part.get("type") == "text":
+                prompt_chars += len(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                image_tokens += IMAGE_TOKENS.get(part["image_url"].get("detail", "auto"), 765)
+    prompt_tokens = prompt_chars // 4 + image_tokens
+    completion_tokens = max(1, len(content) // 4)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def canned_content(request: Dict) -> str:
+    json_schema = (request.get("response_format") or {}).get("json_schema", {})
+    schema_name = json_schema.get("name") or ""
+    analyzer, _, mode = schema_name.partition("_session_")
+    if mode:
+        # Session multi-photos : la même réponse figée pour chaque photo (per_photo)
+        item = SESSION_BODIES.get(analyzer, LIPSTICK_BODY)
+        photos = json_schema.get("schema", {}).get("properties", {})
+        body = item if mode == "consensus" else {key: item for key in photos}
+    else:
+        body = CANNED_BODIES.get(schema_name, LIPSTICK_BODY)
+    return json.dumps(body, ensure_ascii=False)
+
+
+def completion_body(request: Dict, content: str) -> Dict:
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "stub"),
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": content}}],
+        "usage": _usage(request, content),
+    }
+
+
+class BatchStore:
+    # Fichiers et lots de l'API Batch, un JSON de métadonnées par objet sur disque
+    TERMINAL = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(self, directory: str, delay_s: float, error_rate: float):
+        self.root = Path(directory)
+        (self.root / "files").mkdir(parents=True, exist_ok=True)
+        (self.root / "batches").mkdir(parents=True, exist_ok=True)
+        self.delay_s = delay_s
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+
+    def _meta(self, kind: str, object_id: str) -> Optional[Dict]:
+        path = self.root / kind / f"{object_id}.json"
+        if "/" in object_id or not path.exists():
+            return None
+        return json.loads(path.read_text(encoding="utf-8"))
+
+    def _save(self, kind: str, meta: Dict) -> Dict:
+        (self.root / kind / f"{meta['id']}.json").write_text(json.dumps(meta), encoding="utf-8")
+        return meta
+
+    def add_file(self, data: bytes, filename: str, purpose: str) -> Dict:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        (self.root / "files" / file_id).write_bytes(data)
+        return self._save("files", {"id": file_id, "object": "file", "bytes": len(data),
+                                    "created_at": int(time.time()), "filename": filename,
+                                    "purpose": purpose, "status": "processed"})
+
+    def get_file(self, file_id: str) -> Optional[Dict]:
+        return self._meta("files", file_id)
+
+    def file_content(self, file_id: str) -> Optional[bytes]:
+        if self.get_file(file_id) is None:
+            return None
+        return (self.root / "files" / file_id).read_bytes()
+
+    def create_batch(self, params: Dict) -> Optional[Dict]:
+        if self.get_file(params.get("input_file_id", "")) is None:
+            return None
+        now = int(time.time())
+        return self._save("batches", {
+            "id": f"batch_{uuid.uuid4().hex[:24]}", "object": "batch",
+            "endpoint": params.get("endpoint"), "input_file_id": params["input_file_id"],
+            "completion_window": params.get("completion_window", "24h"), "status": "validating",
+            "output_file_id": None, "error_file_id": None, "errors": None,
+            "created_at": now, "in_progress_at": None, "completed_at": None, "cancelled_at": None,
+            "expires_at": now + 24 * 3600, "metadata": params.get("metadata"),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        })
+
+    def get_batch(self, batch_id: str) -> Optional[Dict]:
+        # Le lot avance à la lecture : en cours, puis traité d'un coup après delay_s
+        with self._lock:
+            batch = self._meta("batches", batch_id)
+            if batch is None or batch["status"] in self.TERMINAL:
+                return batch
+            if batch["status"] == "validating":
+                batch.update(status="in_progress", in_progress_at=int(time.time()))
+            elif time.time() - batch["in_progress_at"] >= self.delay_s:
+                self._process(batch)
+            return self._save("batches", batch)
+
+    def cancel_batch(self, batch_id: str) -> Optional[Dict]:
+        with self._lock:
+            batch = self._meta("batches", batch_id)
+            if batch is not None and batch["status"] not in self.TERMINAL:
+                batch.update(status="cancelled", cancelled_at=int(time.time()))
+                self._save("batches", batch)
+            return batch
+
+    def _process(self, batch: Dict) -> None:
+        outputs: List[str] = []
+        errors: List[str] = []
+        lines = self.file_content(batch["input_file_id"]).decode("utf-8").splitlines()
+        for line in filter(None, lines):
+            try:
+                item = json.loads(line)
+                custom_id, request = item["custom_id"], item["body"]
+            except (ValueError, KeyError):
+                errors.append(json.dumps({"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": None,
+                                          "response": None,
+                                          "error": {"code": "invalid_request", "message": "Ligne illisible"}}))
+                continue
+            entry = {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": custom_id, "error": None}
+            if random.random() < self.error_rate:
+                entry["response"] = {"status_code": 500, "request_id": uuid.uuid4().hex,
+                                     "body": {"error": {"message": "Internal error (stub)",
+                                                        "type": "server_error"}}}
+                errors.append(json.dumps(entry, ensure_ascii=False))
+            else:
+                entry["response"] = {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                     "body": completion_body(request, canned_content(request))}
+                outputs.append(json.dumps(entry, ensure_ascii=False))
+        if outputs:
+            batch["output_file_id"] = self.add_file("\n".join(outputs).encode("utf-8") + b"\n",
+                                                    "batch_output.jsonl", "batch_output")["id"]
+        if errors:
+            batch["error_file_id"] = self.add_file("\n".join(errors).encode("utf-8") + b"\n",
+                                                   "batch_errors.jsonl", "batch_output")["id"]
+        batch.update(status="completed", completed_at=int(time.time()),
+                     request_counts={"total": len(outputs) + len(errors),
+                                     "completed": len(outputs), "failed": len(errors)})
+
+
+def _chunks(text: str, size: int) -> Iterator[str]:
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = StubConfig()
+    stats = StubStats()
+    batches: Optional[BatchStore] = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: Dict, headers: Tuple[Tuple[str, str], ...] = ()) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self) -> None:
+        self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_GET(self):
+        if self.path.startswith("/v1/models/"):
+            model = self.path.rsplit("/", 1)[-1]
+            self._send_json(200, {"id": model, "object": "model", "created": 0, "owned_by": "stub"})
+            return
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        if self.batches is not None and parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content":
+            content = self.batches.file_content(parts[2])
+            if content is None:
+                return self._not_found()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        if self.batches is not None and len(parts) == 3 and parts[:2] in (["v1", "files"], ["v1", "batches"]):
+            found = (self.batches.get_file if parts[1] == "files" else self.batches.get_batch)(parts[2])
+            return self._send_json(200, found) if found is not None else self._not_found()
+        self._not_found()
+
+    def _batch_post(self, raw: bytes) -> None:
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        if parts == ["v1", "files"]:
+            # Envoi multipart du SDK : champs "purpose" et "file"
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode("latin-1") + raw)
+            fields = {part.get_param("name", header="content-disposition"): part
+                      for part in message.iter_parts()} if message.is_multipart() else {}
+            if "file" not in fields:
+                return self._send_json(400, {"error": {"message": "file manquant",
+                                                       "type": "invalid_request_error"}})
+            upload = fields["file"]
+            purpose = fields["purpose"].get_content().strip() if "purpose" in fields else "batch"
+            return self._send_json(200, self.batches.add_file(upload.get_payload(decode=True) or b"",
+                                                              upload.get_filename() or "upload.jsonl", purpose))
+        if parts == ["v1", "batches"]:
+            batch = self.batches.create_batch(json.loads(raw))
+            return self._send_json(200, batch) if batch is not None else self._not_found()
+        if len(parts) == 4 and parts[:2] == ["v1", "batches"] and parts[3] == "cancel":
+            batch = self.batches.cancel_batch(parts[2])
+            return self._send_json(200, batch) if batch is not None else self._not_found()
+        self._not_found()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        if self.batches is not None and self.path.startswith(("/v1/files", "/v1/batches")):
+            self._batch_post(raw)
+            return
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._not_found()
+            return
+
+        self.stats.enter()
+        error = False
+        try:
+            request = json.loads(raw)
+            config = self.config
+            time.sleep(max(0.0, random.gauss(config.latency_s, config.jitter_s)))
+
+            if random.random() < config.error_rate:
+                error = True
+                if random.random() < config.rate_limit_share:
+                    self._send_json(429, {"error": {"message": "Rate limit reached (stub)", "type": "requests",
+                                                    "code": "rate_limit_exceeded"}},
+                                    headers=(("retry-after-ms", "200"),))
+                else:
+                    self._send_json(500, {"error": {"message": "Internal error (stub)", "type": "server_error"}})
+                return
+
+            content = canned_content(request)
+            if request.get("stream"):
+                self._stream(request, content)
+            else:
+                self._send_json(200, completion_body(request, content))
+        finally:
+            self.stats.leave(error)
+
+    def _stream(self, request: Dict, content: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": request.get("model", "stub")}
+
+        def send(payload) -> None:
+            data = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+            self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        for piece in _chunks(content, self.config.chunk_chars):
+            send({**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+            time.sleep(self.config.chunk_delay_s)
+        send({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send({**base, "choices": [], "usage": _usage(request, content)})
+        send("[DONE]")
+
+
+def start_stub_server(config: StubConfig, host: str = "127.0.0.1",
+                      port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    # port=0 : port libre choisi par le système ; retourne le base_url à passer au client
+    batches = (BatchStore(config.batch_dir, config.batch_delay_s, config.error_rate)
+               if config.batch_dir else None)
+    handler = type("ConfiguredStubHandler", (StubHandler,),
+                   {"config": config, "stats": StubStats(), "batches": batches})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="openai-stub", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serveur local compatible OpenAI (chat.completions, Batch)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.5, help="Latence moyenne en secondes")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Écart-type de la latence")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Part des requêtes en erreur (0-1)")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="Délai entre fragments en streaming")
+    parser.add_argument("--batch-dir", help="Active l'API Batch, fichiers et lots rangés dans ce dossier")
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="Durée de traitement d'un lot")
+    args = parser.parse_args()
+
+    config = StubConfig(latency_s=args.latency, jitter_s=args.jitter, error_rate=args.error_rate,
+                        chunk_delay_s=args.chunk_delay, batch_dir=args.batch_dir,
+                        batch_delay_s=args.batch_delay)
+    server, base_url = start_stub_server(config, args.host, args.port)
+    print(f"Stub OpenAI prêt : OPENAI_BASE_URL={base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import threading
+
+import pytest
+
+from analysis_pool import AnalysisPool, PoolFullError
+
+
+@pytest.fixture
+def pool():
+    return AnalysisPool(workers=1, max_queue=2)
+
+
+def blocker():
+    started, release = threading.Event(), threading.Event()
+
+    def fn(job):
+        started.set()
+        release.wait(5)
+        return "fini"
+    return fn, started, release
+
+
+def test_job_runs_in_a_worker_and_returns_its_result(pool):
+    threads = []
+    job = pool.submit(lambda job, x: threads.append(threading.current_thread().name) or x * 2, 21)
+    assert job.result() == 42
+    assert job.state == "done"
+    assert threads[0].startswith("analysis")
+    assert pool.snapshot()["completed"] == 1
+
+
+def test_outcome_and_notice_are_reported_on_the_job(pool):
+    def fn(job):
+        job.report("degraded", ("warning", "Service indisponible"))
+        return {}
+    job = pool.submit(fn)
+    job.result()
+    assert (job.outcome, job.notice) == ("degraded", ("warning", "Service indisponible"))
+
+
+def test_progress_is_a_snapshot(pool):
+    partial = {"analysis": "Vot"}
+
+    def fn(job):
+        job.update(partial, {"chosen_color"})
+        partial["analysis"] = "Votre teint"
+        return None
+    job = pool.submit(fn)
+    job.result()
+    assert job.progress() == ({"analysis": "Vot"}, {"chosen_color"})
+
+
+def test_worker_errors_reach_the_page(pool):
+    job = pool.submit(lambda job: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        job.result()
+    assert pool.snapshot()["failed"] == 1
+
+
+def test_full_pool_rejects_new_jobs(pool):
+    fn, started, release = blocker()
+    running = pool.submit(fn)
+    started.wait(2)
+    queued = [pool.submit(lambda job: None) for _ in range(2)]
+    assert pool.queue_position(queued[1]) == 1
+    with pytest.raises(PoolFullError):
+        pool.submit(lambda job: None)
+    assert pool.snapshot()["rejected"] == 1
+    release.set()
+    assert running.result() == "fini"
+    for job in queued:
+        job.result()
+
+
+def test_speculative_jobs_only_get_half_the_queue(pool):
+    fn, started, release = blocker()
+    pool.submit(fn)
+    started.wait(2)
+    pool.submit(lambda job: None, speculative=True)
+    with pytest.raises(PoolFullError):
+        pool.submit(lambda job: None, speculative=True)
+    # Le clic a encore sa place
+    clicked = pool.submit(lambda job: "clic")
+    release.set()
+    assert clicked.result() == "clic"
+
+
+def test_cancelled_job_never_starts(pool):
+    fn, started, release = blocker()
+    pool.submit(fn)
+    started.wait(2)
+    ran = []
+    job = pool.submit(lambda job: ran.append(1), speculative=True)
+    pool.cancel(job.id)
+    release.set()
+    assert job.result() is None
+    assert ran == []
+    assert pool.get(job.id) is None
+    assert pool.snapshot()["cancelled"] == 1
+
+
+def test_failed_precondition_abandons_the_job(pool):
+    ran = []
+    job = pool.submit(lambda job: ran.append(1), precondition=lambda: False)
+    assert job.result() is None
+    assert ran == []
+    assert job.started_at is None and job.finished_at is not None
+
+
+def test_claim_keeps_a_speculative_job(pool):
+    job = pool.submit(lambda job: "prêt", speculative=True)
+    job.result()
+    assert pool.claim(job.id) is job and job.claimed
+    pool.cancel(job.id)
+    assert pool.claim(job.id) is None
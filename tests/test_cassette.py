@@ -0,0 +1,114 @@
+import base64
+import json
+
+import httpx
+import pytest
+
+from cassette import (ELAPSED_HEADER, STATUS_HEADER, CassetteStore, CassetteTransport, cassette_mode_by_env,
+                      normalize_request, request_key)
+
+IMAGE = base64.b64encode(b"\xff\xd8 une photo").decode()
+
+
+def body(**overrides):
+    payload = {
+        "model": "gpt-4o-mini",
+        "max_tokens": 300,
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "Analyse"},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{IMAGE}", "detail": "low"}},
+        ]}],
+    }
+    payload.update(overrides)
+    return json.dumps(payload).encode()
+
+
+def key_of(method, path, content):
+    return request_key(normalize_request(method, path, content))
+
+
+def test_images_are_replaced_by_their_hash():
+    normalized = normalize_request("post", "/v1/chat/completions", body())
+    url = normalized["body"]["messages"][0]["content"][1]["image_url"]["url"]
+    assert url.startswith("data:image/jpeg;sha256,")
+    assert IMAGE not in json.dumps(normalized)
+    assert normalized["method"] == "POST"
+
+
+def test_key_ignores_json_key_order_and_formatting():
+    reordered = json.dumps(dict(reversed(list(json.loads(body()).items()))), indent=2).encode()
+    assert key_of("POST", "/v1/chat/completions", reordered) == key_of("POST", "/v1/chat/completions", body())
+
+
+@pytest.mark.parametrize("method, path, content", [
+    ("POST", "/v1/chat/completions", body(max_tokens=600)),
+    ("POST", "/v1/batches", body()),
+    ("GET", "/v1/chat/completions", body()),
+])
+def test_key_changes_with_the_request(method, path, content):
+    assert key_of(method, path, content) != key_of("POST", "/v1/chat/completions", body())
+
+
+def test_key_changes_with_the_image():
+    other = body().replace(IMAGE.encode(), base64.b64encode(b"une autre photo"))
+    assert key_of("POST", "/v1/chat/completions", other) != key_of("POST", "/v1/chat/completions", body())
+
+
+def test_non_json_body_is_hashed():
+    normalized = normalize_request("POST", "/v1/files", b"--boundary\r\n\xff\xfe")
+    assert set(normalized["body"]) == {"sha256"}
+
+
+def test_mode_from_env(monkeypatch):
+    monkeypatch.setenv("BEAUTY_CASSETTE", " Replay ")
+    assert cassette_mode_by_env() == "replay"
+    monkeypatch.setenv("BEAUTY_CASSETTE", "rewind")
+    with pytest.raises(ValueError):
+        cassette_mode_by_env()
+
+
+def client(store, mode, statuses=None, host="api.openai.com"):
+    responses = iter(statuses or [])
+    inner = httpx.MockTransport(
+        lambda request: httpx.Response(next(responses), json={"id": "chatcmpl-1"},
+                                       headers={"x-request-id": "abc"}))
+    return httpx.Client(base_url=f"https://{host}", transport=CassetteTransport(store, mode, inner))
+
+
+def test_record_then_replay_without_network(tmp_path):
+    store = CassetteStore(tmp_path)
+    recorded = client(store, "record", [200]).post("/v1/chat/completions", content=body(),
+                                                   headers={"authorization": "Bearer sk-1"})
+    assert recorded.headers[STATUS_HEADER] == "recorded"
+
+    # Autre hôte, autre clé d'API : même entrée
+    replayed = client(store, "replay", host="localhost:8000").post(
+        "/v1/chat/completions", content=body(), headers={"authorization": "Bearer sk-2"})
+    assert replayed.status_code == 200
+    assert replayed.json() == {"id": "chatcmpl-1"}
+    assert replayed.headers[STATUS_HEADER] == "hit"
+    assert float(replayed.headers[ELAPSED_HEADER]) >= 0
+    # Seuls les en-têtes stables sont gardés
+    assert "x-request-id" not in replayed.headers
+    assert len(store) == 1
+
+
+def test_replay_miss_is_an_explicit_404(tmp_path):
+    response = client(CassetteStore(tmp_path), "replay").post("/v1/chat/completions", content=body())
+    assert response.status_code == 404
+    assert response.json()["error"]["code"] == "cassette_miss"
+    assert response.headers[STATUS_HEADER] == "miss"
+
+
+def test_errors_never_overwrite_a_recorded_success(tmp_path):
+    store = CassetteStore(tmp_path)
+    recorder = client(store, "record", [503, 200, 429])
+    assert recorder.post("/v1/chat/completions", content=body()).headers[STATUS_HEADER] == "recorded"
+    assert recorder.post("/v1/chat/completions", content=body()).headers[STATUS_HEADER] == "recorded"
+    throttled = recorder.post("/v1/chat/completions", content=body())
+    assert throttled.status_code == 429
+    assert throttled.headers[STATUS_HEADER] == "kept"
+
+    replayed = client(store, "replay").post("/v1/chat/completions", content=body())
+    assert replayed.status_code == 200
+    assert store.snapshot()["kept"] == 1
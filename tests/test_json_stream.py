@@ -0,0 +1,108 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from json_stream import IncrementalJSONParser, stream_completion
+
+DOCUMENT = {
+    "analysis": "Teint \"lumineux\", sous-ton chaud.\nÀ tester : é ✓",
+    "chosen_color": "Rouge Passion",
+    "confidence": 0.85,
+    "has_gray": False,
+    "extra": None,
+    "products": [{"name": "Huile", "price": 12}, {"name": "Baume", "price": -3.5e1}],
+    "steps": ["laver", "sécher"],
+}
+
+
+def feed_all(text, size):
+    parser = IncrementalJSONParser()
+    for i in range(0, len(text), size):
+        parser.feed(text[i:i + size])
+    return parser
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 1000])
+def test_any_chunking_rebuilds_the_document(size):
+    parser = feed_all(json.dumps(DOCUMENT, ensure_ascii=False), size)
+    assert parser.root == DOCUMENT
+    assert parser.done
+    assert parser.completed == set(DOCUMENT)
+
+
+def test_ascii_escapes_split_across_chunks():
+    # é coupé entre deux fragments
+    parser = feed_all(json.dumps({"analysis": "café"}), 1)
+    assert parser.root == {"analysis": "café"}
+
+
+def test_partial_string_is_visible_before_it_ends():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"analysis": "Votre te') == {"analysis": "Votre te"}
+    assert parser.completed == set()
+    parser.feed('int", "chosen')
+    assert parser.root == {"analysis": "Votre teint"}
+    assert parser.completed == {"analysis"}
+
+
+def test_nested_value_completes_its_root_key_when_closed():
+    parser = IncrementalJSONParser()
+    parser.feed('{"products": [{"name": "Huile"}')
+    assert "products" not in parser.completed
+    parser.feed(", {\"name\": \"Baume\"}]")
+    assert parser.completed == {"products"}
+
+
+def test_literal_is_completed_by_the_next_delimiter():
+    parser = IncrementalJSONParser()
+    parser.feed('{"confidence": 0.8')
+    assert "confidence" not in parser.completed
+    parser.feed("5}")
+    assert parser.root == {"confidence": 0.85}
+    assert parser.completed == {"confidence"}
+
+
+def test_text_around_the_object_is_ignored():
+    parser = feed_all('```json\n{"chosen_color": "Nude"}\n```', 3)
+    assert parser.root == {"chosen_color": "Nude"}
+    assert parser.done
+
+
+def test_nothing_before_the_first_brace():
+    parser = IncrementalJSONParser()
+    assert parser.feed("Voici la réponse : ") == {}
+    assert parser.root is None
+
+
+def chunk(content=None, finish_reason=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=finish_reason)]
+    return SimpleNamespace(choices=choices if content is not None or finish_reason else [], usage=usage)
+
+
+def fake_client(chunks, seen):
+    def create(**request):
+        seen.update(request)
+        return iter(chunks)
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def test_stream_completion_reports_progress_and_timing():
+    text = json.dumps({"analysis": "Bonne mine", "chosen_color": "Nude"})
+    usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+    chunks = [chunk("")] + [chunk(text[i:i + 4]) for i in range(0, len(text), 4)]
+    chunks += [chunk(finish_reason="stop"), chunk(usage=usage)]
+    updates, seen = [], {}
+
+    content, parser, timing = stream_completion(
+        fake_client(chunks, seen), {"model": "m"},
+        lambda partial, completed: updates.append((dict(partial), set(completed))))
+
+    assert content == text
+    assert parser.root == {"analysis": "Bonne mine", "chosen_color": "Nude"}
+    assert seen["stream"] is True and seen["stream_options"] == {"include_usage": True}
+    assert timing.finish_reason == "stop"
+    assert timing.usage is usage
+    assert timing.chunks == len(chunks) - 3
+    assert 0 <= timing.first_token_s <= timing.first_content_s <= timing.total_s
+    assert updates[-1] == (parser.root, {"analysis", "chosen_color"})
@@ -0,0 +1,60 @@
+import pytest
+
+from near_duplicate import INDEX_FILENAME, NearDuplicateIndex
+from result_cache import ResultCache
+
+NS = "lipstick"
+BASE = 0x0123456789ABCDEF
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(directory=tmp_path, enabled=True)
+
+
+def index_for(cache, max_distance=6):
+    return NearDuplicateIndex(cache.directory, max_distance=max_distance, enabled=True, cache=cache)
+
+
+def test_lookup_returns_every_candidate_nearest_first(cache):
+    index = index_for(cache)
+    index.add(NS, BASE ^ 0b111, "loin")
+    index.add(NS, BASE ^ 0b1, "proche")
+    index.add(NS, BASE ^ 0xFFFF, "hors seuil")
+    assert index.lookup(NS, BASE) == [("proche", 1), ("loin", 3)]
+    assert index.lookup("beard", BASE) == []
+
+
+def test_find_skips_entries_gone_from_the_cache(cache, monkeypatch):
+    index = index_for(cache)
+    index.add(NS, BASE ^ 0b1, "évincée")
+    index.add(NS, BASE ^ 0b11, "présente")
+    cache.set("présente", {"analysis": "ok"})
+    monkeypatch.setattr("near_duplicate.phash", lambda image_bytes: BASE)
+    assert index.find(cache, NS, b"photo") == ({"analysis": "ok"}, BASE)
+    # L'entrée périmée n'est plus proposée
+    assert index.lookup(NS, BASE) == [("présente", 2)]
+    assert index.snapshot()["stale"] == 1
+
+
+def test_seen_fingerprint_takes_the_new_key(cache):
+    index = index_for(cache)
+    index.add(NS, BASE, "ancienne")
+    index.add(NS, BASE, "nouvelle")
+    assert index.lookup(NS, BASE) == [("nouvelle", 0)]
+    assert len(index) == 1
+
+
+def test_load_compacts_the_log_and_drops_dead_keys(cache):
+    index = index_for(cache)
+    index.add(NS, BASE, "ancienne")
+    index.add(NS, BASE, "nouvelle")
+    index.add(NS, BASE ^ 0b1, "disparue")
+    cache.set("nouvelle", {"analysis": "ok"})
+    log = cache.directory / INDEX_FILENAME
+    log.write_text(log.read_text(encoding="utf-8") + "ligne tronq", encoding="utf-8")
+
+    reloaded = index_for(cache)
+    assert reloaded.lookup(NS, BASE) == [("nouvelle", 0)]
+    assert log.read_text(encoding="utf-8").splitlines() == [f"{NS}\t{BASE:016x}\tnouvelle"]
+    assert not list(cache.directory.glob("*.tmp"))
@@ -0,0 +1,28 @@
+import httpx
+import pytest
+
+pytest.importorskip("openai")
+from openai_client import CountingTransport, PoolStats  # noqa: E402
+
+
+def send(transport: httpx.BaseTransport) -> httpx.Response:
+    return transport.handle_request(httpx.Request("GET", "https://api.openai.com/v1/models"))
+
+
+def test_responses_are_counted():
+    stats = PoolStats()
+    send(CountingTransport(httpx.MockTransport(lambda request: httpx.Response(200)), stats))
+    snapshot = stats.snapshot()
+    assert (snapshot["requests"], snapshot["responses"], snapshot["in_flight"]) == (1, 1, 0)
+
+
+def test_transport_errors_do_not_leak_in_flight():
+    def fail(request):
+        raise httpx.ConnectTimeout("délai dépassé", request=request)
+    stats = PoolStats()
+    transport = CountingTransport(httpx.MockTransport(fail), stats)
+    for _ in range(3):
+        with pytest.raises(httpx.ConnectTimeout):
+            send(transport)
+    snapshot = stats.snapshot()
+    assert (snapshot["transport_errors"], snapshot["in_flight"], snapshot["peak_in_flight"]) == (3, 0, 1)
@@ -0,0 +1,143 @@
+import threading
+import time
+
+import pytest
+
+from rate_limiter import (FileBackend, LocalBackend, RateLimiter, RateLimitExceeded, _new_bucket, _refill,
+                          _wait_for, estimate_request_tokens)
+
+
+def drain(backend, kind):
+    backend._state[kind]["level"] = 0.0
+    backend._state[kind]["updated"] = time.time()
+
+
+def test_refill_is_continuous_and_capped():
+    bucket = _new_bucket(60)
+    bucket["level"], bucket["updated"] = 0.0, 100.0
+    _refill(bucket, 110.0)
+    # 60 par minute : 1 par seconde
+    assert bucket["level"] == pytest.approx(10.0)
+    _refill(bucket, 1000.0)
+    assert bucket["level"] == 60.0
+
+
+def test_wait_for_missing_budget():
+    bucket = {"level": 10.0, "capacity": 60.0, "updated": 0.0}
+    assert _wait_for(bucket, 5) == 0.0
+    assert _wait_for(bucket, 20) == pytest.approx(10.0)
+    # Plus gros que le seau : attend seulement qu'il soit plein
+    assert _wait_for(bucket, 1000) == pytest.approx(50.0)
+
+
+def test_reserve_takes_a_request_and_its_tokens():
+    backend = LocalBackend(rpm=10, tpm=1000)
+    assert backend.reserve(300) == 0
+    state = backend.snapshot()
+    assert state["requests"]["level"] == pytest.approx(9, abs=0.01)
+    assert state["tokens"]["level"] == pytest.approx(700, abs=1)
+
+
+def test_reserve_returns_the_wait_without_reserving():
+    backend = LocalBackend(rpm=60, tpm=1000)
+    drain(backend, "requests")
+    wait = backend.reserve(10)
+    assert 0 < wait <= 1.0
+    assert backend.snapshot()["tokens"]["level"] == pytest.approx(1000)
+
+
+def test_headers_resync_limits_and_levels():
+    backend = LocalBackend(rpm=500, tpm=200_000)
+    limiter = RateLimiter(backend, enabled=True)
+    limiter.observe_headers({"x-ratelimit-limit-requests": "5000", "x-ratelimit-remaining-requests": "12",
+                             "x-ratelimit-limit-tokens": "oops"})
+    state = backend.snapshot()
+    assert state["requests"]["capacity"] == 5000
+    assert state["requests"]["level"] == pytest.approx(12, abs=1)
+    assert state["tokens"]["capacity"] == 200_000
+
+
+def test_acquire_admits_within_budget():
+    limiter = RateLimiter(LocalBackend(rpm=100, tpm=10_000), enabled=True)
+    assert limiter.acquire(100) == pytest.approx(0, abs=0.01)
+    assert limiter.stats["admitted"] == 1
+
+
+def test_acquire_sheds_when_the_predicted_wait_is_too_long():
+    backend = LocalBackend(rpm=60, tpm=60)
+    drain(backend, "tokens")
+    limiter = RateLimiter(backend, max_wait=1.0, enabled=True)
+    # 30 tokens à 1 token/s : 30 s d'attente prévue
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(30)
+    assert limiter.stats["shed"] == 1
+
+
+def test_acquire_waits_for_the_refill():
+    backend = LocalBackend(rpm=600, tpm=100_000)
+    drain(backend, "requests")
+    limiter = RateLimiter(backend, max_wait=2.0, enabled=True)
+    # 10 requêtes par seconde : une place en 0,1 s
+    waited = limiter.acquire(1)
+    assert 0.05 < waited < 1.0
+    assert limiter.stats["waited"] == 1
+
+
+def test_waiting_callers_are_served_in_order():
+    backend = LocalBackend(rpm=1200, tpm=100_000)
+    drain(backend, "requests")
+    limiter = RateLimiter(backend, max_wait=5.0, enabled=True)
+    order = []
+
+    def call(i):
+        limiter.acquire(1)
+        order.append(i)
+
+    threads = []
+    for i in range(4):
+        threads.append(threading.Thread(target=call, args=(i,)))
+        threads[-1].start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    assert order == [0, 1, 2, 3]
+
+
+def test_try_acquire_never_waits():
+    backend = LocalBackend(rpm=60, tpm=1000)
+    limiter = RateLimiter(backend, enabled=True)
+    assert limiter.try_acquire(10)
+    drain(backend, "requests")
+    assert not limiter.try_acquire(10)
+
+
+def test_disabled_limiter_admits_everything():
+    backend = LocalBackend(rpm=1, tpm=1)
+    drain(backend, "requests")
+    limiter = RateLimiter(backend, enabled=False)
+    assert limiter.acquire(10_000) == 0.0
+    assert limiter.try_acquire(10_000)
+
+
+def test_file_backend_is_shared_between_instances(tmp_path):
+    path = tmp_path / "state.json"
+    first, second = FileBackend(path, rpm=10, tpm=1000), FileBackend(path, rpm=10, tpm=1000)
+    assert first.reserve(400) == 0
+    assert second.reserve(400) == 0
+    assert first.snapshot()["tokens"]["level"] == pytest.approx(200, abs=1)
+    assert second.reserve(400) > 0
+
+
+def test_estimate_counts_text_images_and_output():
+    request = {
+        "max_tokens": 300,
+        "messages": [
+            {"role": "system", "content": "x" * 40},
+            {"role": "user", "content": [
+                {"type": "text", "text": "y" * 80},
+                {"type": "image_url", "image_url": {"url": "data:...", "detail": "low"}},
+                {"type": "image_url", "image_url": {"url": "data:..."}},
+            ]},
+        ],
+    }
+    assert estimate_request_tokens(request) == 120 // 4 + 85 + 765 + 300
@@ -0,0 +1,196 @@
+import threading
+import time
+
+import httpx
+import pytest
+
+openai = pytest.importorskip("openai")
+
+import resilience  # noqa: E402
+from rate_limiter import RateLimiter  # noqa: E402
+from resilience import (CircuitBreaker, CircuitOpenError, ResilientCaller, is_retryable,  # noqa: E402
+                        latency_class, retry_after_seconds)
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def status_error(status, headers=None, code=None):
+    response = httpx.Response(status, request=REQUEST, headers=headers or {})
+    return openai.APIStatusError(f"HTTP {status}", response=response,
+                                 body={"code": code} if code else None)
+
+
+def caller(**kwargs):
+    kwargs.setdefault("hedging", False)
+    instance = ResilientCaller(limiter=RateLimiter(enabled=False), **kwargs)
+    # Pas d'attente réelle entre les tentatives
+    instance._backoff = lambda attempt, error: 0.0
+    return instance
+
+
+@pytest.mark.parametrize("error, expected", [
+    (openai.APIConnectionError(request=REQUEST), True),
+    (openai.APITimeoutError(REQUEST), True),
+    (status_error(408), True),
+    (status_error(429), True),
+    (status_error(500), True),
+    (status_error(503), True),
+    (status_error(400), False),
+    (status_error(401), False),
+    (status_error(429, code="insufficient_quota"), False),
+    (ValueError("réponse illisible"), False),
+])
+def test_retry_classification(error, expected):
+    assert is_retryable(error) is expected
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"retry-after": "3"}, 3.0),
+    ({"retry-after": "Wed, 21 Oct 2026 07:28:00 GMT"}, None),
+    ({}, None),
+])
+def test_retry_after(headers, expected):
+    assert retry_after_seconds(status_error(429, headers)) == expected
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, cooldown_seconds=60)
+    for _ in range(2):
+        breaker.record_failure()
+    breaker.record_success()
+    for _ in range(3):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert breaker.snapshot()["rejected"] == 1
+
+
+def test_half_open_lets_a_single_probe_through():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    # Sonde en échec : nouveau refroidissement complet
+    breaker.record_failure()
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_ignored_error_only_releases_the_probe():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_ignored()
+    assert breaker.state == "half_open"
+    assert breaker.snapshot()["consecutive_failures"] == 1
+    breaker.before_call()
+
+
+def test_transient_errors_are_retried():
+    attempts = []
+
+    def flaky(timeout):
+        attempts.append(timeout)
+        if len(attempts) < 3:
+            raise status_error(503)
+        return "ok"
+
+    resilient = caller(max_attempts=3)
+    assert resilient.call(flaky) == "ok"
+    assert len(attempts) == 3
+    assert resilient.stats["retries"] == 2
+    assert resilient.breaker.state == "closed"
+
+
+def test_retries_stop_at_max_attempts():
+    resilient = caller(max_attempts=2)
+    attempts = []
+    with pytest.raises(openai.APIStatusError):
+        resilient.call(lambda timeout: attempts.append(1) or (_ for _ in ()).throw(status_error(500)))
+    assert len(attempts) == 2
+    assert resilient.stats["failures"] == 1
+
+
+def test_non_retryable_error_is_raised_at_once_without_touching_the_breaker():
+    resilient = caller(max_attempts=3, breaker=CircuitBreaker(failure_threshold=2))
+    resilient.breaker.record_failure()
+    attempts = []
+    with pytest.raises(openai.APIStatusError):
+        resilient.call(lambda timeout: attempts.append(1) or (_ for _ in ()).throw(status_error(400)))
+    assert attempts == [1]
+    assert resilient.breaker.snapshot()["consecutive_failures"] == 1
+
+
+def test_open_breaker_fails_fast():
+    resilient = caller(breaker=CircuitBreaker(failure_threshold=1, cooldown_seconds=60))
+    resilient.breaker.record_failure()
+    called = []
+    with pytest.raises(CircuitOpenError):
+        resilient.call(lambda timeout: called.append(1))
+    assert called == []
+
+
+def test_attempt_timeout_is_bounded_by_the_deadline():
+    resilient = caller(deadline_seconds=5, attempt_timeout=30)
+    timeouts = []
+    resilient.call(lambda timeout: timeouts.append(timeout))
+    assert timeouts[0] <= 5
+
+
+def test_latency_class_separates_request_shapes():
+    def request(max_tokens, *details):
+        parts = [{"type": "image_url", "image_url": {"url": "data:", "detail": d}} for d in details]
+        return {"max_tokens": max_tokens, "messages": [{"role": "user", "content": parts}]}
+
+    assert latency_class("lipstick", request(150, "low")) == "lipstick:150:1xlow"
+    assert latency_class("beard", request(900, "high", "high")) == "beard:900:2xhigh"
+    assert latency_class("beard:products", {"max_tokens": 300, "messages": [{"content": "t"}]}) \
+        == "beard:products:300:text"
+
+
+def warm(resilient, request_class, seconds, count):
+    for _ in range(count):
+        resilient.call(lambda timeout: time.sleep(seconds), hedge=True, request_class=request_class)
+
+
+def test_hedging_uses_the_p95_of_the_request_class(monkeypatch):
+    monkeypatch.setattr(resilience, "HEDGE_MIN_SAMPLES", 5)
+    resilient = caller(hedging=True)
+    warm(resilient, "fast", 0.01, 5)
+    warm(resilient, "slow", 0.15, 5)
+    p95 = resilient.snapshot()["p95_s"]
+    assert p95["fast"] < 0.1 < p95["slow"]
+
+    # Aussi lent que d'habitude pour sa classe : pas de seconde requête
+    resilient.call(lambda timeout: time.sleep(0.12), hedge=True, request_class="slow")
+    assert resilient.stats["hedges"] == 0
+
+    # Lent pour la classe rapide : la seconde requête part et gagne
+    calls = []
+    lock = threading.Lock()
+
+    def first_slow(timeout):
+        with lock:
+            calls.append(1)
+            first = len(calls) == 1
+        time.sleep(0.5 if first else 0.0)
+        return "première" if first else "seconde"
+
+    assert resilient.call(first_slow, hedge=True, request_class="fast") == "seconde"
+    assert resilient.stats["hedges"] == 1 and resilient.stats["hedge_wins"] == 1
+
+
+def test_streaming_calls_do_not_feed_the_windows():
+    resilient = caller(hedging=True)
+    resilient.call(lambda timeout: None)
+    assert resilient.snapshot()["p95_s"] == {}
@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import result_cache
+from result_cache import ResultCache, cache_namespace, make_cache_key
+
+
+@pytest.fixture
+def memory_cache():
+    return ResultCache(directory=None, max_entries=2, enabled=True)
+
+
+def test_cache_key_is_stable():
+    args = (b"photo", "lipstick", "gpt-4o-mini", "v1", 300)
+    assert make_cache_key(*args) == make_cache_key(*args)
+    assert len(make_cache_key(*args)) == 64
+
+
+@pytest.mark.parametrize("changed", [
+    (b"autre photo", "lipstick", "gpt-4o-mini", "v1", 300),
+    (b"photo", "beard", "gpt-4o-mini", "v1", 300),
+    (b"photo", "lipstick", "gpt-4o", "v1", 300),
+    (b"photo", "lipstick", "gpt-4o-mini", "v2", 300),
+    (b"photo", "lipstick", "gpt-4o-mini", "v1", 600),
+])
+def test_cache_key_depends_on_every_parameter(changed):
+    assert make_cache_key(*changed) != make_cache_key(b"photo", "lipstick", "gpt-4o-mini", "v1", 300)
+
+
+def test_namespace_matches_key_parameters():
+    assert cache_namespace("lipstick", "gpt-4o-mini", "v1", 300) == "lipstick|gpt-4o-mini|v1|300"
+    # Résultats de l'interface et du traitement par lots rangés à part
+    assert (make_cache_key(b"photo", "lipstick", "gpt-4o-mini", "v1", 300)
+            != make_cache_key(b"photo", "lipstick-batch", "gpt-4o-mini", "v1", 300))
+
+
+def test_memory_lru_evicts_least_recently_used(memory_cache):
+    memory_cache.set("a", {"v": 1})
+    memory_cache.set("b", {"v": 2})
+    # Lecture de "a" : c'est "b" le moins récemment utilisé
+    assert memory_cache.get("a") == {"v": 1}
+    memory_cache.set("c", {"v": 3})
+    assert memory_cache.get("b") is None
+    assert memory_cache.get("a") == {"v": 1}
+    assert memory_cache.get("c") == {"v": 3}
+    assert memory_cache.stats["evictions"] == 1
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResultCache(directory=None, enabled=False)
+    cache.set("a", {"v": 1})
+    assert cache.get("a") is None
+    assert cache.snapshot()["writes"] == 0
+
+
+def test_disk_entries_survive_a_new_instance(tmp_path):
+    ResultCache(directory=tmp_path, enabled=True).set("ab12", {"v": 1})
+    cache = ResultCache(directory=tmp_path, enabled=True)
+    assert cache.get("ab12") == {"v": 1}
+    assert cache.stats["disk_hits"] == 1
+    assert cache.snapshot()["disk_bytes"] > 0
+
+
+def test_expired_entries_are_dropped(tmp_path, monkeypatch):
+    cache = ResultCache(directory=tmp_path, ttl_seconds=60, enabled=True)
+    cache.set("ab12", {"v": 1})
+    now = time.time()
+    monkeypatch.setattr(result_cache.time, "time", lambda: now + 61)
+    assert cache.get("ab12") is None
+    assert not list(tmp_path.glob("*/*.json"))
+    assert cache.snapshot()["disk_bytes"] == 0
+
+
+def test_disk_eviction_removes_oldest_entries(tmp_path):
+    value = {"v": "x" * 200}
+    cache = ResultCache(directory=tmp_path, max_entries=1, max_disk_bytes=10_000, enabled=True)
+    entry_size = None
+    for i in range(3):
+        key = f"{i:02d}" + "0" * 62
+        cache.set(key, value)
+        path = tmp_path / key[:2] / f"{key}.json"
+        entry_size = path.stat().st_size
+        # mtime croissant : l'éviction suit l'ordre d'écriture
+        os.utime(path, (1000 + i, 1000 + i))
+    # Budget de deux entrées et demie : la quatrième écriture fait évincer la plus ancienne
+    cache.max_disk_bytes = int(entry_size * 2.5)
+    cache.set("03" + "0" * 62, value)
+    remaining = sorted(p.name[:2] for p in tmp_path.glob("*/*.json"))
+    assert remaining == ["02", "03"]
+    assert cache.snapshot()["disk_bytes"] <= cache.max_disk_bytes
+
+
+def test_clear_empties_both_levels(tmp_path):
+    cache = ResultCache(directory=tmp_path, enabled=True)
+    cache.set("ab12", {"v": 1})
+    cache.clear()
+    assert cache.get("ab12") is None
+    assert cache.snapshot()["disk_bytes"] == 0
+
+
+def test_results_are_copied_in_and_out(tmp_path):
+    cache = ResultCache(directory=tmp_path, enabled=True)
+    stored = {"analysis": "ok", "palette": ["Rouge"]}
+    cache.set("ab12", stored)
+    stored["palette"].append("Rose")
+    first = cache.get("ab12")
+    first["palette"].append("Nude")
+    assert cache.get("ab12") == {"analysis": "ok", "palette": ["Rouge"]}
+    # Relu depuis le disque par une autre instance : même garantie
+    other = ResultCache(directory=tmp_path, enabled=True)
+    other.get("ab12")["analysis"] = "modifié"
+    assert other.get("ab12")["analysis"] == "ok"
+
+
+def test_concurrent_writers_of_a_key_leave_no_temp_file(tmp_path):
+    cache = ResultCache(directory=tmp_path, enabled=True)
+    threads = [threading.Thread(target=lambda i=i: [cache.set("ab12", {"v": i}) for _ in range(50)])
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.get("ab12")["v"] in range(4)
+    assert not list(tmp_path.glob("*/*.tmp"))
+    assert json.loads((tmp_path / "ab" / "ab12.json").read_text(encoding="utf-8"))["value"]["v"] in range(4)
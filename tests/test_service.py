@@ -0,0 +1,127 @@
+import io
+import threading
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("openai")
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient  # noqa: E402
+
+import service  # noqa: E402
+import upload_buffer  # noqa: E402
+from analysis_pool import AnalysisPool  # noqa: E402
+
+
+def png(width: int = 10, height: int = 10) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), "white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeAnalyzer:
+    outcome = "model"
+
+    def __init__(self):
+        self.last_trace = None
+        self.last_notice = None
+
+    def analyze_image(self, image_bytes, use_cache=True):
+        self.last_trace = SimpleNamespace(outcome=self.outcome)
+        return {"photos": 1}
+
+    def analyze_session(self, images, mode, use_cache=True):
+        self.last_trace = SimpleNamespace(outcome=self.outcome)
+        return {"photos": len(images), "mode": mode}
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = AnalysisPool(workers=1, max_queue=0)
+    monkeypatch.setattr(service, "get_analysis_pool", lambda: pool)
+    monkeypatch.setattr(service, "load_analyzer_class", lambda kind: FakeAnalyzer)
+    return pool
+
+
+@pytest.fixture
+def client(pool):
+    return TestClient(service.app)
+
+
+def post_raw(client, data: bytes, kind: str = "lipstick", **params):
+    return client.post(f"/v1/{kind}/analyze", content=data,
+                       headers={"Content-Type": "image/png"}, params=params)
+
+
+def test_analysis_returns_the_result(client, pool):
+    response = post_raw(client, png())
+    assert response.status_code == 200
+    assert response.json()["result"] == {"photos": 1}
+    assert response.json()["outcome"] == "model"
+    assert pool.snapshot()["completed"] == 1
+
+
+def test_several_photos_form_a_session(client):
+    files = [("image", ("a.png", png(), "image/png")), ("image", ("b.png", png(), "image/png"))]
+    response = client.post("/v1/beard/analyze", files=files)
+    assert response.status_code == 200
+    assert response.json()["result"] == {"photos": 2, "mode": "per_photo"}
+
+
+def test_unknown_analyzer_is_404(client):
+    assert post_raw(client, png(), kind="mascara").status_code == 404
+
+
+def test_empty_image_and_bad_mode_are_400(client):
+    assert post_raw(client, b"").status_code == 400
+    assert post_raw(client, png(), mode="moyenne").status_code == 400
+
+
+def test_unsupported_format_is_415(client):
+    assert post_raw(client, b"GIF89a" + b"\0" * 20).status_code == 415
+
+
+def test_too_many_bytes_is_413(client, monkeypatch):
+    monkeypatch.setattr(upload_buffer, "MAX_UPLOAD_BYTES", 10)
+    assert post_raw(client, png()).status_code == 413
+
+
+def test_too_many_pixels_is_413_before_the_pool(client, pool, monkeypatch):
+    monkeypatch.setattr(upload_buffer, "MAX_IMAGE_PIXELS", 1000)
+    response = post_raw(client, png(100, 100))
+    assert response.status_code == 413
+    assert "100x100" in response.json()["detail"]
+    assert pool.snapshot()["submitted"] == 0
+
+
+def test_full_pool_is_503_with_retry_after(client, pool):
+    started, release = threading.Event(), threading.Event()
+    running = pool.submit(lambda job: started.set() or release.wait(5))
+    started.wait(2)
+    try:
+        response = post_raw(client, png())
+    finally:
+        release.set()
+    running.result()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
+
+
+def test_error_outcome_is_502_with_the_fallback(client, monkeypatch):
+    monkeypatch.setattr(FakeAnalyzer, "outcome", "error")
+    response = post_raw(client, png())
+    assert response.status_code == 502
+    assert response.json()["result"] == {"photos": 1}
+
+
+def test_jobs_are_forgotten_even_when_the_worker_fails(pool, monkeypatch):
+    post_raw(TestClient(service.app), png())
+    assert pool.snapshot()["jobs"] == 0
+
+    def crash(self, image_bytes, use_cache=True):
+        raise RuntimeError("panne")
+    monkeypatch.setattr(FakeAnalyzer, "analyze_image", crash)
+    response = post_raw(TestClient(service.app, raise_server_exceptions=False), png())
+    assert response.status_code == 500
+    assert pool.snapshot()["jobs"] == 0
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def run_concurrently(flight, key, fn, callers):
+    results, errors = [], []
+    barrier = threading.Barrier(callers)
+
+    def call():
+        barrier.wait()
+        try:
+            results.append(flight.do(key, fn))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_identical_calls_share_one_execution():
+    flight, calls = SingleFlight(), []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return {"chosen_color": "Ruby"}
+
+    results, errors = run_concurrently(flight, "photo", slow, 5)
+    assert not errors
+    assert len(calls) == 1
+    assert [value for value, _ in results] == [{"chosen_color": "Ruby"}] * 5
+    # Un seul appelant a exécuté la fonction, les autres ont attendu son résultat
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    assert flight.snapshot() == {"calls": 1, "coalesced": 4, "errors": 0, "in_flight": 0}
+
+
+def test_error_is_raised_to_every_waiter():
+    flight = SingleFlight()
+
+    def failing():
+        time.sleep(0.1)
+        raise RuntimeError("API indisponible")
+
+    results, errors = run_concurrently(flight, "photo", failing, 3)
+    assert results == []
+    assert len(errors) == 3 and all(str(e) == "API indisponible" for e in errors)
+    assert flight.stats["errors"] == 1
+
+
+def test_key_is_released_after_the_call():
+    flight, calls = SingleFlight(), []
+    for _ in range(2):
+        assert flight.do("photo", lambda: calls.append(1) or len(calls)) == (len(calls), False)
+    assert calls == [1, 1]
+    assert flight.in_flight() == 0
+    with pytest.raises(ValueError):
+        flight.do("photo", lambda: (_ for _ in ()).throw(ValueError("x")))
+    assert flight.in_flight() == 0
+
+
+def test_different_keys_run_independently():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait(2)
+        return "a"
+
+    thread = threading.Thread(target=flight.do, args=("a", blocking))
+    thread.start()
+    started.wait(2)
+    # La clé "a" est occupée : "b" part quand même tout de suite
+    assert flight.do("b", lambda: "b") == ("b", False)
+    release.set()
+    thread.join()
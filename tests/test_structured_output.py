@@ -0,0 +1,66 @@
+import pytest
+
+from structured_output import (SchemaValidationError, coerce_bool, enum_property, json_schema_format,
+                               nearest_choice, repair_enum, strict_object)
+
+COLORS = ["Rouge Passion", "Rose Nude", "Ruby", "Prune Élégante"]
+BEARD_COLORS = ["Noir", "Châtain", "Gris/Poivre et Sel"]
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("Ruby", "Ruby"),
+    # Casse, accents et espaces ignorés
+    ("  rouge passion ", "Rouge Passion"),
+    ("prune elegante", "Prune Élégante"),
+    # Valeur contenue dans une seule option, ou qui en contient une seule
+    ("Rouge Ruby", "Ruby"),
+    ("Gris", "Gris/Poivre et Sel"),
+    # Faute de frappe
+    ("Rose Nud", "Rose Nude"),
+])
+def test_nearest_choice(value, expected):
+    choices = BEARD_COLORS if value == "Gris" else COLORS
+    assert nearest_choice(value, choices) == expected
+
+
+@pytest.mark.parametrize("value", ["", "   ", None, 3, "Bleu Océan"])
+def test_nearest_choice_without_match(value):
+    assert nearest_choice(value, COLORS) is None
+
+
+def test_repair_enum_replaces_and_records():
+    data, repairs = {"chosen_color": "rouge passion"}, []
+    repair_enum(data, "chosen_color", COLORS, repairs)
+    assert data["chosen_color"] == "Rouge Passion"
+    assert repairs == ["chosen_color: 'rouge passion' -> 'Rouge Passion'"]
+
+
+def test_repair_enum_leaves_valid_values_alone():
+    data, repairs = {"chosen_color": "Ruby"}, []
+    repair_enum(data, "chosen_color", COLORS, repairs)
+    assert data == {"chosen_color": "Ruby"}
+    assert repairs == []
+
+
+@pytest.mark.parametrize("data", [{"chosen_color": "Bleu Océan"}, {}])
+def test_repair_enum_rejects_unknown_values(data):
+    with pytest.raises(SchemaValidationError, match="chosen_color"):
+        repair_enum(data, "chosen_color", COLORS, [])
+
+
+@pytest.mark.parametrize("value, expected", [
+    (True, True), ("Oui", True), ("yes", True), (1, True),
+    (False, False), ("NON", False), ("0", False), (0.0, False),
+    ("peut-être", None), (None, None),
+])
+def test_coerce_bool(value, expected):
+    assert coerce_bool(value) is expected
+
+
+def test_strict_schema_requires_every_property():
+    schema = strict_object({"chosen_color": enum_property(COLORS, "Teinte"), "analysis": {"type": "string"}})
+    assert schema["required"] == ["chosen_color", "analysis"]
+    assert schema["additionalProperties"] is False
+    assert schema["properties"]["chosen_color"] == {"type": "string", "enum": COLORS, "description": "Teinte"}
+    response_format = json_schema_format("lipstick", schema)
+    assert response_format["json_schema"] == {"name": "lipstick", "strict": True, "schema": schema}
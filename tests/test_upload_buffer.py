@@ -0,0 +1,50 @@
+import io
+
+import pytest
+from PIL import Image
+
+import upload_buffer
+from upload_buffer import UploadTooLargeError, upload_bytes
+
+
+class FakeUpload(io.BytesIO):
+    # Comme UploadedFile de Streamlit : un BytesIO avec la taille annoncée
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.size = len(data)
+
+
+def png(width: int, height: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), "white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_small_photo_is_accepted():
+    data = png(10, 10)
+    assert upload_bytes(FakeUpload(data)) == data
+
+
+def test_too_many_bytes_is_rejected_before_reading(monkeypatch):
+    monkeypatch.setattr(upload_buffer, "MAX_UPLOAD_BYTES", 10)
+    with pytest.raises(UploadTooLargeError, match="volumineuse"):
+        upload_bytes(FakeUpload(png(10, 10)))
+
+
+def test_too_many_pixels_is_rejected_at_upload(monkeypatch):
+    # Fichier minuscule (PNG uni) dont l'en-tête annonce plus de pixels que le plafond
+    monkeypatch.setattr(upload_buffer, "MAX_IMAGE_PIXELS", 1000)
+    data = png(100, 100)
+    assert len(data) < upload_buffer.MAX_UPLOAD_BYTES
+    with pytest.raises(UploadTooLargeError, match="100x100"):
+        upload_bytes(FakeUpload(data))
+
+
+def test_decompression_bomb_is_rejected_cleanly(monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    with pytest.raises(UploadTooLargeError):
+        upload_bytes(FakeUpload(png(100, 100)))
+
+
+def test_unreadable_bytes_are_left_to_the_analysis():
+    assert upload_bytes(FakeUpload(b"pas une image")) == b"pas une image"
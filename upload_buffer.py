@@ -0,0 +1,65 @@
+"""Photos envoyées : une seule lecture, pas de copie, taille bornée.
+
+UploadedFile est un BytesIO construit sur les octets reçus. Tant qu'il n'est
+ni modifié ni exporté, CPython fait partager ce même objet bytes à
+getvalue() et à io.BytesIO(data) : ni le hash, ni le décodage Pillow, ni
+les analyses ne recopient l'envoi. Il faut en revanche éviter getbuffer(),
+qui force une copie privée (et rend les getvalue() suivants copiants eux
+aussi). Les vraies copies venaient de l'aperçu : la photo entière encodée en
+base64 (un tiers plus grande) puis gardée dans la session. L'aperçu est
+désormais une vignette (image_prep.PREVIEW_OPTIONS), et seules les images
+réduites sont encodées en base64.
+
+La taille est vérifiée avant tout décodage : octets annoncés par l'envoi
+(BEAUTY_MAX_UPLOAD_BYTES), puis dimensions lues dans l'en-tête de l'image
+(BEAUTY_MAX_IMAGE_PIXELS), pour qu'une photo géante ou une bombe de
+décompression ne soit jamais décodée en entier. upload_bytes() fait les deux
+vérifications à la lecture de l'envoi, pour que la page refuse la photo avant
+de calculer l'aperçu.
+"""
+import io
+import os
+
+from PIL import Image, UnidentifiedImageError
+
+MAX_UPLOAD_BYTES = int(os.getenv("BEAUTY_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("BEAUTY_MAX_IMAGE_PIXELS", str(40_000_000)))
+
+
+class UploadTooLargeError(ValueError):
+    """Photo au-delà de la taille ou du nombre de pixels autorisés."""
+
+
+def check_upload_size(size: int) -> None:
+    if size > MAX_UPLOAD_BYTES:
+        raise UploadTooLargeError(f"Photo trop volumineuse : {size / 2**20:.1f} Mo "
+                                  f"(max {MAX_UPLOAD_BYTES / 2**20:.0f} Mo)")
+
+
+def check_image_pixels(width: int, height: int) -> None:
+    # Appelé juste après Image.open, qui ne lit que l'en-tête
+    if width * height > MAX_IMAGE_PIXELS:
+        raise UploadTooLargeError(f"Photo trop grande : {width}x{height} pixels "
+                                  f"(max {MAX_IMAGE_PIXELS / 1e6:.0f} mégapixels)")
+
+
+def check_image_header(image_bytes: bytes) -> None:
+    # Dimensions lues dans l'en-tête, sans décodage des pixels
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            check_image_pixels(*image.size)
+    except Image.DecompressionBombError as e:
+        # Au-delà du seuil de Pillow lui-même : même refus que le nôtre
+        raise UploadTooLargeError(f"Photo trop grande (max {MAX_IMAGE_PIXELS / 1e6:.0f} mégapixels)") from e
+    except (UnidentifiedImageError, OSError):
+        # Illisible par Pillow : image_prep envoie alors l'original, sans le décoder
+        return
+
+
+def upload_bytes(uploaded_file) -> bytes:
+    # Taille annoncée vérifiée avant de toucher au contenu
+    check_upload_size(uploaded_file.size)
+    # Même objet bytes à chaque appel, partagé avec le tampon de l'UploadedFile
+    data = uploaded_file.getvalue()
+    check_image_header(data)
+    return data